@@ -0,0 +1,369 @@
+import numpy as np
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+from database import SessionLocal
+from metrics import register_stats, executor_stats
+from face_matching import (
+    SessionDescriptors,
+    load_session_descriptors,
+    face_distances,
+    rank_photos,
+    match_faces,
+    session_file_path,
+    prefix_fingerprint,
+    DESCRIPTOR_DTYPE,
+    DEFAULT_MATCH_THRESHOLD
+)
+
+# Sessions with fewer faces than this are searched exactly
+ANN_MIN_FACES = int(os.getenv("ANN_MIN_FACES", "2000"))
+
+# Number of inverted lists probed per query (higher = better recall, slower)
+ANN_NPROBE = int(os.getenv("ANN_NPROBE", "8"))
+
+# Retrain the centroids once the session has grown this much since training
+ANN_RETRAIN_FACTOR = float(os.getenv("ANN_RETRAIN_FACTOR", "4"))
+
+# Threads training and extending indexes in the background
+ANN_BUILD_WORKERS = int(os.getenv("ANN_BUILD_WORKERS", "1"))
+
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLE_PER_LIST = 32
+
+
+_build_pool = ThreadPoolExecutor(max_workers=ANN_BUILD_WORKERS, thread_name_prefix="ann-build")
+
+register_stats("ann_build_pool", "Background ANN index builds", lambda: executor_stats(_build_pool))
+
+
+def default_nlist(face_count: int) -> int:
+    """Number of inverted lists for a session of the given size (~2*sqrt(n))"""
+    return int(max(1, min(2 * np.sqrt(face_count), face_count // 8 or 1)))
+
+
+def _nearest_centroids(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    # Squared distance up to the per-vector constant ||v||^2
+    centroid_norms = np.einsum('ij,ij->i', centroids, centroids)
+    scores = centroid_norms[None, :] - 2.0 * (vectors @ centroids.T)
+    return scores.argmin(axis=1).astype(np.int32)
+
+
+def train_centroids(vectors: np.ndarray, nlist: int, seed: int = 0) -> np.ndarray:
+    """
+    Lloyd's k-means on (a sample of) the session's descriptors
+
+    Args:
+        vectors: Descriptor matrix, shape (faces, 128)
+        nlist: Number of centroids
+        seed: Random seed, fixed so rebuilds are reproducible
+
+    Returns:
+        float32 array of shape (nlist, 128)
+    """
+    rng = np.random.default_rng(seed)
+    count = vectors.shape[0]
+
+    sample_size = min(count, nlist * KMEANS_SAMPLE_PER_LIST)
+    sample = np.asarray(vectors[np.sort(rng.choice(count, sample_size, replace=False))])
+    centroids = sample[rng.choice(sample_size, nlist, replace=False)].copy()
+
+    for _ in range(KMEANS_ITERATIONS):
+        labels = _nearest_centroids(sample, centroids)
+
+        # Per-list means via one sort + reduceat instead of a Python loop
+        order = np.argsort(labels, kind='stable')
+        counts = np.bincount(labels, minlength=nlist)
+        filled = counts > 0
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[filled]
+        sums = np.add.reduceat(sample[order].astype(np.float64), starts, axis=0)
+        centroids[filled] = (sums / counts[filled, None]).astype(DESCRIPTOR_DTYPE)
+
+        # Reseed empty lists with random points so every list stays useful
+        empty = np.flatnonzero(~filled)
+        if len(empty):
+            centroids[empty] = sample[rng.choice(sample_size, len(empty), replace=False)]
+
+    return centroids
+
+
+class IVFIndex:
+    """
+    Inverted-file index over a session's descriptor matrix
+
+    The index stores only centroids and the list assignment of each matrix
+    row; the vectors themselves stay in the memory-mapped matrix file.
+    """
+
+    def __init__(self, centroids: np.ndarray, assignments: np.ndarray, trained_faces: int, fingerprint: str):
+        self.centroids = centroids
+        self.assignments = assignments
+        self.trained_faces = trained_faces
+        self.fingerprint = fingerprint
+        self._build_lists()
+
+    def _build_lists(self):
+        self.list_order = np.argsort(self.assignments, kind='stable').astype(np.int64)
+        self.list_offsets = np.searchsorted(
+            self.assignments[self.list_order], np.arange(len(self.centroids) + 1)
+        )
+
+    @property
+    def nlist(self) -> int:
+        return len(self.centroids)
+
+    def __len__(self):
+        return len(self.assignments)
+
+    @classmethod
+    def train(cls, matrix: np.ndarray, nlist: Optional[int] = None) -> "IVFIndex":
+        """Train centroids on the matrix and assign every row"""
+        count = matrix.shape[0]
+        centroids = train_centroids(matrix, nlist or default_nlist(count))
+        assignments = _nearest_centroids(np.asarray(matrix), centroids)
+        return cls(centroids, assignments, count, prefix_fingerprint(matrix, count))
+
+    def extend(self, matrix: np.ndarray):
+        """Assign rows appended to the matrix since the index was last saved"""
+        start = len(self.assignments)
+        if matrix.shape[0] <= start:
+            return
+
+        tail = _nearest_centroids(np.asarray(matrix[start:]), self.centroids)
+        self.assignments = np.concatenate([self.assignments, tail])
+        self.fingerprint = prefix_fingerprint(matrix, len(self.assignments))
+        self._build_lists()
+
+    def candidates(self, queries: np.ndarray, nprobe: int) -> np.ndarray:
+        """Matrix rows in the nprobe lists closest to any of the queries"""
+        nprobe = min(max(1, nprobe), self.nlist)
+
+        # (queries, nlist) squared distances up to the per-query constant
+        centroid_norms = np.einsum('ij,ij->i', self.centroids, self.centroids)
+        scores = centroid_norms[None, :] - 2.0 * (queries @ self.centroids.T)
+        probes = np.unique(np.argpartition(scores, nprobe - 1, axis=1)[:, :nprobe])
+
+        return np.concatenate([
+            self.list_order[self.list_offsets[l]:self.list_offsets[l + 1]]
+            for l in probes
+        ])
+
+    def search(self, matrix: np.ndarray, queries: np.ndarray, nprobe: int = ANN_NPROBE) -> np.ndarray:
+        """
+        Approximate per-face distances to the closest query
+
+        Returns:
+            float32 array of shape (faces,); faces outside the probed lists are inf
+        """
+        rows = np.sort(self.candidates(queries, nprobe))
+
+        distances = np.full(matrix.shape[0], np.inf, dtype=np.float32)
+        if len(rows):
+            distances[rows] = face_distances(np.asarray(matrix[rows]), queries)
+
+        return distances
+
+    def save(self, path: str):
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp.npz"
+        np.savez(
+            tmp_path,
+            centroids=self.centroids,
+            assignments=self.assignments,
+            trained_faces=np.int64(self.trained_faces),
+            fingerprint=np.str_(self.fingerprint)
+        )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "IVFIndex":
+        with np.load(path) as data:
+            return cls(
+                data["centroids"],
+                data["assignments"],
+                int(data["trained_faces"]),
+                str(data["fingerprint"])
+            )
+
+
+# In-process copies of loaded indexes: session -> (file mtime, IVFIndex)
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def load_session_index(session_id: str, descriptors: SessionDescriptors) -> Optional[IVFIndex]:
+    """
+    The session's stored index, if it was built from the first rows of the matrix
+
+    Never trains or extends (see update_session_index); the index may cover
+    fewer rows than the matrix has.
+
+    Returns:
+        IVFIndex, or None if there is none or the matrix was rebuilt
+        differently since (e.g. photos deleted)
+    """
+    path = session_file_path(session_id, "ivf.npz")
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+    with _indexes_lock:
+        cached = _indexes.get(session_id)
+
+    if cached is not None and cached[0] == mtime:
+        index = cached[1]
+    else:
+        try:
+            index = IVFIndex.load(path)
+        except (OSError, ValueError, KeyError):
+            return None
+        with _indexes_lock:
+            _indexes[session_id] = (mtime, index)
+
+    indexed = len(index)
+    if indexed > len(descriptors) or index.fingerprint != descriptors.prefix_fingerprint(indexed):
+        return None
+    return index
+
+
+def index_outdated(index: Optional[IVFIndex], count: int) -> bool:
+    """Whether update_session_index has work to do for a matrix of count rows"""
+    return index is None or len(index) < count or count > index.trained_faces * ANN_RETRAIN_FACTOR
+
+
+def update_session_index(session_id: str, descriptors: SessionDescriptors) -> IVFIndex:
+    """
+    Extend or (re)train the IVF index of a session and save it
+
+    New faces at the end of the matrix are assigned to the existing lists;
+    the centroids are retrained only when the session has grown by
+    ANN_RETRAIN_FACTOR or the matrix no longer matches the index. Runs in
+    the background (request_index_update), never in a match request.
+
+    Args:
+        session_id: Session ID
+        descriptors: The session's current descriptor matrix
+
+    Returns:
+        IVFIndex covering every row of the matrix
+    """
+    matrix = descriptors.matrix
+    count = len(descriptors)
+    index = load_session_index(session_id, descriptors)
+
+    if not index_outdated(index, count):
+        return index
+
+    if index is None or count > index.trained_faces * ANN_RETRAIN_FACTOR:
+        index = IVFIndex.train(matrix)
+    else:
+        # Requests may be searching the cached copy; extend a new one
+        index = IVFIndex(index.centroids, index.assignments, index.trained_faces, index.fingerprint)
+        index.extend(matrix)
+
+    path = session_file_path(session_id, "ivf.npz")
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        index.save(path)
+    except OSError as e:
+        print(f"Error saving ANN index for session {session_id}: {e}")
+
+    return index
+
+
+# Sessions with an index update queued; one more request while it runs queues one more run
+_pending = set()
+_pending_lock = threading.Lock()
+
+
+def _update_logged(session_id: str):
+    with _pending_lock:
+        _pending.discard(session_id)
+
+    db = SessionLocal()
+    try:
+        descriptors = load_session_descriptors(db, session_id)
+        db.rollback()
+        if len(descriptors) >= ANN_MIN_FACES:
+            update_session_index(session_id, descriptors)
+    except Exception as e:
+        print(f"Error updating ANN index for session {session_id}: {e}")
+    finally:
+        db.close()
+
+
+def request_index_update(session_id: str, if_indexed: bool = False):
+    """
+    Bring a session's index up to date on the background pool
+
+    Requests for a session that already has an update queued are merged
+    into it, so a burst of newly ready photos costs one run.
+
+    Args:
+        session_id: Session ID
+        if_indexed: Only if the session already has an index (small sessions
+            are searched exactly and get their first index from a match)
+    """
+    if if_indexed and not os.path.exists(session_file_path(session_id, "ivf.npz")):
+        return
+    with _pending_lock:
+        if session_id in _pending:
+            return
+        _pending.add(session_id)
+    _build_pool.submit(_update_logged, session_id)
+
+
+def forget_session_index(session_id: str):
+    """Drop the in-process copy of a session's index"""
+    with _indexes_lock:
+        _indexes.pop(session_id, None)
+
+
+def search_session(
+    session_id: str,
+    descriptors: SessionDescriptors,
+    queries: np.ndarray,
+    threshold: float = DEFAULT_MATCH_THRESHOLD,
+    limit: Optional[int] = None,
+    nprobe: Optional[int] = None
+) -> List[dict]:
+    """
+    Rank a session's photos against the queries, using the IVF index for
+    large sessions and exact search for small ones
+
+    Only stored indexes are used: a missing or stale one is updated in the
+    background, and the search is exact (for faces the index doesn't cover
+    yet) meanwhile.
+
+    Args:
+        session_id: Session ID
+        descriptors: Session descriptor matrix
+        queries: Query descriptors, shape (queries, 128)
+        threshold: Maximum distance counted as a match
+        limit: Optional maximum number of photos to return
+        nprobe: Lists probed per query (defaults to ANN_NPROBE)
+
+    Returns:
+        List of {"photo_id", "distance"} sorted by ascending distance
+    """
+    if len(descriptors) < ANN_MIN_FACES:
+        return match_faces(descriptors, queries, threshold, limit)
+
+    count = len(descriptors)
+    index = load_session_index(session_id, descriptors)
+    if index_outdated(index, count):
+        request_index_update(session_id)
+
+    if index is None:
+        # Searched exactly until the background build is done
+        return match_faces(descriptors, queries, threshold, limit)
+
+    distances = index.search(descriptors.matrix, queries, ANN_NPROBE if nprobe is None else nprobe)
+    indexed = len(index)
+    if indexed < count:
+        # Faces that arrived since the last update are compared one by one
+        distances[indexed:] = face_distances(np.asarray(descriptors.matrix[indexed:]), queries)
+
+    return rank_photos(descriptors, distances, threshold, limit)
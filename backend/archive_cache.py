@@ -0,0 +1,132 @@
+import hashlib
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import List
+
+from sqlalchemy import or_
+from sqlalchemy.orm import Session
+
+from database import SessionLocal
+from models import Session as SessionModel, Photo
+from ingestion import STATUS_READY
+from storage import get_storage
+from zip_stream import stream_zip
+from metrics import register_stats, executor_stats
+
+# A build that has not finished after this long is assumed dead and may be retried
+ARCHIVE_BUILD_LEASE_SECONDS = int(os.getenv("ARCHIVE_BUILD_LEASE_SECONDS", "1800"))
+
+ARCHIVE_BUILD_WORKERS = int(os.getenv("ARCHIVE_BUILD_WORKERS", "2"))
+
+_build_pool = ThreadPoolExecutor(max_workers=ARCHIVE_BUILD_WORKERS, thread_name_prefix="archive-build")
+
+register_stats("archive_build_pool", "Background session archive builds", lambda: executor_stats(_build_pool))
+
+
+def archive_key(session_id: str) -> str:
+    """R2 key of a session's cached full archive"""
+    return f"sessions/{session_id}/archive.zip"
+
+
+def archive_fingerprint(photos: List[Photo]) -> str:
+    """
+    Identify the set of photos an archive contains
+
+    Any added or removed photo changes the fingerprint, which is what makes
+    a stored archive stale.
+    """
+    digest = hashlib.sha256("\n".join(sorted(photo.id for photo in photos)).encode())
+    return digest.hexdigest()[:32]
+
+
+def claim_archive_build(db: Session, session_id: str) -> bool:
+    """
+    Mark a session's archive as being built
+
+    The conditional UPDATE makes this single-flight across requests and
+    workers: only the caller that flips the lease gets True.
+    """
+    now = datetime.utcnow()
+    claimed = db.query(SessionModel).filter(
+        SessionModel.id == session_id,
+        or_(
+            SessionModel.archive_build_started_at.is_(None),
+            SessionModel.archive_build_started_at < now - timedelta(seconds=ARCHIVE_BUILD_LEASE_SECONDS)
+        )
+    ).update({SessionModel.archive_build_started_at: now}, synchronize_session=False)
+    db.commit()
+    return claimed == 1
+
+
+def build_session_archive(session_id: str):
+    """
+    Build the full-session ZIP into a temp file and store it in R2
+
+    Every photo must make it in: if one can't be fetched nothing is stored,
+    only the build lease is cleared, and a later download retries.
+    """
+    db = SessionLocal()
+    try:
+        photos = db.query(Photo).filter(
+            Photo.session_id == session_id,
+            Photo.status == STATUS_READY
+        ).all()
+
+        fingerprint = archive_fingerprint(photos)
+        entries = [
+            (photo.r2_key_original, photo.original_filename, photo.uploaded_at)
+            for photo in photos
+        ]
+        db.rollback()
+
+        with tempfile.TemporaryFile() as archive_file:
+            for chunk in stream_zip(entries, strict=True):
+                archive_file.write(chunk)
+            size = archive_file.tell()
+            archive_file.seek(0)
+            get_storage().put_fileobj(archive_file, archive_key(session_id), "application/zip")
+
+        updated = db.query(SessionModel).filter(SessionModel.id == session_id).update({
+            SessionModel.archive_fingerprint: fingerprint,
+            SessionModel.archive_size: size,
+            SessionModel.archive_build_started_at: None
+        }, synchronize_session=False)
+        db.commit()
+
+        if not updated:
+            # Session was deleted while the archive was being built
+            delete_session_archive(session_id)
+            return
+        print(f"Built archive for session {session_id} ({len(entries)} photos, {size} bytes)")
+    except Exception as e:
+        print(f"Error building archive for session {session_id}: {e}")
+        db.rollback()
+        db.query(SessionModel).filter(SessionModel.id == session_id).update(
+            {SessionModel.archive_build_started_at: None}, synchronize_session=False
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+def request_archive_build(db: Session, session_id: str) -> bool:
+    """
+    Start a background build of the session's archive unless one is running
+
+    Returns:
+        True if this call started a build
+    """
+    if not claim_archive_build(db, session_id):
+        return False
+    _build_pool.submit(build_session_archive, session_id)
+    return True
+
+
+def delete_session_archive(session_id: str):
+    """Remove a session's cached archive from R2"""
+    try:
+        get_storage().delete(archive_key(session_id))
+    except Exception as e:
+        print(f"Error deleting archive for session {session_id}: {e}")
@@ -0,0 +1,73 @@
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional, Tuple
+
+from r2_storage import R2_MAX_CONNECTIONS
+from storage import get_storage
+from object_cache import object_cache
+from metrics import register_stats, executor_stats
+
+# Threads doing blocking storage calls for async code. One per pooled R2
+# connection: more threads would only queue on botocore's connection pool.
+STORAGE_IO_THREADS = int(os.getenv("STORAGE_IO_THREADS", str(R2_MAX_CONNECTIONS)))
+
+_io_pool = ThreadPoolExecutor(max_workers=STORAGE_IO_THREADS, thread_name_prefix="storage-io")
+
+register_stats("storage_io_pool", "Storage I/O thread pool used by async code", lambda: executor_stats(_io_pool))
+
+
+async def run_storage(func: Callable, *args, **kwargs):
+    """Run a blocking storage call on the storage thread pool"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_io_pool, functools.partial(func, *args, **kwargs))
+
+
+async def upload_bytes(content: bytes, key: str, content_type: str = "image/jpeg") -> str:
+    return await run_storage(get_storage().put, content, key, content_type)
+
+
+async def upload_fileobj(fileobj, key: str, content_type: str = "application/octet-stream") -> str:
+    return await run_storage(get_storage().put_fileobj, fileobj, key, content_type)
+
+
+async def upload_file(path: str, key: str, content_type: str = "application/octet-stream") -> str:
+    return await run_storage(get_storage().put_file, path, key, content_type)
+
+
+async def download_bytes(key: str) -> bytes:
+    return await run_storage(get_storage().get, key)
+
+
+async def delete_object(key: str):
+    return await run_storage(get_storage().delete, key)
+
+
+async def open_stream(key: str, byte_range: Optional[str] = None) -> Tuple[object, dict]:
+    """
+    Async StorageBackend.open_stream
+
+    Only the GET request runs here; the returned chunk iterator is still
+    blocking and is meant for StreamingResponse, which drains sync iterators
+    on its own thread pool.
+    """
+    return await run_storage(get_storage().open_stream, key, byte_range)
+
+
+async def cached_get(key: str, use_memory: bool = True) -> bytes:
+    """object_cache.get without blocking the event loop"""
+    # Memory hits are a dict lookup; don't pay for a thread hop
+    value = object_cache.get_memory(key) if use_memory else None
+    if value is not None:
+        return value
+    return await run_storage(object_cache.get, key, use_memory)
+
+
+async def cached_open_stream(key: str) -> Tuple[object, dict]:
+    """object_cache.open_stream without blocking the event loop (see open_stream)"""
+    return await run_storage(object_cache.open_stream, key)
+
+
+def shutdown_storage_pool():
+    _io_pool.shutdown(wait=True)
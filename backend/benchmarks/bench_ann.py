@@ -0,0 +1,166 @@
+"""
+Benchmark: IVF index vs exact brute-force face matching
+
+Usage:
+    python benchmarks/bench_ann.py [--people 300] [--faces 20000] [--queries 200] [--json out.json]
+
+Generates a synthetic session (clusters of faces around random "people"),
+then reports recall of the matched photo set and p50/p95 query latency for
+exact search and for the IVF index at several nprobe values. The "request"
+runs time what the match endpoint does per call (load_session_descriptors
+from the session's matrix files, then search_session), so per-request
+overhead shows up next to the bare index search. Runs offline, no database
+or R2 needed.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DESCRIPTOR_MATRIX_DIR", tempfile.mkdtemp(prefix="bench-ann-"))
+# Never opened: the benchmark writes the session's matrix files itself
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(os.environ['DESCRIPTOR_MATRIX_DIR'], 'unused.db')}")
+
+from face_matching import (  # noqa: E402
+    SessionDescriptors, match_faces, rank_photos, load_session_descriptors, session_file_path,
+    DESCRIPTOR_MATRIX_DIR, DEFAULT_MATCH_THRESHOLD
+)
+from ann_index import IVFIndex, search_session, update_session_index  # noqa: E402
+
+SESSION_ID = "bench-ann"
+
+
+def synthetic_session(people: int, faces: int, faces_per_photo: int, seed: int = 0):
+    """Faces drawn around per-person centres, ~1.0 apart like face-api.js descriptors"""
+    rng = np.random.default_rng(seed)
+    centres = rng.normal(0, 0.0625, size=(people, 128)).astype(np.float32)
+    owners = rng.integers(0, people, size=faces)
+    matrix = centres[owners] + rng.normal(0, 0.02, size=(faces, 128)).astype(np.float32)
+
+    photo_count = max(1, faces // faces_per_photo)
+    face_photo_index = np.sort(rng.integers(0, photo_count, size=faces))
+    photo_ids = [f"photo-{i:06d}" for i in range(photo_count)]
+
+    descriptors = SessionDescriptors(matrix.astype(np.float32), face_photo_index, photo_ids)
+    return descriptors, centres, rng
+
+
+def write_session_files(descriptors: SessionDescriptors):
+    """The matrix files build_session_matrix would write for this session"""
+    os.makedirs(DESCRIPTOR_MATRIX_DIR, exist_ok=True)
+    np.save(session_file_path(SESSION_ID, "matrix.npy"), descriptors.matrix)
+    np.save(
+        session_file_path(SESSION_ID, "photos.npy"),
+        np.asarray(descriptors.photo_ids, dtype='U')[descriptors.face_photo_index]
+    )
+
+
+def percentile_ms(samples, pct):
+    return float(np.percentile(samples, pct) * 1000)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--people", type=int, default=300)
+    parser.add_argument("--faces", type=int, default=20000)
+    parser.add_argument("--faces-per-photo", type=int, default=4)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument("--json", help="Write results to this file")
+    args = parser.parse_args()
+
+    descriptors, centres, rng = synthetic_session(args.people, args.faces, args.faces_per_photo)
+    owners = rng.integers(0, args.people, size=args.queries)
+    queries = centres[owners] + rng.normal(0, 0.02, size=(args.queries, 128)).astype(np.float32)
+
+    start = time.perf_counter()
+    index = IVFIndex.train(descriptors.matrix)
+    build_seconds = time.perf_counter() - start
+
+    results = {
+        "faces": args.faces,
+        "photos": len(descriptors.photo_ids),
+        "queries": args.queries,
+        "nlist": index.nlist,
+        "build_ms": round(build_seconds * 1000, 1),
+        "runs": []
+    }
+
+    exact_sets = []
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        matches = match_faces(descriptors, query[None, :], DEFAULT_MATCH_THRESHOLD)
+        latencies.append(time.perf_counter() - start)
+        exact_sets.append({m["photo_id"] for m in matches})
+
+    results["runs"].append({
+        "method": "exact",
+        "recall": 1.0,
+        "p50_ms": round(percentile_ms(latencies, 50), 3),
+        "p95_ms": round(percentile_ms(latencies, 95), 3)
+    })
+
+    for nprobe in args.nprobe:
+        latencies = []
+        found = 0
+        expected = 0
+        for query, exact in zip(queries, exact_sets):
+            start = time.perf_counter()
+            distances = index.search(descriptors.matrix, query[None, :], nprobe)
+            matches = rank_photos(descriptors, distances, DEFAULT_MATCH_THRESHOLD)
+            latencies.append(time.perf_counter() - start)
+
+            found += len(exact & {m["photo_id"] for m in matches})
+            expected += len(exact)
+
+        results["runs"].append({
+            "method": f"ivf nprobe={nprobe}",
+            "recall": round(found / expected, 4) if expected else 1.0,
+            "p50_ms": round(percentile_ms(latencies, 50), 3),
+            "p95_ms": round(percentile_ms(latencies, 95), 3)
+        })
+
+    # Full request path, with the index the background build would have saved
+    write_session_files(descriptors)
+    update_session_index(SESSION_ID, load_session_descriptors(None, SESSION_ID))
+    for nprobe in args.nprobe:
+        latencies = []
+        found = 0
+        expected = 0
+        for query, exact in zip(queries, exact_sets):
+            start = time.perf_counter()
+            session_descriptors = load_session_descriptors(None, SESSION_ID)
+            matches = search_session(
+                SESSION_ID, session_descriptors, query[None, :], DEFAULT_MATCH_THRESHOLD, nprobe=nprobe
+            )
+            latencies.append(time.perf_counter() - start)
+
+            found += len(exact & {m["photo_id"] for m in matches})
+            expected += len(exact)
+
+        results["runs"].append({
+            "method": f"request nprobe={nprobe}",
+            "recall": round(found / expected, 4) if expected else 1.0,
+            "p50_ms": round(percentile_ms(latencies, 50), 3),
+            "p95_ms": round(percentile_ms(latencies, 95), 3)
+        })
+
+    print(f"{results['faces']} faces / {results['photos']} photos, "
+          f"nlist={results['nlist']}, index built in {results['build_ms']} ms")
+    print(f"{'method':<22}{'recall':>8}{'p50 ms':>10}{'p95 ms':>10}")
+    for run in results["runs"]:
+        print(f"{run['method']:<22}{run['recall']:>8.4f}{run['p50_ms']:>10.3f}{run['p95_ms']:>10.3f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
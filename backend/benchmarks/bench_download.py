@@ -0,0 +1,84 @@
+"""
+Benchmark: download_photos ZIP size versus server peak RSS
+
+Usage:
+    python benchmarks/bench_download.py [--photos 10 50 100] [--megapixels 12] [--storage r2|local] [--json out.json]
+
+Seeds one session on an offline server (see offline.py), then downloads
+the first N photos as a ZIP for each N, reading the stream without keeping
+it. A streaming ZIP keeps RSS growth flat as the archive grows; growth that
+tracks the ZIP size means something buffers whole files or the archive.
+Photos are selected explicitly, so the live streaming path is measured
+rather than the cached full-session archive.
+"""
+import argparse
+import os
+import sys
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_thumbnails import synthetic_photo  # noqa: E402
+from offline import OfflineServer, RSSSampler, create_session, photo_ids, unique_variant, write_results  # noqa: E402
+
+
+def download_zip(client, session_id: str, ids) -> int:
+    """Stream a ZIP of the given photos; returns its size in bytes"""
+    size = 0
+    with client.stream("POST", f"/api/session/{session_id}/download", json=ids, timeout=600) as response:
+        response.raise_for_status()
+        for chunk in response.iter_raw():
+            size += len(chunk)
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--photos", type=int, nargs="+", default=[10, 50, 100])
+    parser.add_argument("--megapixels", type=float, default=12)
+    parser.add_argument("--storage", choices=["r2", "local"], default="r2")
+    parser.add_argument("--json", help="Write results to this file")
+    args = parser.parse_args()
+
+    base = synthetic_photo(args.megapixels)
+    results = []
+
+    with OfflineServer(storage=args.storage) as server, httpx.Client(base_url=server.url) as client:
+        photos = [unique_variant(base, i) for i in range(max(args.photos))]
+        session_id = create_session(client, "bench-download", photos)["session_id"]
+        ids = photo_ids(client, session_id)
+
+        # Warm-up: thread pools and connections
+        download_zip(client, session_id, ids[:1])
+
+        for count in args.photos:
+            with RSSSampler(server.pid) as rss:
+                start = time.perf_counter()
+                zip_bytes = download_zip(client, session_id, ids[:count])
+                seconds = time.perf_counter() - start
+
+            zip_mb = zip_bytes / 2 ** 20
+            results.append({
+                "photos": count,
+                "megapixels": args.megapixels,
+                "zip_mb": round(zip_mb, 1),
+                "seconds": round(seconds, 3),
+                "mb_per_second": round(zip_mb / seconds, 1),
+                "peak_rss_mb": rss.peak_mb,
+                "rss_growth_mb": rss.delta_mb,
+                "rss_growth_per_zip_mb": round(rss.delta_mb / zip_mb, 3) if zip_mb else None
+            })
+
+    print(f"{'photos':>7}{'ZIP':>10}{'time':>9}{'MB/s':>8}{'peak RSS':>11}{'growth':>9}")
+    for row in results:
+        print(f"{row['photos']:>7}{row['zip_mb']:>8.1f}MB{row['seconds']:>8.2f}s{row['mb_per_second']:>8.1f}"
+              f"{row['peak_rss_mb']:>9.1f}MB{row['rss_growth_mb']:>7.1f}MB")
+
+    if args.json:
+        write_results(args.json, "download", vars(args), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Benchmark: create_session throughput and memory with N photos
+
+Usage:
+    python benchmarks/bench_ingest.py [--photos 10 50 100] [--megapixels 12] [--storage r2|local] [--json out.json]
+
+Uploads N synthetic photos in one POST /api/host/create-session to an
+offline server (see offline.py) and waits until ingestion has stored every
+original and its derivatives. Reports the time until the request returned,
+the time until all photos were ready, photos/s and the server's peak RSS
+(including the thumbnail process pool) over its level before the upload.
+"""
+import argparse
+import os
+import sys
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_thumbnails import synthetic_photo  # noqa: E402
+from offline import OfflineServer, RSSSampler, create_session, unique_variant, write_results  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--photos", type=int, nargs="+", default=[10, 50, 100])
+    parser.add_argument("--megapixels", type=float, default=12)
+    parser.add_argument("--storage", choices=["r2", "local"], default="r2")
+    parser.add_argument("--json", help="Write results to this file")
+    args = parser.parse_args()
+
+    base = synthetic_photo(args.megapixels)
+    results = []
+
+    with OfflineServer(storage=args.storage) as server, httpx.Client(base_url=server.url) as client:
+        # Warm-up: imports, process pool start, SQLite schema
+        create_session(client, "warm-up", [unique_variant(base, -1)])
+
+        for count in args.photos:
+            photos = [unique_variant(base, count * 100000 + i) for i in range(count)]
+            upload_mb = sum(len(content) for content in photos) / 2 ** 20
+
+            with RSSSampler(server.pid) as rss:
+                session = create_session(client, f"bench-{count}", photos)
+
+            results.append({
+                "photos": count,
+                "megapixels": args.megapixels,
+                "upload_mb": round(upload_mb, 1),
+                "request_seconds": round(session["request_seconds"], 3),
+                "ready_seconds": round(session["ready_seconds"], 3),
+                "photos_per_second": round(count / session["ready_seconds"], 2),
+                "peak_rss_mb": rss.peak_mb,
+                "rss_growth_mb": rss.delta_mb
+            })
+
+    print(f"{'photos':>7}{'upload':>10}{'request':>10}{'ready':>10}{'photos/s':>10}{'peak RSS':>11}{'growth':>9}")
+    for row in results:
+        print(f"{row['photos']:>7}{row['upload_mb']:>8.1f}MB{row['request_seconds']:>9.2f}s{row['ready_seconds']:>9.2f}s"
+              f"{row['photos_per_second']:>10.2f}{row['peak_rss_mb']:>9.1f}MB{row['rss_growth_mb']:>7.1f}MB")
+
+    if args.json:
+        write_results(args.json, "ingest", vars(args), results)
+
+
+if __name__ == "__main__":
+    main()
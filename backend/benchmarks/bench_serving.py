@@ -0,0 +1,165 @@
+"""
+Benchmark: concurrent thumbnail fetch latency, alone and during host uploads
+
+Usage:
+    python benchmarks/bench_serving.py [--photos 50] [--concurrency 1 8 32] [--requests 400]
+                                       [--upload-batch 10] [--storage r2|local] [--json out.json]
+
+Seeds a session on an offline server (see offline.py), then for each
+concurrency level has that many guests fetch thumbnails (view and grid
+sizes, JPEG and WebP) and reports p50/p95/p99 latency and requests/s.
+
+Each level is measured twice: "guests" alone, and "mixed" while a host
+keeps uploading batches of new photos to another session, so guest
+latency under ingestion load (uploads, derivative generation, storage
+writes) can be compared with the idle numbers.
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import sys
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_thumbnails import synthetic_photo  # noqa: E402
+from offline import OfflineServer, create_session, percentiles_ms, photo_ids, unique_variant, write_results  # noqa: E402
+
+VARIANTS = [
+    {"size": "view", "format": "jpeg"},
+    {"size": "grid", "format": "jpeg"},
+    {"size": "view", "format": "webp"},
+    {"size": "grid", "format": "webp"}
+]
+
+
+async def fetch_thumbnails(client, ids, concurrency: int, requests: int):
+    """`concurrency` guests sharing `requests` thumbnail fetches; returns (latencies, errors, seconds)"""
+    targets = itertools.cycle(itertools.product(ids, VARIANTS))
+    remaining = iter(range(requests))
+    latencies = []
+    errors = 0
+
+    async def guest():
+        nonlocal errors
+        for _ in remaining:
+            photo_id, params = next(targets)
+            start = time.perf_counter()
+            response = await client.get(f"/api/photo/{photo_id}/thumbnail", params=params)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(guest() for _ in range(concurrency)))
+    return latencies, errors, time.perf_counter() - start
+
+
+async def host_uploads(client, photos, stop: asyncio.Event) -> dict:
+    """Upload batches of photos to one session until stopped; returns upload counters once ingested"""
+    session = (await client.post("/api/host/create-session", data={"session_name": "bench-host"})).json()
+    url = f"/api/session/{session['session_id']}/uploads"
+    uploaded = 0
+    upload_bytes = 0
+
+    for batch in itertools.count():
+        if stop.is_set():
+            break
+
+        # Same resumable protocol as the host UI: init, one PUT per part, commit
+        contents = [unique_variant(photo, batch * len(photos) + i) for i, photo in enumerate(photos)]
+        upload = (await client.post(url, json={"files": [
+            {"filename": f"host_{batch}_{i}.jpg", "content_type": "image/jpeg", "size": len(content)}
+            for i, content in enumerate(contents)
+        ]})).json()
+
+        part_size = upload["part_size"]
+        for entry, content in zip(upload["files"], contents):
+            for index in range(entry["parts"]):
+                response = await client.put(
+                    f"/api/uploads/{upload['upload_id']}/photos/{entry['photo_id']}/parts/{index}",
+                    content=content[index * part_size:(index + 1) * part_size]
+                )
+                response.raise_for_status()
+        (await client.post(f"/api/uploads/{upload['upload_id']}/commit", json={})).raise_for_status()
+
+        uploaded += len(contents)
+        upload_bytes += sum(len(content) for content in contents)
+
+    # Let ingestion finish so it doesn't spill into the next measurement
+    while not (await client.get(f"/api/session/{session['session_id']}/ingest-status")).json()["done"]:
+        await asyncio.sleep(0.05)
+
+    return {"photos": uploaded, "mb": upload_bytes / 2 ** 20}
+
+
+async def run_level(url: str, ids, concurrency: int, requests: int, host_photos=None) -> dict:
+    limits = httpx.Limits(max_connections=concurrency + 1, max_keepalive_connections=concurrency + 1)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=120) as client:
+        stop = asyncio.Event()
+        host = asyncio.create_task(host_uploads(client, host_photos, stop)) if host_photos else None
+
+        try:
+            latencies, errors, seconds = await fetch_thumbnails(client, ids, concurrency, requests)
+        finally:
+            stop.set()
+        uploads = await host if host else None
+
+    row = {
+        "scenario": "mixed" if host_photos else "guests",
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": errors,
+        "requests_per_second": round(len(latencies) / seconds, 1),
+        **percentiles_ms(latencies)
+    }
+    if uploads is not None:
+        row["host_photos_uploaded"] = uploads["photos"]
+        row["host_upload_mb_per_second"] = round(uploads["mb"] / seconds, 2)
+    return row
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--photos", type=int, default=50, help="Photos in the session guests browse")
+    parser.add_argument("--megapixels", type=float, default=12)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=400, help="Thumbnail fetches per measurement")
+    parser.add_argument("--upload-batch", type=int, default=10, help="Photos per host upload (0 skips the mixed runs)")
+    parser.add_argument("--storage", choices=["r2", "local"], default="r2")
+    parser.add_argument("--json", help="Write results to this file")
+    args = parser.parse_args()
+
+    base = synthetic_photo(args.megapixels)
+    host_photos = [unique_variant(base, -i - 1) for i in range(args.upload_batch)]
+    results = []
+
+    with OfflineServer(storage=args.storage) as server:
+        with httpx.Client(base_url=server.url) as client:
+            photos = [unique_variant(base, i) for i in range(args.photos)]
+            session_id = create_session(client, "bench-serving", photos)["session_id"]
+            ids = photo_ids(client, session_id)
+
+        # Warm-up: fills the metadata and object caches like a session that's being browsed
+        asyncio.run(run_level(server.url, ids, 4, len(ids) * len(VARIANTS)))
+
+        for concurrency in args.concurrency:
+            results.append(asyncio.run(run_level(server.url, ids, concurrency, args.requests)))
+            if host_photos:
+                results.append(asyncio.run(run_level(server.url, ids, concurrency, args.requests, host_photos)))
+
+    print(f"{'scenario':>9}{'conc':>6}{'req/s':>9}{'p50':>10}{'p95':>10}{'p99':>10}{'errors':>8}{'uploaded':>10}")
+    for row in results:
+        print(f"{row['scenario']:>9}{row['concurrency']:>6}{row['requests_per_second']:>9.1f}"
+              f"{row['p50_ms']:>8.1f}ms{row['p95_ms']:>8.1f}ms{row['p99_ms']:>8.1f}ms{row['errors']:>8}"
+              f"{row.get('host_photos_uploaded', ''):>10}")
+
+    if args.json:
+        write_results(args.json, "serving", vars(args), results)
+
+
+if __name__ == "__main__":
+    main()
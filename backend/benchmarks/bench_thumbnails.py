@@ -0,0 +1,97 @@
+"""
+Benchmark: derivative generation per image
+
+Usage:
+    python benchmarks/bench_thumbnails.py [--megapixels 4 12 24] [--repeat 5] [--json out.json]
+
+Compares the original thumbnail path (full decode, LANCZOS to 800px,
+optimize=True) with r2_storage.generate_derivatives (draft-mode decode,
+800px + 200px, JPEG + WebP) on synthetic camera-sized JPEGs. Runs offline.
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image  # noqa: E402
+
+from r2_storage import generate_derivatives  # noqa: E402
+
+
+def legacy_thumbnail(image_content: bytes, max_size: tuple = (800, 800)) -> bytes:
+    """generate_thumbnail as it was before the derivative engine"""
+    img = Image.open(io.BytesIO(image_content))
+    if img.mode == 'RGBA':
+        img = img.convert('RGB')
+    img.thumbnail(max_size, Image.Resampling.LANCZOS)
+    output = io.BytesIO()
+    img.save(output, format='JPEG', quality=85, optimize=True)
+    return output.getvalue()
+
+
+def synthetic_photo(megapixels: float) -> bytes:
+    """A 3:2 JPEG with noise and gradients so it decodes like a real photo"""
+    width = int((megapixels * 1_000_000 * 1.5) ** 0.5)
+    height = int(width / 1.5)
+    noise = Image.effect_noise((width // 8, height // 8), 32).resize((width, height), Image.Resampling.BICUBIC)
+    gradient = Image.linear_gradient("L").resize((width, height))
+    img = Image.merge("RGB", (noise, gradient, noise.transpose(Image.Transpose.FLIP_LEFT_RIGHT)))
+    output = io.BytesIO()
+    img.save(output, format='JPEG', quality=90)
+    return output.getvalue()
+
+
+def time_call(func, content: bytes, repeat: int) -> float:
+    func(content)  # warm-up
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(content)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--megapixels", type=float, nargs="+", default=[4, 12, 24])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", help="Write results to this file")
+    args = parser.parse_args()
+
+    view_only = [("view", 800, "JPEG")]
+    results = []
+
+    for megapixels in args.megapixels:
+        content = synthetic_photo(megapixels)
+
+        legacy = time_call(legacy_thumbnail, content, args.repeat)
+        draft_view = time_call(lambda c: generate_derivatives(c, view_only), content, args.repeat)
+        all_derivatives = time_call(generate_derivatives, content, args.repeat)
+
+        results.append({
+            "megapixels": megapixels,
+            "input_bytes": len(content),
+            "legacy_800_jpeg_ms": round(legacy * 1000, 1),
+            "draft_800_jpeg_ms": round(draft_view * 1000, 1),
+            "all_derivatives_ms": round(all_derivatives * 1000, 1),
+            "speedup_800_jpeg": round(legacy / draft_view, 2),
+            "legacy_ms_per_megapixel": round(legacy * 1000 / megapixels, 2),
+            "draft_ms_per_megapixel": round(draft_view * 1000 / megapixels, 2)
+        })
+
+    print(f"{'MP':>5}{'legacy 800':>12}{'draft 800':>11}{'all 4':>9}{'speedup':>9}")
+    for row in results:
+        print(f"{row['megapixels']:>5g}{row['legacy_800_jpeg_ms']:>10.1f}ms{row['draft_800_jpeg_ms']:>9.1f}ms"
+              f"{row['all_derivatives_ms']:>7.1f}ms{row['speedup_800_jpeg']:>8.2f}x")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,333 @@
+"""
+Offline API server and helpers shared by the API benchmarks
+
+Usage (normally started by the benchmarks themselves):
+    python benchmarks/offline.py --port 8765 [--storage r2|local] [--workdir DIR]
+
+Runs the real app under uvicorn with SQLite and either moto's in-memory S3
+behind r2_storage ("r2", the production code path) or the local storage
+backend, so benchmarks need no network, database server or R2 credentials.
+The server is a separate process: its RSS is measured on its own, and the
+load generator doesn't compete with it for the GIL.
+"""
+import argparse
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BUCKET_NAME = "bench-photos"
+
+
+def configure_environment(workdir: str, storage: str):
+    """Point the app at throwaway SQLite/storage under workdir (explicit env vars win)"""
+    os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(workdir, 'bench.db')}")
+    os.environ.setdefault("STORAGE_BACKEND", storage)
+    os.environ.setdefault("LOCAL_STORAGE_DIR", os.path.join(workdir, "objects"))
+    os.environ.setdefault("INGEST_SPOOL_DIR", os.path.join(workdir, "spool"))
+    os.environ.setdefault("DISK_CACHE_DIR", os.path.join(workdir, "cache"))
+    os.environ.setdefault("DESCRIPTOR_MATRIX_DIR", os.path.join(workdir, "descriptors"))
+    os.environ.setdefault("MAX_PHOTOS_PER_SESSION", "10000")
+
+    # moto accepts any credentials; the endpoint only has to look like S3
+    os.environ.setdefault("R2_ACCOUNT_ID", "bench")
+    os.environ.setdefault("R2_ACCESS_KEY_ID", "bench")
+    os.environ.setdefault("R2_SECRET_ACCESS_KEY", "bench")
+    os.environ.setdefault("R2_BUCKET_NAME", BUCKET_NAME)
+    os.environ.setdefault("R2_ENDPOINT", "https://s3.amazonaws.com")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+
+def start_fake_s3():
+    """Start moto's in-memory S3 in this process and create the bucket"""
+    try:
+        import boto3
+        from moto import mock_aws
+    except ImportError:
+        sys.exit("The r2 storage benchmarks need moto: pip install -r benchmarks/requirements.txt")
+
+    mock = mock_aws()
+    mock.start()
+    boto3.client("s3", region_name=os.environ["AWS_DEFAULT_REGION"]).create_bucket(
+        Bucket=os.environ["R2_BUCKET_NAME"]
+    )
+    return mock
+
+
+def serve(port: int, storage: str, workdir: str):
+    configure_environment(workdir, storage)
+    if os.environ["STORAGE_BACKEND"] == "r2":
+        start_fake_s3()
+
+    sys.path.insert(0, BACKEND_DIR)
+    import uvicorn
+    from main import app
+
+    uvicorn.run(app, host="127.0.0.1", port=port, log_level="warning", access_log=False)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _children(pid: int):
+    children = []
+    try:
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/children") as f:
+                children.extend(int(child) for child in f.read().split())
+    except OSError:
+        pass
+    return children
+
+
+def _rss(pid: int) -> int:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def tree_rss(pid: int) -> int:
+    """Resident bytes of a process and its descendants (e.g. the thumbnail pool); 0 without /proc"""
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        total += _rss(current)
+        pending.extend(_children(current))
+    return total
+
+
+class RSSSampler:
+    """
+    Peak resident memory of a process tree while the block runs
+
+    Samples every `interval` seconds from a thread; peak_mb is the highest
+    sample and delta_mb its growth over the level when the block started.
+    """
+
+    def __init__(self, pid: int, interval: float = 0.01):
+        self.pid = pid
+        self.interval = interval
+        self.baseline = 0
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, tree_rss(self.pid))
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.baseline = self.peak = tree_rss(self.pid)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, tree_rss(self.pid))
+
+    @property
+    def peak_mb(self) -> float:
+        return round(self.peak / 2 ** 20, 1)
+
+    @property
+    def delta_mb(self) -> float:
+        return round((self.peak - self.baseline) / 2 ** 20, 1)
+
+
+class OfflineServer:
+    """
+    Start this module as an API server subprocess and wait until it answers
+
+    Usage:
+        with OfflineServer(storage="r2") as server:
+            httpx.get(server.url + "/")
+    """
+
+    def __init__(self, storage: str = "r2", env: dict = None, startup_timeout: float = 60):
+        self.storage = storage
+        self.env = env or {}
+        self.startup_timeout = startup_timeout
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.process = None
+        self._workdir = None
+
+    @property
+    def pid(self) -> int:
+        return self.process.pid
+
+    def __enter__(self):
+        import httpx
+
+        self._workdir = tempfile.TemporaryDirectory(prefix="photo-matcher-bench-")
+        self.process = subprocess.Popen(
+            [
+                sys.executable, os.path.abspath(__file__),
+                "--port", str(self.port),
+                "--storage", self.storage,
+                "--workdir", self._workdir.name
+            ],
+            env={**os.environ, **{name: str(value) for name, value in self.env.items()}},
+            stdout=subprocess.DEVNULL
+        )
+
+        deadline = time.monotonic() + self.startup_timeout
+        while True:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"Benchmark server exited with code {self.process.returncode}")
+            try:
+                httpx.get(self.url + "/", timeout=1).raise_for_status()
+                return self
+            except httpx.HTTPError:
+                if time.monotonic() > deadline:
+                    self.__exit__(None, None, None)
+                    raise RuntimeError("Benchmark server didn't start in time")
+                time.sleep(0.1)
+
+    def __exit__(self, *exc):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        if self._workdir is not None:
+            self._workdir.cleanup()
+
+
+def unique_variant(content: bytes, n: int) -> bytes:
+    """
+    The same JPEG with a numbered comment segment after SOI
+
+    Uploads are deduplicated by content hash, so every benchmark photo
+    needs different bytes; this avoids encoding a new image for each one.
+    """
+    comment = f"bench-{n}".encode()
+    return content[:2] + b"\xff\xfe" + (len(comment) + 2).to_bytes(2, "big") + comment + content[2:]
+
+
+def create_session(client, name: str, photos, timeout: float = 600) -> dict:
+    """
+    POST /api/host/create-session and wait until every photo is processed
+
+    Args:
+        client: httpx.Client bound to the server
+        photos: List of JPEG bytes
+
+    Returns:
+        The create-session response plus request_seconds and ready_seconds
+    """
+    files = [("files", (f"photo_{i:05d}.jpg", content, "image/jpeg")) for i, content in enumerate(photos)]
+
+    start = time.perf_counter()
+    response = client.post("/api/host/create-session", data={"session_name": name}, files=files, timeout=timeout)
+    response.raise_for_status()
+    request_seconds = time.perf_counter() - start
+
+    session = response.json()
+    status = wait_until_ingested(client, session["session_id"], timeout)
+    if status["failed"]:
+        raise RuntimeError(f"{status['failed']} photos failed to ingest: {status['failed_files'][:3]}")
+
+    return {**session, "request_seconds": request_seconds, "ready_seconds": time.perf_counter() - start}
+
+
+def wait_until_ingested(client, session_id: str, timeout: float = 600) -> dict:
+    deadline = time.monotonic() + timeout
+    while True:
+        status = client.get(f"/api/session/{session_id}/ingest-status").json()
+        if status["done"]:
+            return status
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"Session {session_id} still ingesting after {timeout}s: {status}")
+        time.sleep(0.05)
+
+
+def photo_ids(client, session_id: str):
+    """Every photo ID of a session, following the keyset cursor"""
+    ids = []
+    params = {"per_page": 1000}
+    while True:
+        page = client.get(f"/api/session/{session_id}/photos", params=params).json()
+        ids.extend(photo["id"] for photo in page["photos"])
+        if not page["pagination"]["has_next"]:
+            return ids
+        params["after"] = page["pagination"]["next_cursor"]
+
+
+def percentiles_ms(samples) -> dict:
+    """p50/p95/p99/max of latencies given in seconds"""
+    ordered = sorted(samples)
+    if not ordered:
+        return {"p50_ms": None, "p95_ms": None, "p99_ms": None, "max_ms": None}
+
+    def pick(pct):
+        return round(ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))] * 1000, 2)
+
+    return {"p50_ms": pick(50), "p95_ms": pick(95), "p99_ms": pick(99), "max_ms": round(ordered[-1] * 1000, 2)}
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=BACKEND_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def environment_info() -> dict:
+    """What a result file was measured on, so runs can be compared between commits"""
+    return {
+        "commit": git_commit(),
+        "measured_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count()
+    }
+
+
+def write_results(path: str, benchmark: str, params: dict, results: list):
+    """Results plus the parameters and environment they were measured with"""
+    params = {name: value for name, value in params.items() if name != "json"}
+    with open(path, "w") as f:
+        json.dump(
+            {"benchmark": benchmark, "environment": environment_info(), "params": params, "results": results},
+            f,
+            indent=2
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, required=True)
+    parser.add_argument("--storage", choices=["r2", "local"], default="r2")
+    parser.add_argument("--workdir", default=None, help="Database, spool and local objects (default: a temp dir)")
+    args = parser.parse_args()
+
+    serve(args.port, args.storage, args.workdir or tempfile.mkdtemp(prefix="photo-matcher-bench-"))
+
+
+if __name__ == "__main__":
+    main()
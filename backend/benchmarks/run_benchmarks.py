@@ -0,0 +1,156 @@
+"""
+Run the offline benchmark suite into one JSON file and compare runs
+
+Usage:
+    python benchmarks/run_benchmarks.py --json results.json [--quick] [--only ingest serving]
+                                        [--baseline previous.json] [--tolerance 0.15]
+    python benchmarks/run_benchmarks.py --compare previous.json results.json [--tolerance 0.15]
+
+Each benchmark runs in its own process (so one's memory doesn't show up in
+the next one's RSS). The combined file records the commit and machine it was
+measured on. With a baseline, every metric is compared row by row and the
+exit status is 1 when one got worse by more than the tolerance, so two
+commits can be compared on the same machine:
+
+    git checkout A && python benchmarks/run_benchmarks.py --json a.json
+    git checkout B && python benchmarks/run_benchmarks.py --json b.json --baseline a.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from offline import environment_info  # noqa: E402
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# name -> (script, full arguments, --quick arguments, fields identifying a result row)
+SUITE = {
+    "thumbnails": ("bench_thumbnails.py", [], ["--megapixels", "4", "12", "--repeat", "2"], ["megapixels"]),
+    "ingest": ("bench_ingest.py", [], ["--photos", "10", "30", "--megapixels", "4"], ["photos"]),
+    "download": ("bench_download.py", [], ["--photos", "10", "30", "--megapixels", "4"], ["photos"]),
+    "serving": (
+        "bench_serving.py",
+        [],
+        ["--photos", "20", "--megapixels", "4", "--concurrency", "1", "8", "--requests", "200", "--upload-batch", "4"],
+        ["scenario", "concurrency"]
+    ),
+    "ann": ("bench_ann.py", [], ["--faces", "5000", "--queries", "50"], ["method"])
+}
+
+# Metric name endings where a larger value is better; for everything else
+# (latencies, durations, memory) smaller is better
+HIGHER_IS_BETTER = ("per_second", "speedup_800_jpeg", "recall")
+
+# Row fields that describe the measurement rather than its outcome
+NOT_METRICS = {"megapixels", "photos", "input_bytes", "upload_mb", "zip_mb", "requests", "errors",
+               "host_photos_uploaded"}
+
+
+def run_benchmark(name: str, quick: bool) -> dict:
+    script, full_args, quick_args, _ = SUITE[name]
+    with tempfile.TemporaryDirectory() as workdir:
+        output = os.path.join(workdir, f"{name}.json")
+        command = [sys.executable, os.path.join(BENCHMARKS_DIR, script), *(quick_args if quick else full_args),
+                   "--json", output]
+        print(f"== {name}: {' '.join(command[1:-2])}", flush=True)
+        subprocess.run(command, check=True)
+        with open(output) as f:
+            report = json.load(f)
+
+    if "runs" in report:
+        # bench_ann reports the session shape next to its runs
+        runs = report.pop("runs")
+        return {"params": report, "results": runs}
+    return {"params": report.get("params", {"args": quick_args if quick else full_args}), "results": report["results"]}
+
+
+def row_key(name: str, row: dict) -> tuple:
+    return tuple(row.get(field) for field in SUITE.get(name, (None, None, None, []))[3])
+
+
+def compare(baseline: dict, current: dict, tolerance: float) -> list:
+    """
+    Metrics that got worse by more than `tolerance` (a fraction)
+
+    Returns:
+        List of (benchmark, row key, metric, baseline value, current value)
+    """
+    regressions = []
+    print(f"{'benchmark':<12}{'case':<22}{'metric':<28}{'baseline':>12}{'current':>12}{'change':>9}")
+
+    for name, report in current["benchmarks"].items():
+        previous = baseline.get("benchmarks", {}).get(name)
+        if previous is None:
+            continue
+        previous_rows = {row_key(name, row): row for row in previous["results"]}
+
+        for row in report["results"]:
+            key = row_key(name, row)
+            old_row = previous_rows.get(key)
+            if old_row is None:
+                continue
+
+            for metric, value in row.items():
+                old = old_row.get(metric)
+                if (metric in NOT_METRICS or metric in SUITE[name][3]
+                        or isinstance(value, bool) or not isinstance(value, (int, float))
+                        or not isinstance(old, (int, float)) or old == 0):
+                    continue
+
+                change = (value - old) / abs(old)
+                worse = -change if metric.endswith(HIGHER_IS_BETTER) else change
+                flag = "  worse" if worse > tolerance else ""
+                case = ",".join(str(part) for part in key)
+                print(f"{name:<12}{case:<22}{metric:<28}{old:>12g}{value:>12g}{change:>+8.0%}{flag}")
+                if worse > tolerance:
+                    regressions.append((name, key, metric, old, value))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--json", help="Write the combined results to this file")
+    parser.add_argument("--quick", action="store_true", help="Smaller inputs, for a fast smoke run")
+    parser.add_argument("--only", nargs="+", choices=list(SUITE), help="Run only these benchmarks")
+    parser.add_argument("--baseline", help="Compare the results with this earlier run")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"), help="Only compare two result files")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="Allowed slowdown before a metric counts as worse")
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            baseline = json.load(f)
+        with open(args.compare[1]) as f:
+            current = json.load(f)
+    else:
+        current = {"environment": environment_info(), "quick": args.quick, "benchmarks": {}}
+        for name in args.only or SUITE:
+            current["benchmarks"][name] = run_benchmark(name, args.quick)
+
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(current, f, indent=2)
+
+        if not args.baseline:
+            return
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    print(f"\nBaseline {baseline['environment']['commit'][:12]} vs current {current['environment']['commit'][:12]}")
+    if baseline.get("quick") != current.get("quick"):
+        print("Warning: comparing a --quick run with a full run")
+
+    regressions = compare(baseline, current, args.tolerance)
+    if regressions:
+        print(f"\n{len(regressions)} metrics worse by more than {args.tolerance:.0%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+
+from sqlalchemy import select, update, delete
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from models import Blob
+from r2_storage import derivative_name, DERIVATIVE_SPECS, DERIVATIVE_EXTENSIONS
+
+
+def new_blob_keys(content_hash: str, filename: str) -> Tuple[str, str, dict]:
+    """
+    Keys for a newly stored blob
+
+    Each upload generation gets its own blob ID in the path, so a blob being
+    deleted never shares keys with a fresh upload of the same content.
+
+    Returns:
+        (blob_id, original_key, derivative_keys)
+    """
+    blob_id = str(uuid.uuid4())
+    prefix = f"blobs/{content_hash[:2]}/{content_hash}/{blob_id}"
+    file_extension = filename.split('.')[-1].lower() if '.' in filename else 'jpg'
+
+    original_key = f"{prefix}/original.{file_extension}"
+    derivative_keys = {
+        derivative_name(size_name, image_format):
+            f"{prefix}/{size_name}.{DERIVATIVE_EXTENSIONS[image_format]}"
+        for size_name, _, image_format in DERIVATIVE_SPECS
+    }
+    return blob_id, original_key, derivative_keys
+
+
+def blob_object_keys(blob: Blob) -> List[str]:
+    return [blob.original_key, *(blob.derivative_keys or {}).values()]
+
+
+async def find_blob(db: AsyncSession, content_hash: str) -> Optional[Blob]:
+    """The stored blob with this content, if any"""
+    return (await db.execute(
+        select(Blob).where(Blob.content_hash == content_hash)
+    )).scalar_one_or_none()
+
+
+async def add_blob_reference(db: AsyncSession, blob_id: str) -> bool:
+    """
+    Count one more photo using a blob (doesn't commit)
+
+    Returns:
+        False if the blob was deleted in the meantime
+    """
+    result = await db.execute(
+        update(Blob).where(Blob.id == blob_id).values(ref_count=Blob.ref_count + 1)
+    )
+    return result.rowcount == 1
+
+
+async def register_blob(db: AsyncSession, blob: Blob) -> Blob:
+    """
+    Record a newly uploaded blob, with no references yet, and commit
+
+    The photo that uploaded it takes its reference when it is marked ready;
+    blobs nobody ever referenced are collected by collect_orphan_blobs().
+
+    Returns:
+        The registered blob, or the one another upload of the same content
+        registered first (the caller should then delete its own objects)
+    """
+    blob.ref_count = 0
+    db.add(blob)
+    try:
+        await db.commit()
+        return blob
+    except IntegrityError:
+        await db.rollback()
+        existing = await find_blob(db, blob.content_hash)
+        if existing is None:
+            raise
+        return existing
+
+
+def release_blob_references(db: Session, content_hashes: List[str]) -> List[str]:
+    """
+    Drop one blob reference per content hash of deleted ready photos (doesn't commit)
+
+    Must run in the transaction that deleted the photos, with the hashes the
+    DELETE returned: a concurrent purge of the same photos then deletes (and
+    releases) nothing, so references are never dropped twice.
+
+    Returns:
+        Storage keys of blobs that are no longer referenced; delete them
+        after committing
+    """
+    unreferenced = []
+    for content_hash, references in Counter(content_hashes).items():
+        db.execute(
+            update(Blob)
+            .where(Blob.content_hash == content_hash)
+            .values(ref_count=Blob.ref_count - references)
+        )
+        blob = db.query(Blob).filter(Blob.content_hash == content_hash, Blob.ref_count <= 0).first()
+        if blob is None:
+            continue
+        # Conditional, in case an ingest picked the blob up in between
+        deleted = db.execute(delete(Blob).where(Blob.id == blob.id, Blob.ref_count <= 0))
+        if deleted.rowcount:
+            unreferenced.extend(blob_object_keys(blob))
+
+    return unreferenced
+
+
+def collect_orphan_blobs(db: Session, min_age_seconds: int, limit: int) -> List[str]:
+    """
+    Delete blob rows that never got (or lost) all references and are older
+    than min_age_seconds, e.g. uploads whose photo was deleted mid-ingest
+    (doesn't commit)
+
+    Returns:
+        Storage keys to delete after committing
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=min_age_seconds)
+    orphans = db.query(Blob).filter(Blob.ref_count <= 0, Blob.created_at < cutoff).limit(limit).all()
+
+    keys = []
+    for blob in orphans:
+        deleted = db.execute(delete(Blob).where(Blob.id == blob.id, Blob.ref_count <= 0))
+        if deleted.rowcount:
+            keys.extend(blob_object_keys(blob))
+    return keys
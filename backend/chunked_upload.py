@@ -0,0 +1,433 @@
+import asyncio
+import hashlib
+import os
+import shutil
+import uuid
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Dict, List
+
+import aiofiles
+from sqlalchemy import insert, select, update, delete
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from database import AsyncSessionLocal, SessionLocal
+from models import Session as SessionModel, Photo, Upload, FaceDescriptor
+from ingestion import (
+    new_photo_row,
+    reserve_photo_slots,
+    released_slots,
+    spool_path,
+    enqueue_photos,
+    SPOOL_CHUNK_SIZE,
+    STATUS_UPLOADING,
+    STATUS_PENDING
+)
+from face_matching import validate_faces, face_descriptor_rows
+
+# Resumable uploads:
+#   1. init:   the client lists its files; photo slots are reserved and each
+#              file gets a photo ID and a number of parts
+#   2. parts:  each part is PUT on its own, in any order and in parallel;
+#              re-sending a part replaces it
+#   3. commit: complete files are assembled into the ingestion spool and
+#              queued like photos from create-session
+# Parts live next to the spool file until commit, so an interrupted upload
+# only resends the parts the status endpoint reports missing.
+
+# Bytes per part (clients split files at these boundaries)
+UPLOAD_PART_SIZE = int(os.getenv("UPLOAD_PART_SIZE", str(8 * 1024 * 1024)))
+
+# Largest single file accepted
+UPLOAD_MAX_FILE_SIZE = int(os.getenv("UPLOAD_MAX_FILE_SIZE", str(200 * 1024 * 1024)))
+
+# Uncommitted uploads are discarded (parts deleted, slots released) after this long
+UPLOAD_TTL_SECONDS = int(os.getenv("UPLOAD_TTL_SECONDS", str(24 * 3600)))
+
+
+class UploadNotFound(Exception):
+    """No upload (or no file in it) with that ID"""
+
+
+class UploadClosed(Exception):
+    """The upload has expired or was already committed"""
+
+
+class IncompleteUpload(Exception):
+    """Commit attempted while parts are missing"""
+
+    def __init__(self, missing: Dict[str, List[int]]):
+        super().__init__(f"{len(missing)} files are missing parts")
+        self.missing = missing
+
+
+def part_count(size: int, part_size: int) -> int:
+    return max(1, -(-size // part_size))
+
+
+def part_length(size: int, part_size: int, index: int) -> int:
+    """Expected length of part index of a file"""
+    return min(part_size, size - index * part_size)
+
+
+def parts_dir(session_id: str, photo_id: str) -> str:
+    return f"{spool_path(session_id, photo_id)}.parts"
+
+
+def received_parts(session_id: str, photo_id: str) -> List[int]:
+    try:
+        names = os.listdir(parts_dir(session_id, photo_id))
+    except FileNotFoundError:
+        return []
+    return sorted(int(name) for name in names if name.isdigit())
+
+
+def _missing_parts(photo: Photo, part_size: int) -> List[int]:
+    received = set(received_parts(photo.session_id, photo.id))
+    return [index for index in range(part_count(photo.file_size, part_size)) if index not in received]
+
+
+def _validate_files(files: List[dict]):
+    if not files:
+        raise ValueError("No files to upload")
+    for file in files:
+        filename = file.get("filename")
+        content_type = file.get("content_type") or ""
+        size = file.get("size")
+        if not isinstance(filename, str) or not filename:
+            raise ValueError("Every file needs a filename")
+        if not content_type.startswith("image/"):
+            raise ValueError(f"{filename} is not an image")
+        if not isinstance(size, int) or not 0 < size <= UPLOAD_MAX_FILE_SIZE:
+            raise ValueError(f"{filename}: size must be between 1 and {UPLOAD_MAX_FILE_SIZE} bytes")
+        if file.get("faces") is not None:
+            try:
+                validate_faces(file["faces"])
+            except ValueError as e:
+                raise ValueError(f"{filename}: {e}")
+
+
+async def create_upload(db: AsyncSession, session_id: str, files: List[dict], max_photos: int) -> dict:
+    """
+    Start a resumable upload of photos into a session
+
+    Args:
+        db: Database session (committed on success)
+        session_id: Session to add the photos to
+        files: {"filename", "content_type", "size"} per file, optionally with
+            "faces" the client detected in it (see face_matching.validate_faces)
+        max_photos: Most photos the session may hold
+
+    Returns:
+        The upload, as upload_status() describes it
+
+    Raises:
+        ValueError: The file list is invalid or the session has no room for it
+    """
+    _validate_files(files)
+
+    if not await reserve_photo_slots(db, session_id, len(files), max_photos):
+        raise ValueError(f"Maximum {max_photos} photos allowed per session")
+
+    upload = Upload(
+        id=str(uuid.uuid4()),
+        session_id=session_id,
+        part_size=UPLOAD_PART_SIZE,
+        expires_at=datetime.utcnow() + timedelta(seconds=UPLOAD_TTL_SECONDS)
+    )
+    db.add(upload)
+
+    rows = []
+    faces = []
+    for file in files:
+        detected = validate_faces(file["faces"]) if file.get("faces") is not None else None
+        row = new_photo_row(
+            session_id,
+            file["filename"],
+            file["content_type"],
+            file_size=file["size"],
+            status=STATUS_UPLOADING,
+            upload_id=upload.id,
+            faces_detected=None if detected is None else len(detected)
+        )
+        rows.append(row)
+        faces.extend(face_descriptor_rows(row["id"], detected or []))
+
+    await db.execute(insert(Photo), rows)
+    if faces:
+        # Stored now, matched once the photo is ready
+        await db.execute(insert(FaceDescriptor), faces)
+    await db.commit()
+
+    return await upload_status(upload.id)
+
+
+async def _load_upload(db: AsyncSession, upload_id: str) -> Upload:
+    upload = await db.get(Upload, upload_id)
+    if upload is None:
+        raise UploadNotFound(upload_id)
+    return upload
+
+
+async def _upload_photos(db: AsyncSession, upload_id: str) -> List[Photo]:
+    # Creation order, which is the order the client listed the files in
+    return (await db.execute(
+        select(Photo).where(Photo.upload_id == upload_id).order_by(Photo.uploaded_at, Photo.id)
+    )).scalars().all()
+
+
+async def upload_status(upload_id: str) -> dict:
+    """Files of an upload, with the parts received and still missing for each"""
+    async with AsyncSessionLocal() as db:
+        upload = await _load_upload(db, upload_id)
+        photos = await _upload_photos(db, upload_id)
+
+    files = []
+    for photo in photos:
+        entry = {
+            "photo_id": photo.id,
+            "filename": photo.original_filename,
+            "size": photo.file_size,
+            "parts": part_count(photo.file_size, upload.part_size),
+            "status": photo.status
+        }
+        if photo.status == STATUS_UPLOADING:
+            entry["missing_parts"] = _missing_parts(photo, upload.part_size)
+        files.append(entry)
+
+    return {
+        "upload_id": upload.id,
+        "session_id": upload.session_id,
+        "part_size": upload.part_size,
+        "expires_at": upload.expires_at.isoformat(),
+        "committed": upload.committed_at is not None,
+        "files": files
+    }
+
+
+async def write_part(upload_id: str, photo_id: str, index: int, chunks: AsyncIterator[bytes]) -> int:
+    """
+    Store one part of a file, streamed from the request body
+
+    The part is written to a temporary file and renamed into place only when
+    its length is right, so a dropped connection never leaves a torn part.
+
+    Returns:
+        Bytes stored
+
+    Raises:
+        UploadNotFound, UploadClosed, ValueError (wrong index or length)
+    """
+    async with AsyncSessionLocal() as db:
+        upload = await _load_upload(db, upload_id)
+        photo = await db.get(Photo, photo_id)
+        if photo is None or photo.upload_id != upload_id:
+            raise UploadNotFound(photo_id)
+        if upload.committed_at is not None or photo.status != STATUS_UPLOADING or upload.expires_at < datetime.utcnow():
+            raise UploadClosed(upload_id)
+        session_id, size, part_size = photo.session_id, photo.file_size, upload.part_size
+
+    if not 0 <= index < part_count(size, part_size):
+        raise ValueError(f"Part {index} is out of range")
+    expected = part_length(size, part_size, index)
+
+    directory = parts_dir(session_id, photo_id)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, str(index))
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+
+    received = 0
+    try:
+        async with aiofiles.open(tmp_path, 'wb') as out:
+            async for chunk in chunks:
+                received += len(chunk)
+                if received > expected:
+                    break
+                await out.write(chunk)
+        if received != expected:
+            raise ValueError(f"Part {index} must be {expected} bytes")
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    return received
+
+
+def _assemble(session_id: str, photo_id: str, count: int) -> tuple:
+    # Concatenate parts into the spool file, hashing on the way (runs on a thread)
+    directory = parts_dir(session_id, photo_id)
+    hasher = hashlib.sha256()
+    size = 0
+    with open(spool_path(session_id, photo_id), 'wb') as out:
+        for index in range(count):
+            with open(os.path.join(directory, str(index)), 'rb') as part:
+                while chunk := part.read(SPOOL_CHUNK_SIZE):
+                    out.write(chunk)
+                    hasher.update(chunk)
+                    size += len(chunk)
+    return size, hasher.hexdigest()
+
+
+def _commit_summary(upload: Upload, photos: List[Photo]) -> dict:
+    return {
+        "upload_id": upload.id,
+        "session_id": upload.session_id,
+        "photo_count": sum(1 for photo in photos if photo.status != STATUS_UPLOADING),
+        "ingest_status_url": f"/api/session/{upload.session_id}/ingest-status"
+    }
+
+
+async def commit_upload(upload_id: str, allow_partial: bool = False) -> dict:
+    """
+    Finish an upload: assemble its files and queue them for processing
+
+    Committing again after success returns the same summary, so clients can
+    retry a commit whose response was lost.
+
+    Args:
+        upload_id: Upload to commit
+        allow_partial: Drop files with missing parts (releasing their slots)
+            instead of refusing the commit
+
+    Raises:
+        UploadNotFound, UploadClosed (expired), IncompleteUpload
+    """
+    async with AsyncSessionLocal() as db:
+        upload = await _load_upload(db, upload_id)
+        photos = await _upload_photos(db, upload_id)
+        if upload.committed_at is not None:
+            return _commit_summary(upload, photos)
+        if upload.expires_at < datetime.utcnow():
+            raise UploadClosed(upload_id)
+
+        missing = {
+            photo.id: parts
+            for photo in photos
+            if photo.status == STATUS_UPLOADING and (parts := _missing_parts(photo, upload.part_size))
+        }
+        if missing and not allow_partial:
+            raise IncompleteUpload(missing)
+
+        # Claim the commit, so concurrent commits don't assemble twice
+        claimed = await db.execute(
+            update(Upload)
+            .where(Upload.id == upload_id, Upload.committed_at.is_(None))
+            .values(committed_at=datetime.utcnow())
+        )
+        await db.commit()
+        if not claimed.rowcount:
+            await db.refresh(upload)
+            return _commit_summary(upload, await _upload_photos(db, upload_id))
+
+        complete = [photo for photo in photos if photo.status == STATUS_UPLOADING and photo.id not in missing]
+        loop = asyncio.get_running_loop()
+        try:
+            for photo in complete:
+                size, content_hash = await loop.run_in_executor(
+                    None, _assemble, photo.session_id, photo.id, part_count(photo.file_size, upload.part_size)
+                )
+                photo.file_size = size
+                photo.content_hash = content_hash
+                photo.status = STATUS_PENDING
+                photo.uploaded_at = datetime.utcnow()
+
+            dropped = [photo for photo in photos if photo.id in missing]
+            await _discard_photos(db, upload.session_id, [photo.id for photo in dropped])
+            await db.commit()
+        except BaseException:
+            await db.rollback()
+            await db.execute(update(Upload).where(Upload.id == upload_id).values(committed_at=None))
+            await db.commit()
+            raise
+
+        photos = [photo for photo in photos if photo.id not in missing]
+
+    for photo in photos:
+        shutil.rmtree(parts_dir(photo.session_id, photo.id), ignore_errors=True)
+    enqueue_photos([photo.id for photo in complete])
+
+    summary = _commit_summary(upload, photos)
+    summary["dropped_files"] = [photo.original_filename for photo in dropped]
+    return summary
+
+
+def discard_photos(db: Session, session_id: str, photo_ids: List[str]):
+    """Delete photos that never finished uploading and release their slots (doesn't commit)"""
+    if not photo_ids:
+        return
+    db.execute(
+        delete(FaceDescriptor).where(FaceDescriptor.photo_id.in_(
+            select(Photo.id).where(Photo.id.in_(photo_ids), Photo.status == STATUS_UPLOADING)
+        ))
+    )
+    deleted = db.execute(
+        delete(Photo).where(Photo.id.in_(photo_ids), Photo.status == STATUS_UPLOADING)
+    )
+    db.execute(
+        update(SessionModel)
+        .where(SessionModel.id == session_id)
+        .values(reserved_photos=released_slots(deleted.rowcount))
+    )
+    for photo_id in photo_ids:
+        shutil.rmtree(parts_dir(session_id, photo_id), ignore_errors=True)
+
+
+async def _discard_photos(db: AsyncSession, session_id: str, photo_ids: List[str]):
+    await db.run_sync(discard_photos, session_id, photo_ids)
+
+
+def discard_upload(db: Session, upload_id: str) -> bool:
+    """
+    Delete an uncommitted upload with its parts, releasing its photo slots
+    (doesn't commit)
+
+    Returns:
+        False if there was no such uncommitted upload
+    """
+    upload = db.get(Upload, upload_id)
+    if upload is None or upload.committed_at is not None:
+        return False
+
+    photo_ids = [
+        photo_id for (photo_id,) in db.query(Photo.id).filter(
+            Photo.upload_id == upload_id,
+            Photo.status == STATUS_UPLOADING
+        )
+    ]
+    discard_photos(db, upload.session_id, photo_ids)
+    db.delete(upload)
+    return True
+
+
+async def abort_upload(upload_id: str):
+    """Cancel an uncommitted upload"""
+    async with AsyncSessionLocal() as db:
+        upload = await _load_upload(db, upload_id)
+        if upload.committed_at is not None:
+            raise UploadClosed(upload_id)
+        await db.run_sync(discard_upload, upload_id)
+        await db.commit()
+
+
+def expire_uploads(batch_size: int) -> int:
+    """
+    Discard up to batch_size uploads past their expiry (committed ones just
+    lose their record)
+
+    Returns:
+        Number of uploads removed
+    """
+    db = SessionLocal()
+    try:
+        expired = db.query(Upload).filter(
+            Upload.expires_at < datetime.utcnow()
+        ).order_by(Upload.expires_at).limit(batch_size).all()
+
+        for upload in expired:
+            if not discard_upload(db, upload.id):
+                db.delete(upload)
+        db.commit()
+        return len(expired)
+    finally:
+        db.close()
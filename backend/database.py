@@ -3,10 +3,14 @@ from dotenv import load_dotenv
 
 
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.orm import sessionmaker
 import os
+import time
 from models import Base
+from metrics import STAGE_SECONDS, register_stats
 
 # Load environment variables from .env file
 load_dotenv()
@@ -17,12 +21,94 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     raise ValueError("DATABASE_URL environment variable not set!")
 
-# Create engine
-engine = create_engine(DATABASE_URL, echo=True)
+# Connection pool per engine (ignored for SQLite, which doesn't pool connections)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))
+
+# Log every SQL statement (debugging only: it is slow and very noisy)
+SQL_ECHO = os.getenv("SQL_ECHO", "false").lower() == "true"
+
+# Async drivers used for each sync dialect
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "postgresql+psycopg2": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+
+def pool_options(url: str) -> dict:
+    if make_url(url).get_backend_name() == "sqlite":
+        return {}
+    return {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_pre_ping": True
+    }
+
+
+def async_database_url(url: str) -> str:
+    """Same database, through the async driver for its dialect"""
+    parsed = make_url(url)
+    drivername = ASYNC_DRIVERS.get(parsed.drivername, parsed.drivername)
+    query = dict(parsed.query)
+    if drivername == "postgresql+asyncpg" and "sslmode" in query:
+        # asyncpg spells libpq's sslmode as ssl
+        query["ssl"] = query.pop("sslmode")
+    return parsed.set(drivername=drivername, query=query).render_as_string(hide_password=False)
+
+
+# Create engine (scripts, background threads)
+engine = create_engine(DATABASE_URL, echo=SQL_ECHO, **pool_options(DATABASE_URL))
 
 # Create session factory
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Async engine for request handlers and ingestion, so queries don't block the event loop
+ASYNC_DATABASE_URL = async_database_url(DATABASE_URL)
+async_engine = create_async_engine(ASYNC_DATABASE_URL, echo=SQL_ECHO, **pool_options(ASYNC_DATABASE_URL))
+
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+
+def instrument_engine(sync_engine):
+    """Time every statement as a db_<verb> stage (db_select, db_update...)"""
+    
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def start_timer(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+    
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def stop_timer(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["query_started"].pop()
+        verb = statement.lstrip()[:6].lower()
+        if verb not in ("select", "insert", "update", "delete"):
+            verb = "other"
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage=f"db_{verb}")
+    
+    @event.listens_for(sync_engine, "handle_error")
+    def drop_timer(context):
+        # Failed statements never reach after_cursor_execute
+        if context.connection is not None and context.connection.info.get("query_started"):
+            context.connection.info["query_started"].pop()
+
+
+def pool_stats(sync_engine) -> dict:
+    pool = sync_engine.pool
+    stats = {}
+    # SQLite's pools don't keep these counts
+    for name in ("size", "checkedin", "checkedout", "overflow"):
+        if hasattr(pool, name):
+            stats[name] = getattr(pool, name)()
+    return stats
+
+
+instrument_engine(engine)
+instrument_engine(async_engine.sync_engine)
+register_stats("db_pool", "Connection pool of the sync engine", lambda: pool_stats(engine))
+register_stats("async_db_pool", "Connection pool of the async engine", lambda: pool_stats(async_engine.sync_engine))
+
 def get_db():
     """Dependency for FastAPI to get database session"""
     db = SessionLocal()
@@ -31,12 +117,41 @@ def get_db():
     finally:
         db.close()
 
+async def get_async_db():
+    """Dependency for async FastAPI handlers to get an AsyncSession"""
+    async with AsyncSessionLocal() as db:
+        yield db
+
 def init_db():
     """Initialize database - create all tables"""
     print("Creating database tables...")
     Base.metadata.create_all(bind=engine)
+    upgrade_schema()
     print("Database tables created successfully!")
 
+def upgrade_schema():
+    """Add columns and indexes that were added to the models after their tables were created"""
+    inspector = inspect(engine)
+    
+    for table in Base.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            
+            column_type = column.type.compile(dialect=engine.dialect)
+            ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"
+            if column.server_default is not None:
+                ddl += f" DEFAULT '{column.server_default.arg}'"
+            
+            with engine.begin() as conn:
+                conn.execute(text(ddl))
+            print(f"Added column {table.name}.{column.name}")
+        
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+
 def drop_db():
     """Drop all tables (use carefully!)"""
     print("Dropping all database tables...")
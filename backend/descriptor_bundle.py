@@ -0,0 +1,121 @@
+import hashlib
+import json
+import os
+import struct
+from typing import List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from object_cache import MemoryLRU
+from metrics import register_stats
+from models import Photo
+from ingestion import STATUS_READY
+from face_matching import (
+    DESCRIPTOR_SIZE, DESCRIPTOR_DTYPE, load_session_descriptors, session_file_path
+)
+
+# Bundle layout:
+#   b"PMFD" | uint32 BE header length | header JSON (space-padded to 4 bytes)
+#   | uint32 LE photo index per face | float32 LE descriptors (faces x 128)
+# The header lists "photo_ids" (what the per-face index points into) and
+# "unanalyzed_photo_ids" (ready photos nobody detected faces in at upload,
+# which the client still has to analyze itself). The padding keeps both
+# arrays 4-byte aligned, so a browser can view them without copying.
+BUNDLE_MAGIC = b"PMFD"
+BUNDLE_VERSION = 1
+DESCRIPTOR_BUNDLE_MEDIA_TYPE = "application/vnd.photo-matcher.descriptors"
+
+# Memory kept for assembled descriptor bundles (one per session being matched against)
+DESCRIPTOR_BUNDLE_CACHE_BYTES = int(os.getenv("DESCRIPTOR_BUNDLE_CACHE_BYTES", str(64 * 1024 * 1024)))
+
+_bundles = MemoryLRU(DESCRIPTOR_BUNDLE_CACHE_BYTES)
+
+register_stats(
+    "descriptor_bundle_cache",
+    "Assembled session descriptor bundles kept in memory",
+    lambda: {"items": len(_bundles), "bytes": _bundles.current_bytes, "evictions": _bundles.evictions}
+)
+
+
+def unanalyzed_photo_ids(db: Session, session_id: str) -> List[str]:
+    """Ready photos of a session whose faces weren't detected at upload"""
+    rows = db.query(Photo.id).filter(
+        Photo.session_id == session_id,
+        Photo.status == STATUS_READY,
+        Photo.faces_detected.is_(None)
+    ).order_by(Photo.uploaded_at, Photo.id).all()
+    return [row.id for row in rows]
+
+
+def build_descriptor_bundle(db: Session, session_id: str) -> bytes:
+    """
+    Pack every face descriptor of a session into one binary response
+
+    Args:
+        db: Database session
+        session_id: Session ID
+
+    Returns:
+        Bundle bytes (see the layout above)
+    """
+    descriptors = load_session_descriptors(db, session_id)
+
+    header = json.dumps(
+        {
+            "version": BUNDLE_VERSION,
+            "dimensions": DESCRIPTOR_SIZE,
+            "faces": len(descriptors),
+            "photo_ids": descriptors.photo_ids,
+            "unanalyzed_photo_ids": unanalyzed_photo_ids(db, session_id)
+        },
+        separators=(",", ":")
+    ).encode()
+    header += b" " * (-(len(BUNDLE_MAGIC) + 4 + len(header)) % 4)
+
+    return b"".join([
+        BUNDLE_MAGIC,
+        struct.pack(">I", len(header)),
+        header,
+        np.asarray(descriptors.face_photo_index, dtype='<u4').tobytes(),
+        np.ascontiguousarray(descriptors.matrix, dtype=DESCRIPTOR_DTYPE).tobytes()
+    ])
+
+
+def _matrix_version(session_id: str) -> Optional[Tuple[int, int]]:
+    try:
+        stat = os.stat(session_file_path(session_id, "matrix.npy"))
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_ino
+
+
+def get_descriptor_bundle(db: Session, session_id: str) -> Tuple[str, bytes]:
+    """
+    Cached build_descriptor_bundle
+
+    Bundles are cached per version of the session's matrix file, which is
+    rewritten whenever a photo with faces becomes ready.
+
+    Returns:
+        (etag, bundle bytes)
+    """
+    version = _matrix_version(session_id)
+    if version is None:
+        # Writes the matrix file, so the bundle can be cached under its version
+        load_session_descriptors(db, session_id)
+        version = _matrix_version(session_id)
+
+    key = f"{session_id}:{version}"
+    if version is not None:
+        bundle = _bundles.get(key)
+        etag = _bundles.get(f"{key}:etag")
+        if bundle is not None and etag is not None:
+            return etag.decode(), bundle
+
+    bundle = build_descriptor_bundle(db, session_id)
+    etag = f'"{hashlib.sha256(bundle).hexdigest()[:32]}"'
+    if version is not None:
+        _bundles.put(key, bundle)
+        _bundles.put(f"{key}:etag", etag.encode())
+    return etag, bundle
@@ -0,0 +1,483 @@
+"""
+Group a session's faces into people
+
+Usage:
+    python face_clustering.py [session_id ...]
+
+Clusters the stored descriptors of the given sessions (every unexpired
+session by default) and saves the people. The API runs the same job in the
+background when a session's people are requested or matched against.
+"""
+import numpy as np
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import or_, insert
+from sqlalchemy.orm import Session
+
+from database import SessionLocal, init_db
+from models import Session as SessionModel, FaceDescriptor, Person, PersonPhoto, generate_uuid
+from match_cache import bump_match_generation
+from face_matching import (
+    SessionDescriptors,
+    session_descriptor_rows,
+    descriptors_from_rows,
+    session_file_path,
+    face_distances,
+    rank_photos,
+    pack_descriptor,
+    DESCRIPTOR_DTYPE,
+    DEFAULT_MATCH_THRESHOLD
+)
+from metrics import register_stats, executor_stats, timed
+
+# Faces closer than this are linked into the same person. Tighter than the
+# match threshold so that chains of look-alikes don't merge two people.
+CLUSTER_LINK_THRESHOLD = float(os.getenv("CLUSTER_LINK_THRESHOLD", "0.5"))
+
+# A face needs this many faces (itself included) within the link threshold
+# to start or extend a cluster; others can only join their closest one
+CLUSTER_MIN_FACES = int(os.getenv("CLUSTER_MIN_FACES", "3"))
+
+# Clusters found in fewer photos than this aren't reported as people
+CLUSTER_MIN_PHOTOS = int(os.getenv("CLUSTER_MIN_PHOTOS", "2"))
+
+# Links kept per face (its nearest neighbours), which bounds memory to faces x this
+CLUSTER_MAX_LINKS = int(os.getenv("CLUSTER_MAX_LINKS", "16"))
+
+# Recluster once this share of a session's faces arrived after the last run
+CLUSTER_REBUILD_GROWTH = float(os.getenv("CLUSTER_REBUILD_GROWTH", "0.25"))
+
+# A clustering run that has not finished after this long is assumed dead
+CLUSTER_BUILD_LEASE_SECONDS = int(os.getenv("CLUSTER_BUILD_LEASE_SECONDS", "600"))
+
+CLUSTER_WORKERS = int(os.getenv("CLUSTER_WORKERS", "1"))
+
+# Match guests against people once a session is clustered ("false" keeps
+# searching every face, exactly or through the ANN index)
+PEOPLE_MATCHING = os.getenv("PEOPLE_MATCHING", "true").lower() == "true"
+
+# Pairwise distances computed at once; a block of rows is sized to hold about this many
+CLUSTER_BLOCK_ELEMENTS = 4 * 1024 * 1024
+
+_build_pool = ThreadPoolExecutor(max_workers=CLUSTER_WORKERS, thread_name_prefix="face-clustering")
+
+register_stats("clustering_pool", "Background face clustering runs", lambda: executor_stats(_build_pool))
+
+
+class SessionPeople(NamedTuple):
+    """
+    Clusters of a session as used for matching
+
+    labels[i] is the person (row of centroids) of matrix row i, or -1 for
+    faces that belong to nobody; faces appended after clustering have no
+    label yet.
+    """
+    person_ids: List[str]
+    centroids: np.ndarray
+    labels: np.ndarray
+    fingerprint: str
+
+
+def _connected_components(count: int, sources: np.ndarray, targets: np.ndarray) -> np.ndarray:
+    """
+    Union-find over an edge list, vectorized: hook the larger root of every
+    edge under the smaller one, then compress paths, until nothing changes
+
+    Returns:
+        Root (smallest member index) of every node's component
+    """
+    parent = np.arange(count)
+    while True:
+        a, b = parent[sources], parent[targets]
+        differ = a != b
+        if not differ.any():
+            return parent
+        np.minimum.at(parent, np.maximum(a, b)[differ], np.minimum(a, b)[differ])
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                break
+            parent = grandparent
+
+
+def cluster_faces(
+    matrix: np.ndarray,
+    face_photo_index: np.ndarray,
+    link_threshold: float = CLUSTER_LINK_THRESHOLD,
+    min_faces: int = CLUSTER_MIN_FACES,
+    min_photos: int = CLUSTER_MIN_PHOTOS,
+    max_links: int = CLUSTER_MAX_LINKS
+) -> np.ndarray:
+    """
+    DBSCAN-style clustering on a thresholded nearest-neighbour graph
+
+    Faces with at least min_faces neighbours within link_threshold are core
+    faces; linked core faces form clusters (connected components), and
+    every other face joins the cluster of its closest core neighbour, if it
+    has one. Distances are computed a block of rows at a time, so memory
+    stays at about CLUSTER_BLOCK_ELEMENTS plus faces x max_links.
+
+    Args:
+        matrix: Descriptors, shape (faces, 128)
+        face_photo_index: Photo of every face (to count photos per cluster)
+
+    Returns:
+        int array of shape (faces,): cluster of every face, numbered from 0
+        by descending photo count, or -1
+    """
+    count = matrix.shape[0]
+    labels = np.full(count, -1, dtype=np.int32)
+    if count == 0:
+        return labels
+
+    matrix = np.asarray(matrix, dtype=DESCRIPTOR_DTYPE)
+    norms = np.einsum('ij,ij->i', matrix, matrix)
+    limit = link_threshold * link_threshold
+    links = min(max_links, count - 1)
+
+    neighbours = np.full((count, max(links, 1)), -1, dtype=np.int64)
+    neighbour_distances = np.full((count, max(links, 1)), np.inf, dtype=np.float32)
+    degree = np.zeros(count, dtype=np.int64)
+
+    block_size = max(16, CLUSTER_BLOCK_ELEMENTS // count)
+    for start in range(0, count, block_size):
+        stop = min(start + block_size, count)
+        squared = norms[start:stop, None] + norms[None, :] - 2.0 * (matrix[start:stop] @ matrix.T)
+        degree[start:stop] = (squared < limit).sum(axis=1)
+
+        rows = np.arange(stop - start)
+        squared[rows, rows + start] = np.inf
+        if links == 0:
+            continue
+
+        nearest = np.argpartition(squared, links - 1, axis=1)[:, :links]
+        nearest_squared = np.take_along_axis(squared, nearest, axis=1)
+        within = nearest_squared < limit
+        neighbours[start:stop] = np.where(within, nearest, -1)
+        neighbour_distances[start:stop] = np.where(within, nearest_squared, np.inf)
+
+    core = degree >= min_faces
+    if not core.any():
+        return labels
+
+    sources = np.repeat(np.arange(count), neighbours.shape[1])
+    targets = neighbours.ravel()
+    keep = targets >= 0
+    sources, targets = sources[keep], targets[keep]
+    keep = core[sources] & core[targets]
+    roots = _connected_components(count, sources[keep], targets[keep])
+
+    # Border faces take the cluster of their closest core neighbour
+    assigned = np.where(core, roots, -1)
+    border = np.flatnonzero(~core)
+    if len(border):
+        candidate_distances = np.where(
+            core[np.maximum(neighbours[border], 0)] & (neighbours[border] >= 0),
+            neighbour_distances[border],
+            np.inf
+        )
+        best = candidate_distances.argmin(axis=1)
+        has_core = np.isfinite(candidate_distances[np.arange(len(border)), best])
+        assigned[border[has_core]] = roots[neighbours[border[has_core], best[has_core]]]
+
+    members = np.flatnonzero(assigned >= 0)
+    cluster_roots, cluster_of_member = np.unique(assigned[members], return_inverse=True)
+
+    # Distinct photos per cluster
+    pairs = np.unique(np.stack([cluster_of_member, face_photo_index[members]]), axis=1)
+    photo_counts = np.bincount(pairs[0], minlength=len(cluster_roots))
+
+    kept = np.flatnonzero(photo_counts >= min_photos)
+    order = kept[np.argsort(-photo_counts[kept], kind='stable')]
+    renumber = np.full(len(cluster_roots), -1, dtype=np.int32)
+    renumber[order] = np.arange(len(order), dtype=np.int32)
+
+    labels[members] = renumber[cluster_of_member]
+    return labels
+
+
+def claim_people_build(db: Session, session_id: str) -> bool:
+    """Mark a session as being clustered; single-flight like claim_archive_build"""
+    now = datetime.utcnow()
+    claimed = db.query(SessionModel).filter(
+        SessionModel.id == session_id,
+        or_(
+            SessionModel.people_build_started_at.is_(None),
+            SessionModel.people_build_started_at < now - timedelta(seconds=CLUSTER_BUILD_LEASE_SECONDS)
+        )
+    ).update({SessionModel.people_build_started_at: now}, synchronize_session=False)
+    db.commit()
+    return claimed == 1
+
+
+def _save_people(path: str, people: SessionPeople):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp.npz"
+    np.savez(
+        tmp_path,
+        person_ids=np.asarray(people.person_ids, dtype='U36'),
+        centroids=people.centroids,
+        labels=people.labels,
+        fingerprint=np.str_(people.fingerprint)
+    )
+    os.replace(tmp_path, path)
+
+
+def build_session_people(session_id: str) -> Optional[int]:
+    """
+    Cluster a session's faces and replace its stored people
+
+    Returns:
+        Number of people found, or None if the session no longer exists
+    """
+    db = SessionLocal()
+    try:
+        rows = session_descriptor_rows(db, session_id, FaceDescriptor.quality_score, FaceDescriptor.is_primary)
+        db.rollback()
+
+        descriptors = descriptors_from_rows(rows)
+        with timed("clustering"):
+            labels = cluster_faces(descriptors.matrix, descriptors.face_photo_index)
+
+        person_count = int(labels.max()) + 1 if len(labels) else 0
+        person_ids = [generate_uuid() for _ in range(person_count)]
+        centroids = np.empty((person_count, descriptors.matrix.shape[1]), dtype=DESCRIPTOR_DTYPE)
+        people = []
+        person_photos = []
+
+        quality = np.asarray([row.quality_score if row.quality_score is not None else 1.0 for row in rows])
+        # Primary faces (the best of their photo) win the cover photo
+        cover_score = quality + np.asarray([2.0 if row.is_primary else 0.0 for row in rows])
+
+        for person in range(person_count):
+            members = np.flatnonzero(labels == person)
+            weights = np.maximum(quality[members], 0.05)
+            centroid = np.average(descriptors.matrix[members], axis=0, weights=weights).astype(DESCRIPTOR_DTYPE)
+            centroids[person] = centroid
+
+            distances = face_distances(descriptors.matrix[members], centroid[None, :])
+            photos = descriptors.face_photo_index[members]
+            best = {}
+            for photo, distance in zip(photos.tolist(), distances.tolist()):
+                best[photo] = min(distance, best.get(photo, distance))
+
+            people.append({
+                "id": person_ids[person],
+                "session_id": session_id,
+                "centroid": pack_descriptor(centroid),
+                "radius": float(distances.max()),
+                "face_count": len(members),
+                "photo_count": len(best),
+                "cover_photo_id": descriptors.photo_ids[photos[cover_score[members].argmax()]]
+            })
+            person_photos.extend(
+                {"person_id": person_ids[person], "photo_id": descriptors.photo_ids[photo], "distance": distance}
+                for photo, distance in best.items()
+            )
+
+        clustered = SessionPeople(
+            person_ids, centroids, labels, descriptors.prefix_fingerprint(len(descriptors))
+        )
+
+        db.query(PersonPhoto).filter(
+            PersonPhoto.person_id.in_(db.query(Person.id).filter(Person.session_id == session_id))
+        ).delete(synchronize_session=False)
+        db.query(Person).filter(Person.session_id == session_id).delete(synchronize_session=False)
+        if people:
+            db.execute(insert(Person), people)
+            db.execute(insert(PersonPhoto), person_photos)
+        updated = db.query(SessionModel).filter(SessionModel.id == session_id).update({
+            SessionModel.people_face_count: len(descriptors),
+            SessionModel.people_clustered_at: datetime.utcnow(),
+            SessionModel.people_build_started_at: None
+        }, synchronize_session=False)
+
+        if not updated:
+            # Session was deleted while clustering
+            db.rollback()
+            return None
+        db.commit()
+
+        try:
+            path = session_file_path(session_id, "people.npz")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            _save_people(path, clustered)
+        except OSError as e:
+            print(f"Error saving people of session {session_id}: {e}")
+        with _people_lock:
+            _people.pop(session_id, None)
+        # Matches now go through the new people
+        bump_match_generation(session_id)
+
+        print(f"Clustered session {session_id}: {len(descriptors)} faces, {person_count} people")
+        return person_count
+    except Exception as e:
+        print(f"Error clustering session {session_id}: {e}")
+        db.rollback()
+        db.query(SessionModel).filter(SessionModel.id == session_id).update(
+            {SessionModel.people_build_started_at: None}, synchronize_session=False
+        )
+        db.commit()
+        raise
+    finally:
+        db.close()
+
+
+# Sessions this process is clustering, so requests don't each try to claim them
+_building = set()
+_building_lock = threading.Lock()
+
+
+def _build_logged(session_id: str):
+    try:
+        build_session_people(session_id)
+    except Exception:
+        pass  # Already logged; the next request retries
+    finally:
+        with _building_lock:
+            _building.discard(session_id)
+
+
+def request_people_build(db: Session, session_id: str) -> bool:
+    """
+    Start clustering a session in the background unless it is already running
+
+    Returns:
+        True if this call started a run
+    """
+    with _building_lock:
+        if session_id in _building:
+            return False
+        _building.add(session_id)
+
+    claimed = False
+    try:
+        claimed = claim_people_build(db, session_id)
+    finally:
+        if not claimed:
+            with _building_lock:
+                _building.discard(session_id)
+
+    if claimed:
+        _build_pool.submit(_build_logged, session_id)
+    return claimed
+
+
+def people_outdated(clustered_faces: Optional[int], face_count: int) -> bool:
+    """Whether enough faces arrived since clustering to warrant a new run"""
+    if clustered_faces is None:
+        return face_count > 0
+    return face_count - clustered_faces > max(clustered_faces * CLUSTER_REBUILD_GROWTH, CLUSTER_MIN_FACES - 1)
+
+
+# In-process copies of loaded clusters: session -> (file mtime, SessionPeople)
+_people = {}
+_people_lock = threading.Lock()
+
+
+def load_session_people(session_id: str, descriptors: SessionDescriptors) -> Optional[SessionPeople]:
+    """
+    A session's clusters, if they were built from the first rows of the matrix
+
+    Returns:
+        SessionPeople, or None if the session hasn't been clustered or its
+        matrix was rebuilt differently since (e.g. photos removed); either
+        way the caller should request_people_build
+    """
+    path = session_file_path(session_id, "people.npz")
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+    with _people_lock:
+        cached = _people.get(session_id)
+
+    if cached is not None and cached[0] == mtime:
+        people = cached[1]
+    else:
+        try:
+            with np.load(path) as data:
+                people = SessionPeople(
+                    data["person_ids"].tolist(),
+                    data["centroids"],
+                    data["labels"],
+                    str(data["fingerprint"])
+                )
+        except (OSError, ValueError, KeyError):
+            return None
+        with _people_lock:
+            _people[session_id] = (mtime, people)
+
+    clustered = len(people.labels)
+    if clustered > len(descriptors) or people.fingerprint != descriptors.prefix_fingerprint(clustered):
+        return None
+    return people
+
+
+def forget_session_people(session_id: str):
+    """Drop the in-process copy of a session's clusters"""
+    with _people_lock:
+        _people.pop(session_id, None)
+
+
+def match_people(
+    people: SessionPeople,
+    descriptors: SessionDescriptors,
+    queries: np.ndarray,
+    threshold: float = DEFAULT_MATCH_THRESHOLD,
+    limit: Optional[int] = None
+) -> Tuple[List[dict], List[str], int]:
+    """
+    Rank a session's photos against the queries using its clusters
+
+    Clustered faces are compared through their person's centroid (one
+    distance per person instead of per face); only faces without a person
+    (outliers and faces added since clustering) are searched exactly.
+
+    Returns:
+        (matches as {"photo_id", "distance"} sorted by ascending distance,
+        IDs of the matched people, number of vectors compared)
+    """
+    count = len(descriptors)
+    labels = np.full(count, -1, dtype=np.int32)
+    labels[:len(people.labels)] = people.labels
+
+    person_distances = face_distances(people.centroids, queries)
+    distances = np.full(count, np.inf, dtype=np.float32)
+
+    clustered = labels >= 0
+    distances[clustered] = person_distances[labels[clustered]]
+
+    unclustered = np.flatnonzero(~clustered)
+    if len(unclustered):
+        distances[unclustered] = face_distances(np.asarray(descriptors.matrix[unclustered]), queries)
+
+    matched = [people.person_ids[i] for i in np.flatnonzero(person_distances < threshold)]
+
+    return rank_photos(descriptors, distances, threshold, limit), matched, len(people.person_ids) + len(unclustered)
+
+
+if __name__ == "__main__":
+    # Adds the people tables and columns if missing
+    init_db()
+
+    db = SessionLocal()
+    try:
+        session_ids = sys.argv[1:] or [
+            session_id for (session_id,) in db.query(SessionModel.id).filter(
+                SessionModel.expires_at > datetime.utcnow()
+            )
+        ]
+    finally:
+        db.close()
+
+    for session_id in session_ids:
+        try:
+            build_session_people(session_id)
+        except Exception:
+            exit(1)
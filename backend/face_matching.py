@@ -0,0 +1,416 @@
+import hashlib
+import numpy as np
+import os
+import tempfile
+import threading
+import uuid
+from typing import List, Optional, Sequence, Tuple
+from sqlalchemy.orm import Session
+
+from models import FaceDescriptor, Photo, STATUS_READY
+
+# face-api.js produces 128-number descriptors
+DESCRIPTOR_SIZE = 128
+DESCRIPTOR_DTYPE = np.dtype('<f4')
+DESCRIPTOR_BYTES = DESCRIPTOR_SIZE * DESCRIPTOR_DTYPE.itemsize
+
+# Per-session matrix files, memory-mapped by every worker on the host
+DESCRIPTOR_MATRIX_DIR = os.getenv(
+    "DESCRIPTOR_MATRIX_DIR",
+    os.path.join(tempfile.gettempdir(), "photo-matcher", "descriptors")
+)
+
+# Euclidean distance below which two faces are considered the same person
+DEFAULT_MATCH_THRESHOLD = float(os.getenv("FACE_MATCH_THRESHOLD", "0.6"))
+
+# Most faces stored for one photo (detections beyond this are unlikely to be useful)
+MAX_FACES_PER_PHOTO = int(os.getenv("MAX_FACES_PER_PHOTO", "50"))
+
+
+class SessionDescriptors:
+    """
+    All face descriptors of a session packed into one matrix
+
+    Attributes:
+        matrix: float32 array of shape (faces, 128)
+        face_photo_index: int array mapping each matrix row to an entry of photo_ids
+        photo_ids: Unique photo IDs that have at least one face
+    """
+
+    def __init__(self, matrix: np.ndarray, face_photo_index: np.ndarray, photo_ids: List[str]):
+        self.matrix = matrix
+        self.face_photo_index = face_photo_index
+        self.photo_ids = photo_ids
+        self._fingerprints = {}
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    def prefix_fingerprint(self, count: int) -> str:
+        """prefix_fingerprint of the first `count` rows, hashed once per count"""
+        fingerprint = self._fingerprints.get(count)
+        if fingerprint is None:
+            fingerprint = self._fingerprints[count] = prefix_fingerprint(self.matrix, count)
+        return fingerprint
+
+
+def pack_descriptor(values: Sequence[float]) -> bytes:
+    """Pack a 128-number descriptor as little-endian float32 bytes"""
+    array = np.asarray(values, dtype=DESCRIPTOR_DTYPE)
+    if array.shape != (DESCRIPTOR_SIZE,):
+        raise ValueError(f"Descriptors must have {DESCRIPTOR_SIZE} values")
+    return array.tobytes()
+
+
+def unpack_descriptor(blob: bytes) -> np.ndarray:
+    """Read a packed descriptor back as a float32 array (no copy)"""
+    return np.frombuffer(blob, dtype=DESCRIPTOR_DTYPE)
+
+
+def validate_faces(faces) -> List[Tuple[bytes, Optional[float]]]:
+    """
+    Check faces a client detected in a photo
+
+    Args:
+        faces: List of {"descriptor": 128 numbers, "score": optional detection score 0-1}
+
+    Returns:
+        (packed descriptor, score) per face
+
+    Raises:
+        ValueError: If the list or any face is malformed
+    """
+    if not isinstance(faces, list):
+        raise ValueError("faces must be a list")
+    if len(faces) > MAX_FACES_PER_PHOTO:
+        raise ValueError(f"At most {MAX_FACES_PER_PHOTO} faces per photo")
+
+    validated = []
+    for face in faces:
+        if not isinstance(face, dict):
+            raise ValueError("Every face needs a descriptor")
+        try:
+            descriptor = validate_query_descriptors([face.get("descriptor")])[0]
+        except (TypeError, ValueError):
+            raise ValueError(f"Face descriptors must be {DESCRIPTOR_SIZE} finite numbers")
+
+        score = face.get("score")
+        if score is not None and (isinstance(score, bool) or not isinstance(score, (int, float)) or not 0 <= score <= 1):
+            raise ValueError("Face scores must be between 0 and 1")
+        validated.append((descriptor.tobytes(), None if score is None else float(score)))
+    return validated
+
+
+def face_descriptor_rows(photo_id: str, faces: List[Tuple[bytes, Optional[float]]]) -> List[dict]:
+    """
+    FaceDescriptor values for validated faces of a photo
+
+    The detection score becomes the quality score, and the best-scored face
+    is the photo's primary face.
+    """
+    if not faces:
+        return []
+    primary = max(range(len(faces)), key=lambda i: faces[i][1] or 0.0)
+    return [
+        {
+            "id": str(uuid.uuid4()),
+            "photo_id": photo_id,
+            "descriptor": descriptor,
+            "quality_score": score,
+            "is_primary": i == primary
+        }
+        for i, (descriptor, score) in enumerate(faces)
+    ]
+
+
+def session_file_path(session_id: str, suffix: str) -> str:
+    """Path of a per-session file in DESCRIPTOR_MATRIX_DIR"""
+    return os.path.join(DESCRIPTOR_MATRIX_DIR, f"{session_id}.{suffix}")
+
+
+def _matrix_paths(session_id: str) -> Tuple[str, str]:
+    return session_file_path(session_id, "matrix.npy"), session_file_path(session_id, "photos.npy")
+
+
+def _empty_descriptors() -> SessionDescriptors:
+    return SessionDescriptors(
+        np.empty((0, DESCRIPTOR_SIZE), dtype=DESCRIPTOR_DTYPE),
+        np.empty(0, dtype=np.int64),
+        []
+    )
+
+
+def _save_array_atomic(path: str, array: np.ndarray):
+    # Write to a temp file and rename so workers that already mapped the
+    # previous file keep a valid view
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+
+def session_descriptor_rows(db: Session, session_id: str, *columns) -> list:
+    """
+    A session's stored descriptors in matrix order
+
+    Args:
+        db: Database session
+        session_id: Session ID
+        columns: Extra FaceDescriptor columns to select with photo_id and descriptor
+
+    Returns:
+        Rows with a well-formed descriptor, in the order of the matrix rows
+    """
+    rows = db.query(FaceDescriptor.photo_id, FaceDescriptor.descriptor, *columns).join(
+        Photo, Photo.id == FaceDescriptor.photo_id
+    ).filter(
+        Photo.session_id == session_id,
+        # Faces sent with an upload count once their photo is ingested
+        Photo.status == STATUS_READY,
+        FaceDescriptor.descriptor.isnot(None)
+    ).order_by(
+        # Append-only order: photos are numbered as they become ready, so faces
+        # of new photos land at the end and an existing ANN index (or people
+        # clustering) only has to take in the new tail. Photos from before
+        # ready_seq existed come first, in upload order.
+        Photo.ready_seq.isnot(None), Photo.ready_seq, Photo.uploaded_at, Photo.id, FaceDescriptor.id
+    ).all()
+
+    return [row for row in rows if len(row.descriptor) == DESCRIPTOR_BYTES]
+
+
+def descriptors_from_rows(rows: list) -> SessionDescriptors:
+    """Pack rows from session_descriptor_rows() into a SessionDescriptors"""
+    if not rows:
+        return _empty_descriptors()
+
+    # One contiguous buffer, no per-row parsing
+    matrix = np.frombuffer(
+        b"".join(row.descriptor for row in rows), dtype=DESCRIPTOR_DTYPE
+    ).reshape(-1, DESCRIPTOR_SIZE)
+    photo_ids, face_photo_index = np.unique(
+        np.asarray([row.photo_id for row in rows]), return_inverse=True
+    )
+    return SessionDescriptors(matrix, face_photo_index, photo_ids.tolist())
+
+
+def prefix_fingerprint(matrix: np.ndarray, count: int) -> str:
+    """Hash of the first `count` rows of a matrix, to check they're the ones something was built from"""
+    prefix = np.ascontiguousarray(matrix[:count], dtype=DESCRIPTOR_DTYPE)
+    return hashlib.blake2b(prefix.data, digest_size=16).hexdigest()
+
+
+def build_session_matrix(db: Session, session_id: str) -> SessionDescriptors:
+    """
+    Build a session's descriptor matrix from the database and write it to disk
+
+    Args:
+        db: Database session
+        session_id: Session ID
+
+    Returns:
+        SessionDescriptors built from the stored rows
+    """
+    descriptors = descriptors_from_rows(session_descriptor_rows(db, session_id))
+
+    try:
+        os.makedirs(DESCRIPTOR_MATRIX_DIR, exist_ok=True)
+        matrix_path, photos_path = _matrix_paths(session_id)
+        _save_array_atomic(
+            photos_path,
+            np.asarray(descriptors.photo_ids, dtype='U')[descriptors.face_photo_index]
+            if len(descriptors) else np.empty(0, dtype='U36')
+        )
+        _save_array_atomic(matrix_path, descriptors.matrix)
+    except OSError as e:
+        print(f"Error writing descriptor matrix for session {session_id}: {e}")
+
+    return descriptors
+
+
+# In-process copies of decoded matrices: session -> (file versions, SessionDescriptors)
+_loaded = {}
+_loaded_lock = threading.Lock()
+
+
+def load_session_descriptors(db: Session, session_id: str) -> SessionDescriptors:
+    """
+    Load every stored face descriptor of a session as one matrix
+
+    The matrix is memory-mapped from the session's .npy file so all workers
+    share the same pages; it is built from the database on first use. The
+    decoded result is kept per process until the files change.
+
+    Args:
+        db: Database session
+        session_id: Session ID
+
+    Returns:
+        SessionDescriptors for the session (may be empty)
+    """
+    matrix_path, photos_path = _matrix_paths(session_id)
+
+    try:
+        version = tuple(
+            (stat.st_mtime_ns, stat.st_ino, stat.st_size)
+            for stat in (os.stat(matrix_path), os.stat(photos_path))
+        )
+    except OSError:
+        return build_session_matrix(db, session_id)
+
+    # Decoding the per-face photo IDs costs far more than a search, so it
+    # happens once per version of the files rather than on every request
+    with _loaded_lock:
+        cached = _loaded.get(session_id)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    try:
+        face_photos = np.load(photos_path, mmap_mode='r')
+        matrix = np.load(matrix_path, mmap_mode='r')
+    except (OSError, ValueError):
+        return build_session_matrix(db, session_id)
+
+    if matrix.shape[0] != face_photos.shape[0]:
+        # Caught between the two renames of a rebuild
+        return build_session_matrix(db, session_id)
+
+    if matrix.shape[0] == 0:
+        descriptors = _empty_descriptors()
+    else:
+        photo_ids, face_photo_index = np.unique(face_photos, return_inverse=True)
+        descriptors = SessionDescriptors(matrix, face_photo_index, photo_ids.tolist())
+
+    with _loaded_lock:
+        _loaded[session_id] = (version, descriptors)
+    return descriptors
+
+
+def invalidate_session_matrix(session_id: str):
+    """Remove a session's matrix files so the next load rebuilds them"""
+    with _loaded_lock:
+        _loaded.pop(session_id, None)
+    for path in _matrix_paths(session_id):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def remove_session_files(session_id: str):
+    """Remove every descriptor file of a deleted session"""
+    invalidate_session_matrix(session_id)
+    for suffix in ("ivf.npz", "people.npz"):
+        try:
+            os.remove(session_file_path(session_id, suffix))
+        except FileNotFoundError:
+            pass
+
+
+def validate_query_descriptors(descriptors: Sequence[Sequence[float]]) -> np.ndarray:
+    """
+    Convert query descriptors to a float32 matrix
+
+    Raises:
+        ValueError: If no descriptors are given or any has the wrong length
+    """
+    if not descriptors:
+        raise ValueError("At least one descriptor is required")
+
+    if any(len(d) != DESCRIPTOR_SIZE for d in descriptors):
+        raise ValueError(f"Descriptors must have {DESCRIPTOR_SIZE} values")
+
+    queries = np.asarray(descriptors, dtype=DESCRIPTOR_DTYPE)
+
+    if not np.all(np.isfinite(queries)):
+        raise ValueError("Descriptors must contain finite numbers")
+
+    return queries
+
+
+def face_distances(matrix: np.ndarray, queries: np.ndarray) -> np.ndarray:
+    """
+    Distance from each stored face to its closest query descriptor
+
+    Uses ||a - b||^2 = ||a||^2 + ||b||^2 - 2 a.b so the whole comparison is a
+    single matrix product.
+
+    Args:
+        matrix: Stored descriptors, shape (faces, 128)
+        queries: Query descriptors, shape (queries, 128)
+
+    Returns:
+        float32 array of shape (faces,)
+    """
+    if matrix.shape[0] == 0:
+        return np.empty(0, dtype=np.float32)
+
+    face_norms = np.einsum('ij,ij->i', matrix, matrix)
+    query_norms = np.einsum('ij,ij->i', queries, queries)
+
+    squared = query_norms[:, None] + face_norms[None, :] - 2.0 * (queries @ matrix.T)
+    best = squared.min(axis=0)
+    np.maximum(best, 0.0, out=best)
+
+    return np.sqrt(best)
+
+
+def rank_photos(
+    descriptors: SessionDescriptors,
+    distances: np.ndarray,
+    threshold: float = DEFAULT_MATCH_THRESHOLD,
+    limit: Optional[int] = None
+) -> List[dict]:
+    """
+    Turn per-face distances into a ranked list of matching photos
+
+    Args:
+        descriptors: Session descriptor matrix
+        distances: Distance of every face to the query, shape (faces,)
+        threshold: Maximum distance counted as a match
+        limit: Optional maximum number of photos to return
+
+    Returns:
+        List of {"photo_id", "distance"} sorted by ascending distance
+    """
+    # Best (smallest) distance per photo
+    per_photo = np.full(len(descriptors.photo_ids), np.inf, dtype=np.float32)
+    np.minimum.at(per_photo, descriptors.face_photo_index, distances)
+
+    candidates = np.flatnonzero(per_photo < threshold)
+    order = candidates[np.argsort(per_photo[candidates], kind='stable')]
+
+    if limit is not None:
+        order = order[:limit]
+
+    return [
+        {"photo_id": descriptors.photo_ids[i], "distance": round(float(per_photo[i]), 4)}
+        for i in order
+    ]
+
+
+def match_faces(
+    descriptors: SessionDescriptors,
+    queries: np.ndarray,
+    threshold: float = DEFAULT_MATCH_THRESHOLD,
+    limit: Optional[int] = None
+) -> List[dict]:
+    """
+    Rank the photos of a session by their best face distance to the queries
+    (exact search over every face)
+
+    Args:
+        descriptors: Session descriptor matrix
+        queries: Query descriptors, shape (queries, 128)
+        threshold: Maximum distance counted as a match
+        limit: Optional maximum number of photos to return
+
+    Returns:
+        List of {"photo_id", "distance"} sorted by ascending distance
+    """
+    if len(descriptors) == 0:
+        return []
+
+    distances = face_distances(descriptors.matrix, queries)
+
+    return rank_photos(descriptors, distances, threshold, limit)
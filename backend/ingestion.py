@@ -0,0 +1,551 @@
+import aiofiles
+import asyncio
+import hashlib
+import os
+import shutil
+import tempfile
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+from typing import List, Optional
+
+from fastapi import UploadFile
+
+from sqlalchemy import select, update, case, func
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from async_storage import upload_bytes, upload_file, run_storage
+from blob_store import new_blob_keys, find_blob, add_blob_reference, register_blob
+from database import AsyncSessionLocal
+from metadata_cache import invalidate_session
+from face_matching import invalidate_session_matrix
+from match_cache import bump_match_generation
+from ann_index import request_index_update
+from metrics import timed, register_stats
+from models import (
+    Session as SessionModel,
+    Photo,
+    Blob,
+    STATUS_UPLOADING,
+    STATUS_PENDING,
+    STATUS_PROCESSING,
+    STATUS_READY,
+    STATUS_FAILED
+)
+from storage import get_storage
+from r2_storage import (
+    generate_derivatives,
+    derivative_name,
+    DERIVATIVE_SPECS,
+    DERIVATIVE_EXTENSIONS,
+    DERIVATIVE_CONTENT_TYPES
+)
+
+# Concurrent R2 PUTs from ingestion, leaving the rest of the storage pool to guests
+R2_UPLOAD_CONCURRENCY = int(os.getenv("R2_UPLOAD_CONCURRENCY", "8"))
+
+# Processes used for rendering derivatives (0 = use threads, for single-CPU hosts)
+THUMBNAIL_PROCESSES = int(os.getenv("THUMBNAIL_PROCESSES", str(os.cpu_count() or 1)))
+
+# Files of one request being spooled at once
+INGEST_CONCURRENCY = int(os.getenv("INGEST_CONCURRENCY", "8"))
+
+# Background jobs processing spooled photos
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "4"))
+INGEST_MAX_ATTEMPTS = int(os.getenv("INGEST_MAX_ATTEMPTS", "3"))
+INGEST_RETRY_DELAY = float(os.getenv("INGEST_RETRY_DELAY", "1"))
+
+# Times a photo's job may be started (again after each restart that
+# interrupted it) before the photo is marked failed rather than re-queued
+INGEST_MAX_JOB_ATTEMPTS = int(os.getenv("INGEST_MAX_JOB_ATTEMPTS", "3"))
+
+# Raw uploads wait here until their job has finished
+INGEST_SPOOL_DIR = os.getenv(
+    "INGEST_SPOOL_DIR",
+    os.path.join(tempfile.gettempdir(), "photo-matcher", "spool")
+)
+
+# Bytes read from an upload at a time while spooling it. Files are hashed,
+# sized and written chunk by chunk, so a request holds at most
+# INGEST_CONCURRENCY x SPOOL_CHUNK_SIZE of upload data in memory whatever
+# its total size; originals then go to storage straight from the spool file.
+SPOOL_CHUNK_SIZE = int(os.getenv("SPOOL_CHUNK_SIZE", str(1024 * 1024)))
+
+_upload_slots: Optional[asyncio.Semaphore] = None
+_thumbnail_pool = None
+
+
+def get_thumbnail_pool():
+    """Pool that runs generate_derivatives off the event loop"""
+    global _thumbnail_pool
+    if _thumbnail_pool is None:
+        if THUMBNAIL_PROCESSES > 0:
+            _thumbnail_pool = ProcessPoolExecutor(max_workers=THUMBNAIL_PROCESSES)
+        else:
+            _thumbnail_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="thumbnail")
+    return _thumbnail_pool
+
+
+def shutdown_pools():
+    """Stop the worker pools (called on app shutdown)"""
+    global _thumbnail_pool
+    if _thumbnail_pool is not None:
+        _thumbnail_pool.shutdown(wait=True)
+        _thumbnail_pool = None
+
+
+def _upload_semaphore() -> asyncio.Semaphore:
+    global _upload_slots
+    if _upload_slots is None:
+        _upload_slots = asyncio.Semaphore(R2_UPLOAD_CONCURRENCY)
+    return _upload_slots
+
+
+async def upload_async(content: bytes, key: str, content_type: str) -> str:
+    """R2 upload limited to R2_UPLOAD_CONCURRENCY at a time"""
+    async with _upload_semaphore():
+        return await upload_bytes(content, key, content_type)
+
+
+async def upload_file_async(path: str, key: str, content_type: str) -> str:
+    """upload_async for a local file, streamed from disk (multipart on R2)"""
+    async with _upload_semaphore():
+        return await upload_file(path, key, content_type)
+
+
+async def derivatives_async(path: str) -> dict:
+    """generate_derivatives of a spooled file on the thumbnail pool"""
+    loop = asyncio.get_running_loop()
+    # Timed here: the pool may be other processes, whose metrics would be lost
+    with timed("derivatives"):
+        return await loop.run_in_executor(get_thumbnail_pool(), generate_derivatives, path)
+
+
+def _photo_keys(session_id: str, photo_id: str, filename: str):
+    file_extension = filename.split('.')[-1] if '.' in filename else 'jpg'
+    original_key = f"sessions/{session_id}/originals/{photo_id}.{file_extension}"
+    derivative_keys = {
+        derivative_name(size_name, image_format):
+            f"sessions/{session_id}/thumbnails/{photo_id}_{size_name}.{DERIVATIVE_EXTENSIONS[image_format]}"
+        for size_name, _, image_format in DERIVATIVE_SPECS
+    }
+    return original_key, derivative_keys
+
+
+def _content_type_for(name: str) -> str:
+    extension = name.rsplit('.', 1)[-1]
+    for image_format, format_extension in DERIVATIVE_EXTENSIONS.items():
+        if format_extension == extension:
+            return DERIVATIVE_CONTENT_TYPES[image_format]
+    return "application/octet-stream"
+
+
+def new_photo_row(session_id: str, filename: str, content_type: str, **values) -> dict:
+    """Values for a new photo row, with per-photo storage keys, pending by default"""
+    photo_id = str(uuid.uuid4())
+    original_key, derivative_keys = _photo_keys(session_id, photo_id, filename)
+    return {
+        "id": photo_id,
+        "session_id": session_id,
+        "original_filename": filename,
+        "r2_key_original": original_key,
+        "r2_key_thumbnail": derivative_keys["view.jpg"],
+        "derivative_keys": derivative_keys,
+        "content_type": content_type,
+        "status": STATUS_PENDING,
+        "ingest_attempts": 0,
+        **values
+    }
+
+
+# Photo slots: a session holds photo_count ready photos plus reserved_photos
+# that are still uploading or being processed
+
+async def reserve_photo_slots(db: AsyncSession, session_id: str, count: int, max_photos: int) -> bool:
+    """
+    Claim room for count more photos in a live session (doesn't commit)
+
+    The limit is checked in the UPDATE itself, so concurrent uploads can't
+    together overshoot max_photos.
+
+    Returns:
+        False if the session is full, expired or gone
+    """
+    result = await db.execute(
+        update(SessionModel)
+        .where(
+            SessionModel.id == session_id,
+            SessionModel.expires_at > datetime.utcnow(),
+            func.coalesce(SessionModel.photo_count, 0) + SessionModel.reserved_photos + count <= max_photos
+        )
+        .values(reserved_photos=SessionModel.reserved_photos + count)
+    )
+    return result.rowcount == 1
+
+
+def released_slots(count: int = 1):
+    """reserved_photos minus count, for UPDATE ... SET (never below zero)"""
+    return case(
+        (SessionModel.reserved_photos > count, SessionModel.reserved_photos - count),
+        else_=0
+    )
+
+
+def spool_path(session_id: str, photo_id: str) -> str:
+    """Local file holding a raw upload until its job has finished"""
+    return os.path.join(INGEST_SPOOL_DIR, session_id, photo_id)
+
+
+def remove_session_spool(session_id: str):
+    """Remove any raw uploads still waiting for a deleted session"""
+    shutil.rmtree(os.path.join(INGEST_SPOOL_DIR, session_id), ignore_errors=True)
+
+
+async def _spool_one(session_id: str, file: UploadFile, semaphore: asyncio.Semaphore) -> Optional[dict]:
+    if not file.content_type or not file.content_type.startswith('image/'):
+        return None
+
+    async with semaphore:
+        try:
+            row = new_photo_row(session_id, file.filename, file.content_type)
+
+            path = spool_path(session_id, row["id"])
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            # Hash while spooling so duplicates can be found without rereading
+            hasher = hashlib.sha256()
+            file_size = 0
+            async with aiofiles.open(path, 'wb') as out:
+                while chunk := await file.read(SPOOL_CHUNK_SIZE):
+                    await out.write(chunk)
+                    hasher.update(chunk)
+                    file_size += len(chunk)
+
+            row.update(file_size=file_size, content_hash=hasher.hexdigest())
+            return row
+        except Exception as e:
+            print(f"Error saving upload {file.filename}: {e}")
+            return None
+
+
+async def spool_uploads(session_id: str, files: List[UploadFile]) -> List[dict]:
+    """
+    Save raw uploads to the local spool so they can be processed later
+
+    Args:
+        session_id: Session the photos belong to
+        files: Uploaded files (non-images are skipped)
+
+    Returns:
+        Pending photo row values for every file that was saved, in upload order
+    """
+    semaphore = asyncio.Semaphore(INGEST_CONCURRENCY)
+    results = await asyncio.gather(*(_spool_one(session_id, file, semaphore) for file in files))
+    return [row for row in results if row is not None]
+
+
+# Background jobs
+
+async def _claim_photo(photo_id: str) -> Optional[dict]:
+    # Atomically move pending -> processing so only one worker takes the job
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(
+            update(Photo)
+            .where(Photo.id == photo_id, Photo.status == STATUS_PENDING)
+            .values(status=STATUS_PROCESSING, ingest_attempts=Photo.ingest_attempts + 1)
+            .execution_options(synchronize_session=False)
+        )
+        await db.commit()
+
+        if not result.rowcount:
+            return None
+
+        photo = await db.get(Photo, photo_id)
+        return {
+            "session_id": photo.session_id,
+            "filename": photo.original_filename,
+            "r2_key_original": photo.r2_key_original,
+            "derivative_keys": photo.derivative_keys or {"view.jpg": photo.r2_key_thumbnail},
+            "content_type": photo.content_type or "image/jpeg",
+            "content_hash": photo.content_hash,
+            "file_size": photo.file_size
+        }
+
+
+async def _find_blob(content_hash: str) -> Optional[Blob]:
+    async with AsyncSessionLocal() as db:
+        return await find_blob(db, content_hash)
+
+
+async def _register_blob(blob: Blob) -> Blob:
+    async with AsyncSessionLocal() as db:
+        return await register_blob(db, blob)
+
+
+async def _discard_objects(keys: List[str]):
+    # Objects uploaded for a blob that ended up unused
+    try:
+        await run_storage(get_storage().delete_many, keys)
+    except Exception as e:
+        print(f"Error deleting unused objects: {e}")
+
+
+async def _finish_photo(photo_id: str, session_id: str, error: Optional[str] = None, blob: Optional[Blob] = None) -> bool:
+    """
+    Mark a processed photo ready (taking its blob reference) or failed
+
+    Returns:
+        False if the blob disappeared before it could be referenced and the
+        photo has to be processed again
+    """
+    async with AsyncSessionLocal() as db:
+        if error is None:
+            values = {"status": STATUS_READY, "ingest_error": None}
+            if blob is not None:
+                # Reference and readiness change together, so counts match ready photos
+                if not await add_blob_reference(db, blob.id):
+                    await db.rollback()
+                    await db.execute(
+                        update(Photo).where(Photo.id == photo_id).values(status=STATUS_PENDING)
+                    )
+                    await db.commit()
+                    return False
+                values.update({
+                    "r2_key_original": blob.original_key,
+                    "r2_key_thumbnail": blob.derivative_keys["view.jpg"],
+                    "derivative_keys": blob.derivative_keys
+                })
+            
+            updated = await db.execute(
+                update(Photo)
+                .where(Photo.id == photo_id, Photo.status == STATUS_PROCESSING)
+                .values(**values)
+            )
+            if not updated.rowcount:
+                # Photo was deleted while processing; don't keep its reference
+                await db.rollback()
+                return True
+            
+            # Guests see the photo as soon as it is counted. The session row
+            # stays locked until commit, so ready_seq follows commit order and
+            # the photo's faces are appended at the end of the session matrix
+            ready_seq = (await db.execute(
+                update(SessionModel)
+                .where(SessionModel.id == session_id)
+                .values(
+                    photo_count=SessionModel.photo_count + 1,
+                    reserved_photos=released_slots(),
+                    ready_sequence=SessionModel.ready_sequence + 1
+                )
+                .returning(SessionModel.ready_sequence)
+            )).scalar_one_or_none()
+            await db.execute(update(Photo).where(Photo.id == photo_id).values(ready_seq=ready_seq))
+        else:
+            await db.execute(
+                update(Photo)
+                .where(Photo.id == photo_id)
+                .values(status=STATUS_FAILED, ingest_error=error[:1000])
+            )
+            # A failed photo gives its slot back
+            await db.execute(
+                update(SessionModel)
+                .where(SessionModel.id == session_id)
+                .values(reserved_photos=released_slots())
+            )
+        await db.commit()
+        # Cached session records carry photo_count
+        invalidate_session(session_id)
+        if error is None:
+            # Faces sent with the upload join the session's matrix
+            invalidate_session_matrix(session_id)
+            bump_match_generation(session_id)
+            # Assign them to the ANN index now rather than in a guest's match
+            request_index_update(session_id, if_indexed=True)
+        return True
+
+
+async def _with_retries(make_call, description: str):
+    delay = INGEST_RETRY_DELAY
+    for attempt in range(1, INGEST_MAX_ATTEMPTS + 1):
+        try:
+            return await make_call()
+        except Exception as e:
+            if attempt == INGEST_MAX_ATTEMPTS:
+                raise
+            print(f"{description} failed (attempt {attempt}/{INGEST_MAX_ATTEMPTS}): {e}")
+            await asyncio.sleep(delay)
+            delay *= 2
+
+
+async def process_photo(photo_id: str):
+    """
+    Upload a spooled photo and its derivatives to R2 and mark it ready
+
+    Photos whose content is already stored (same sha256) reuse that blob's
+    original and derivatives instead of rendering and uploading them again.
+    R2 PUTs are retried with exponential backoff; a photo whose upload keeps
+    failing or whose image cannot be decoded is marked failed.
+    """
+    job = await _claim_photo(photo_id)
+    if job is None:
+        return
+
+    path = spool_path(job["session_id"], photo_id)
+
+    def upload_call(source, key: str, content_type: str):
+        if source is path:
+            return lambda: upload_file_async(path, key, content_type)
+        return lambda: upload_async(source, key, content_type)
+
+    content_hash = job["content_hash"]
+    blob = None
+    uploaded = []
+
+    try:
+        if content_hash:
+            blob = await _find_blob(content_hash)
+
+        if blob is None:
+            if content_hash:
+                blob_id, original_key, derivative_keys = new_blob_keys(content_hash, job["filename"])
+            else:
+                # Spooled before content hashing existed: per-photo keys
+                original_key, derivative_keys = job["r2_key_original"], job["derivative_keys"]
+
+            # The original is never read into memory: the decoder reads the
+            # spool file itself and the upload streams it in parts
+            derivatives = await derivatives_async(path)
+
+            uploads = [(path, original_key, job["content_type"])]
+            for name, key in derivative_keys.items():
+                if name in derivatives:
+                    uploads.append((derivatives[name], key, _content_type_for(name)))
+
+            uploaded = [key for _, key, _ in uploads]
+            await asyncio.gather(*(
+                _with_retries(upload_call(*upload), f"Upload of {upload[1]}")
+                for upload in uploads
+            ))
+
+            if content_hash:
+                blob = await _register_blob(Blob(
+                    id=blob_id,
+                    content_hash=content_hash,
+                    original_key=original_key,
+                    derivative_keys=derivative_keys,
+                    content_type=job["content_type"],
+                    file_size=job["file_size"]
+                ))
+                if blob.id == blob_id:
+                    uploaded = []
+    except Exception as e:
+        print(f"Error processing photo {job['filename']}: {e}")
+        error = str(e) or type(e).__name__
+    else:
+        error = None
+
+    if uploaded and content_hash:
+        # Upload failed, or the same content was registered first by another upload
+        await _discard_objects(uploaded)
+
+    if not await _finish_photo(photo_id, job["session_id"], error, blob if error is None else None):
+        # The blob we were about to reuse was deleted; start over (the spool file is still there)
+        enqueue_photos([photo_id])
+        return
+
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+_queue: Optional[asyncio.Queue] = None
+_workers: List[asyncio.Task] = []
+
+
+async def _worker():
+    while True:
+        photo_id = await _queue.get()
+        try:
+            await process_photo(photo_id)
+        except Exception as e:
+            print(f"Ingestion worker error for photo {photo_id}: {e}")
+        finally:
+            _queue.task_done()
+
+
+def ingest_stats() -> dict:
+    return {
+        "queued": _queue.qsize() if _queue is not None else 0,
+        "workers": len(_workers)
+    }
+
+
+register_stats("ingest", "Background ingestion queue and storage uploads", ingest_stats)
+
+
+def enqueue_photos(photo_ids: List[str]):
+    """Queue photos for background processing"""
+    for photo_id in photo_ids:
+        _queue.put_nowait(photo_id)
+
+
+async def _recover_jobs() -> List[str]:
+    # Jobs interrupted by a restart go back to pending if their upload is still
+    # spooled, unless they already interrupted INGEST_MAX_JOB_ATTEMPTS runs (a
+    # photo that crashes the worker would otherwise be retried forever)
+    async with AsyncSessionLocal() as db:
+        unfinished = (await db.execute(
+            select(Photo).where(Photo.status.in_([STATUS_PENDING, STATUS_PROCESSING]))
+        )).scalars().all()
+
+        photo_ids = []
+        lost = {}
+        for photo in unfinished:
+            path = spool_path(photo.session_id, photo.id)
+            if not os.path.exists(path):
+                photo.ingest_error = "Upload lost before processing"
+            elif (photo.ingest_attempts or 0) >= INGEST_MAX_JOB_ATTEMPTS:
+                photo.ingest_error = f"Processing interrupted {photo.ingest_attempts} times"
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            else:
+                photo.status = STATUS_PENDING
+                photo_ids.append(photo.id)
+                continue
+
+            photo.status = STATUS_FAILED
+            lost[photo.session_id] = lost.get(photo.session_id, 0) + 1
+
+        # A photo given up on gives its slot back, like any other failed one
+        for session_id, count in lost.items():
+            await db.execute(
+                update(SessionModel)
+                .where(SessionModel.id == session_id)
+                .values(reserved_photos=released_slots(count))
+            )
+        await db.commit()
+        return photo_ids
+
+
+async def start_workers():
+    """Start the ingestion workers and re-queue unfinished jobs"""
+    global _queue
+    _queue = asyncio.Queue()
+    for _ in range(INGEST_WORKERS):
+        _workers.append(asyncio.create_task(_worker()))
+
+    recovered = await _recover_jobs()
+    if recovered:
+        print(f"Re-queued {len(recovered)} unfinished photos")
+        enqueue_photos(recovered)
+
+
+async def stop_workers():
+    """Cancel the ingestion workers (unfinished jobs are recovered on next start)"""
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
@@ -1,23 +1,91 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException, Depends, Form
+from fastapi import FastAPI, File, UploadFile, HTTPException, Depends, Form, Body, Header, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, Response, FileResponse, RedirectResponse
+from starlette.concurrency import run_in_threadpool
 from typing import List, Optional
+from sqlalchemy import insert, func, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
+import anyio
 from datetime import datetime, timedelta
 import os
+import re
+import mimetypes
+import time
 import uuid
-import zipfile
-import io
 
 # Import our modules
-from database import get_db, init_db
-from models import Session as SessionModel, Photo as PhotoModel
+from database import get_db, get_async_db, init_db
+from models import Session as SessionModel, Photo as PhotoModel, FaceDescriptor, Person, PersonPhoto
 from r2_storage import (
-    upload_file_to_r2, 
-    download_file_from_r2, 
-    generate_thumbnail,
-    R2_BUCKET_NAME
+    derivative_name,
+    DERIVATIVE_CONTENT_TYPES,
+    PRESIGNED_URL_REFRESH_MARGIN
 )
+from storage import get_storage, ObjectNotFound, InvalidRange
+from zip_stream import stream_zip
+from thumbnail_bundle import get_bundle, BUNDLE_MEDIA_TYPE, MAX_BUNDLE_PHOTOS
+from descriptor_bundle import get_descriptor_bundle, DESCRIPTOR_BUNDLE_MEDIA_TYPE
+from object_cache import object_cache, CACHE_ORIGINALS_ON_DISK
+from async_storage import open_stream, cached_get, cached_open_stream, shutdown_storage_pool
+from archive_cache import (
+    archive_key,
+    archive_fingerprint,
+    request_archive_build
+)
+from ingestion import (
+    spool_uploads,
+    enqueue_photos,
+    reserve_photo_slots,
+    remove_session_spool,
+    start_workers,
+    stop_workers,
+    shutdown_pools,
+    STATUS_UPLOADING,
+    STATUS_PENDING,
+    STATUS_PROCESSING,
+    STATUS_READY,
+    STATUS_FAILED
+)
+from face_matching import (
+    load_session_descriptors,
+    validate_query_descriptors,
+    DEFAULT_MATCH_THRESHOLD
+)
+from chunked_upload import (
+    create_upload,
+    upload_status,
+    write_part,
+    commit_upload,
+    abort_upload,
+    UploadNotFound,
+    UploadClosed,
+    IncompleteUpload
+)
+from ann_index import search_session
+from match_cache import match_cache_key, get_cached_match, cache_match
+from face_clustering import (
+    load_session_people,
+    match_people,
+    people_outdated,
+    request_people_build,
+    PEOPLE_MATCHING
+)
+from metrics import (
+    RequestTimingMiddleware,
+    render_metrics,
+    register_stats,
+    PROMETHEUS_CONTENT_TYPE
+)
+from metadata_cache import (
+    load_session,
+    load_session_sync,
+    load_photo,
+    invalidate_session,
+    SessionRecord,
+    PhotoRecord
+)
+from session_cleanup import schedule_session_purge, start_reaper, stop_reaper
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -37,17 +105,61 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Per-route latency histograms, exported at /metrics
+app.add_middleware(RequestTimingMiddleware)
+
 # App Settings
 MAX_PHOTOS = int(os.getenv("MAX_PHOTOS_PER_SESSION", "100"))
 STORAGE_DAYS = int(os.getenv("STORAGE_DAYS", "7"))
 FRONTEND_URL = os.getenv("FRONTEND_URL", "http://localhost:5173")
 
+# How photo bytes reach clients:
+#   "proxy"     - the API streams them from R2 (default)
+#   "redirect"  - photo endpoints 302 to short-lived presigned R2 URLs
+#   "presigned" - listings hand out presigned URLs directly (and endpoints redirect)
+#   "public"    - like "presigned" but with public bucket URLs (bucket must allow public reads)
+PHOTO_SERVING_MODE = os.getenv("PHOTO_SERVING_MODE", "proxy")
+
+# Threads for sync endpoints and StreamingResponse iterators (Starlette's default is 40)
+API_THREADPOOL_SIZE = int(os.getenv("API_THREADPOOL_SIZE", "64"))
+
 # Initialize database on startup
 @app.on_event("startup")
 async def startup_event():
+    global PHOTO_SERVING_MODE
+    anyio.to_thread.current_default_thread_limiter().total_tokens = API_THREADPOOL_SIZE
+    register_stats("api_threadpool", "Threads running sync endpoints and streaming responses", threadpool_stats)
+    
+    storage = get_storage()
+    print(f"Storage backend: {storage.name}")
+    if PHOTO_SERVING_MODE != "proxy" and not storage.supports_presign:
+        print(f"{storage.name} storage can't hand out direct URLs; PHOTO_SERVING_MODE={PHOTO_SERVING_MODE} falls back to proxy")
+        PHOTO_SERVING_MODE = "proxy"
+    
     print("Initializing database...")
     init_db()
     print("Database initialized!")
+    await start_workers()
+    start_reaper()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await stop_workers()
+    await stop_reaper()
+    shutdown_pools()
+    shutdown_storage_pool()
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """Request/stage latency histograms, cache and pool statistics (Prometheus text format)"""
+    return Response(content=render_metrics(), media_type=PROMETHEUS_CONTENT_TYPE)
+
+
+def threadpool_stats() -> dict:
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    return {"size": limiter.total_tokens, "busy": limiter.borrowed_tokens}
 
 
 @app.get("/")
@@ -62,19 +174,20 @@ def read_root():
 
 @app.post("/api/host/create-session")
 async def create_session(
-    files: List[UploadFile] = File(...),
+    files: List[UploadFile] = File([]),
     session_name: str = Form(...),
     session_mode: str = Form("browse"),
     welcome_message: Optional[str] = Form(None),
     theme_primary: Optional[str] = Form("#FF6B35"),
     theme_secondary: Optional[str] = Form("#F7931E"),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Create a new photo session
     
     Args:
-        files: Photos to upload
+        files: Photos to upload (optional; more can be added with the
+            resumable upload endpoints)
         session_name: Name of the event (e.g., "Priya & Rahul's Wedding")
         session_mode: "privacy" or "browse"
         welcome_message: Optional welcome text
@@ -89,9 +202,6 @@ async def create_session(
             detail=f"Maximum {MAX_PHOTOS} photos allowed per session"
         )
     
-    if not files:
-        raise HTTPException(status_code=400, detail="No files uploaded")
-    
     # Create session
     session_id = str(uuid.uuid4())
     expires_at = datetime.utcnow() + timedelta(days=STORAGE_DAYS)
@@ -111,68 +221,183 @@ async def create_session(
     )
     
     db.add(new_session)
-    db.commit()
+    await db.commit()
     
-    # Upload photos
-    uploaded_count = 0
+    # Save raw uploads; R2 uploads and thumbnails happen in background jobs
+    rows = await spool_uploads(session_id, files)
     
-    for file in files:
-        if not file.content_type or not file.content_type.startswith('image/'):
-            continue
-        
-        try:
-            # Read file content
-            content = await file.read()
-            
-            # Generate unique photo ID
-            photo_id = str(uuid.uuid4())
-            file_extension = file.filename.split('.')[-1] if '.' in file.filename else 'jpg'
-            
-            # R2 keys
-            original_key = f"sessions/{session_id}/originals/{photo_id}.{file_extension}"
-            thumbnail_key = f"sessions/{session_id}/thumbnails/{photo_id}.{file_extension}"
-            
-            # Upload original
-            upload_file_to_r2(content, original_key, file.content_type)
-            
-            # Generate and upload thumbnail
-            thumbnail_content = generate_thumbnail(content)
-            upload_file_to_r2(thumbnail_content, thumbnail_key, "image/jpeg")
-            
-            # Save to database
-            photo = PhotoModel(
-                id=photo_id,
-                session_id=session_id,
-                original_filename=file.filename,
-                r2_key_original=original_key,
-                r2_key_thumbnail=thumbnail_key,
-                file_size=len(content)
+    if rows:
+        if not await reserve_photo_slots(db, session_id, len(rows), MAX_PHOTOS):
+            await db.rollback()
+            remove_session_spool(session_id)
+            raise HTTPException(
+                status_code=400,
+                detail=f"Maximum {MAX_PHOTOS} photos allowed per session"
             )
-            
-            db.add(photo)
-            uploaded_count += 1
-            
-        except Exception as e:
-            print(f"Error uploading photo {file.filename}: {e}")
-            continue
-    
-    # Update session photo count
-    new_session.photo_count = uploaded_count
-    db.commit()
+        await db.execute(insert(PhotoModel), rows)
+        await db.commit()
+        enqueue_photos([row["id"] for row in rows])
     
+    # session.photo_count grows as each photo finishes processing
     return {
         "session_id": session_id,
-        "photo_count": uploaded_count,
+        "photo_count": len(rows),
         "share_url": f"{FRONTEND_URL}/session/{session_id}",
+        "ingest_status_url": f"/api/session/{session_id}/ingest-status",
         "expires_at": expires_at.isoformat()
     }
 
 
+@app.get("/api/session/{session_id}/ingest-status")
+async def get_ingest_status(session_id: str, db: AsyncSession = Depends(get_async_db)):
+    """Processing progress of the photos uploaded to a session"""
+    
+    session = await load_session(db, session_id)
+    
+    if not session:
+        raise HTTPException(status_code=404, detail="Session not found")
+    
+    counts = dict((await db.execute(
+        select(PhotoModel.status, func.count(PhotoModel.id)).where(
+            PhotoModel.session_id == session_id
+        ).group_by(PhotoModel.status)
+    )).all())
+    
+    failed = (await db.execute(
+        select(PhotoModel.original_filename, PhotoModel.ingest_error).where(
+            PhotoModel.session_id == session_id,
+            PhotoModel.status == STATUS_FAILED
+        )
+    )).all()
+    
+    pending = counts.get(STATUS_PENDING, 0) + counts.get(STATUS_PROCESSING, 0)
+    uploading = counts.get(STATUS_UPLOADING, 0)
+    
+    return {
+        "session_id": session_id,
+        "total": sum(counts.values()) - uploading,
+        "ready": counts.get(STATUS_READY, 0),
+        "pending": pending,
+        "uploading": uploading,
+        "failed": len(failed),
+        "failed_files": [
+            {"filename": filename, "error": error}
+            for filename, error in failed
+        ],
+        "done": pending == 0
+    }
+
+
 @app.get("/api/session/{session_id}")
-def get_session(session_id: str, db: Session = Depends(get_db)):
+async def get_session(session_id: str, db: AsyncSession = Depends(get_async_db)):
     """Get session details"""
     
-    session = db.query(SessionModel).filter(SessionModel.id == session_id).first()
+    session = await get_live_session(db, session_id)
+    
+    return session.to_dict()
+
+
+@app.post("/api/session/{session_id}/uploads")
+async def start_upload(
+    session_id: str,
+    files: List[dict] = Body(..., embed=True),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Start a resumable upload adding photos to a session
+    
+    Args:
+        session_id: Session ID
+        files: {"filename", "content_type", "size"} per photo, plus optional
+            "faces": [{"descriptor": 128 numbers, "score"}] the host's browser
+            detected in it (stored once the photo is ingested)
+    
+    Returns:
+        upload_id, part_size and the photo ID and part count of every file.
+        Send each part with PUT /api/uploads/{upload_id}/photos/{photo_id}/parts/{index}
+        (in any order, several at once), then POST /api/uploads/{upload_id}/commit.
+    """
+    
+    await get_live_session(db, session_id)
+    
+    try:
+        return await create_upload(db, session_id, files, MAX_PHOTOS)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def upload_http_error(error: Exception) -> HTTPException:
+    if isinstance(error, UploadNotFound):
+        return HTTPException(status_code=404, detail="Upload not found")
+    if isinstance(error, IncompleteUpload):
+        return HTTPException(
+            status_code=409,
+            detail={"message": "Some parts are missing", "missing_parts": error.missing}
+        )
+    if isinstance(error, UploadClosed):
+        return HTTPException(status_code=410, detail="Upload has expired or was already committed")
+    return HTTPException(status_code=400, detail=str(error))
+
+
+@app.get("/api/uploads/{upload_id}")
+async def get_upload(upload_id: str):
+    """Progress of a resumable upload: which parts of each file are still missing"""
+    
+    try:
+        return await upload_status(upload_id)
+    except UploadNotFound as e:
+        raise upload_http_error(e)
+
+
+@app.put("/api/uploads/{upload_id}/photos/{photo_id}/parts/{index}")
+async def put_upload_part(upload_id: str, photo_id: str, index: int, request: Request):
+    """
+    Upload one part of a file (the raw bytes are the request body)
+    
+    Parts are part_size bytes, except the last part of each file. Sending a
+    part again replaces it, so failed parts can simply be retried.
+    """
+    
+    try:
+        received = await write_part(upload_id, photo_id, index, request.stream())
+    except (UploadNotFound, UploadClosed, ValueError) as e:
+        raise upload_http_error(e)
+    
+    return {"photo_id": photo_id, "part": index, "size": received}
+
+
+@app.post("/api/uploads/{upload_id}/commit")
+async def commit_photo_upload(upload_id: str, allow_partial: bool = Body(False, embed=True)):
+    """
+    Finish a resumable upload and start processing its photos
+    
+    Args:
+        upload_id: Upload ID
+        allow_partial: Drop files that are still missing parts instead of
+            answering 409 with the missing part numbers
+    """
+    
+    try:
+        return await commit_upload(upload_id, allow_partial)
+    except (UploadNotFound, UploadClosed, IncompleteUpload) as e:
+        raise upload_http_error(e)
+
+
+@app.delete("/api/uploads/{upload_id}")
+async def cancel_upload(upload_id: str):
+    """Cancel an uncommitted upload, freeing its photo slots"""
+    
+    try:
+        await abort_upload(upload_id)
+    except (UploadNotFound, UploadClosed) as e:
+        raise upload_http_error(e)
+    
+    return {"message": "Upload cancelled"}
+
+
+async def get_live_session(db: AsyncSession, session_id: str) -> SessionRecord:
+    """Load a session (usually from the metadata cache), raising 404 if it doesn't exist and 410 if it has expired"""
+    session = await load_session(db, session_id)
     
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
@@ -181,15 +406,77 @@ def get_session(session_id: str, db: Session = Depends(get_db)):
     if session.expires_at and session.expires_at < datetime.utcnow():
         raise HTTPException(status_code=410, detail="Session has expired")
     
-    return session.to_dict()
+    return session
+
+
+async def get_live_photo(db: AsyncSession, photo_id: str) -> PhotoRecord:
+    """
+    Load a photo for serving, raising 404 if it doesn't exist and 410 if its
+    session has expired or was deleted
+    
+    Both lookups are normally answered by the metadata cache.
+    """
+    photo = await load_photo(db, photo_id)
+    
+    if not photo:
+        raise HTTPException(status_code=404, detail="Photo not found")
+    
+    await get_live_session(db, photo.session_id)
+    
+    return photo
+
+
+def encode_cursor(photo) -> str:
+    """Keyset cursor ("<uploaded_at>,<id>") for the position just after a photo"""
+    return f"{photo.uploaded_at.isoformat()},{photo.id}"
+
+
+def decode_cursor(cursor: str):
+    try:
+        uploaded_at, photo_id = cursor.rsplit(",", 1)
+        return datetime.fromisoformat(uploaded_at), photo_id
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def ready_photos_query(session_id: str, *columns):
+    """Ready photos of a session in upload order (served by ix_photos_session_uploaded_id)"""
+    return select(*(columns or (PhotoModel,))).where(
+        PhotoModel.session_id == session_id,
+        PhotoModel.status == STATUS_READY
+    ).order_by(PhotoModel.uploaded_at, PhotoModel.id)
+
+
+async def select_photo_page(db: AsyncSession, session_id: str, page: int, per_page: int, after: Optional[str]):
+    """
+    One page of ready photos, by keyset cursor when given or by page number
+    
+    Returns:
+        (photos, has_next)
+    """
+    query = ready_photos_query(session_id)
+    if after:
+        # Seek past the cursor instead of OFFSET so deep pages cost the same as the first
+        uploaded_at, photo_id = decode_cursor(after)
+        query = query.where(
+            (PhotoModel.uploaded_at > uploaded_at) |
+            ((PhotoModel.uploaded_at == uploaded_at) & (PhotoModel.id > photo_id))
+        )
+    else:
+        query = query.offset((max(page, 1) - 1) * per_page)
+    
+    # One extra row tells us whether there is a next page
+    photos = (await db.execute(query.limit(per_page + 1))).scalars().all()
+    return photos[:per_page], len(photos) > per_page
 
 
 @app.get("/api/session/{session_id}/photos")
-def get_session_photos(
+async def get_session_photos(
     session_id: str,
     page: int = 1,
     per_page: int = 10,
-    db: Session = Depends(get_db)
+    after: Optional[str] = None,
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Get photos for a session with pagination
@@ -198,88 +485,492 @@ def get_session_photos(
         session_id: Session ID
         page: Page number (starts at 1)
         per_page: Photos per page (default 10)
+        after: Keyset cursor ("<uploaded_at>,<id>") from a previous page's
+            pagination.next_cursor; when given, `page` is ignored and the
+            page starts right after that photo
     """
     
-    session = db.query(SessionModel).filter(SessionModel.id == session_id).first()
-    
-    if not session:
-        raise HTTPException(status_code=404, detail="Session not found")
-    
-    # Check if expired
-    if session.expires_at and session.expires_at < datetime.utcnow():
-        raise HTTPException(status_code=410, detail="Session has expired")
-    
-    # Get photos with pagination
-    offset = (page - 1) * per_page
-    photos = db.query(PhotoModel).filter(
-        PhotoModel.session_id == session_id
-    ).offset(offset).limit(per_page).all()
-    
-    # Get total count
-    total_photos = db.query(PhotoModel).filter(
-        PhotoModel.session_id == session_id
-    ).count()
+    session = await get_live_session(db, session_id)
+    per_page = max(1, min(per_page, 1000))
+    photos, has_next = await select_photo_page(db, session_id, page, per_page, after)
     
+    # Maintained by ingestion, so no count() over the photos table
+    total_photos = session.photo_count or 0
     total_pages = (total_photos + per_page - 1) // per_page
     
     return {
         "photos": [
             {
                 "id": photo.id,
-                "thumbnail_url": f"/api/photo/{photo.id}/thumbnail",
-                "original_url": f"/api/photo/{photo.id}/original",
+                **photo_urls(photo),
                 "filename": photo.original_filename
             }
             for photo in photos
         ],
         "pagination": {
-            "page": page,
+            "page": None if after else page,
             "per_page": per_page,
             "total_photos": total_photos,
             "total_pages": total_pages,
-            "has_next": page < total_pages,
-            "has_prev": page > 1
+            "has_next": has_next,
+            "has_prev": bool(after) or page > 1,
+            "next_cursor": encode_cursor(photos[-1]) if has_next else None
         }
     }
 
 
+@app.get("/api/session/{session_id}/manifest")
+async def get_session_manifest(session_id: str, db: AsyncSession = Depends(get_async_db)):
+    """
+    Every ready photo of a session in one response
+    
+    In proxy mode photo URLs are derived from the ID, so each entry is only
+    [id, filename] and clients expand `url_templates` themselves. In the other
+    serving modes every URL is different, so entries also carry their URLs.
+    
+    Returns:
+        {"session_id", "photo_count", "fields", "photos", "url_templates"}
+    """
+    session = await get_live_session(db, session_id)
+    
+    if PHOTO_SERVING_MODE == "proxy":
+        # Only the two columns we need; no ORM objects
+        rows = (await db.execute(
+            ready_photos_query(session_id, PhotoModel.id, PhotoModel.original_filename)
+        )).all()
+        return {
+            "session_id": session_id,
+            "photo_count": session.photo_count or 0,
+            "fields": ["id", "filename"],
+            "photos": [[photo_id, filename] for photo_id, filename in rows],
+            "url_templates": photo_urls(PhotoModel(id="{id}"))
+        }
+    
+    photos = (await db.execute(ready_photos_query(session_id))).scalars().all()
+    fields = ["id", "filename", "thumbnail_url", "grid_url", "original_url"]
+    return {
+        "session_id": session_id,
+        "photo_count": session.photo_count or 0,
+        "fields": fields,
+        "photos": [
+            [photo.id, photo.original_filename, *(photo_urls(photo)[field] for field in fields[2:])]
+            for photo in photos
+        ],
+        "url_templates": None
+    }
+
+
+def photo_urls(photo: PhotoModel) -> dict:
+    """Thumbnail/grid/original URLs for a photo according to PHOTO_SERVING_MODE"""
+    if PHOTO_SERVING_MODE in ("presigned", "public"):
+        storage = get_storage()
+        sign = (lambda key: storage.presign(key)[0]) if PHOTO_SERVING_MODE == "presigned" else storage.public_url
+        return {
+            "thumbnail_url": sign(photo.r2_key_thumbnail),
+            "grid_url": sign(thumbnail_key(photo, "grid")[0]),
+            "original_url": sign(photo.r2_key_original)
+        }
+    return {
+        "thumbnail_url": f"/api/photo/{photo.id}/thumbnail",
+        "grid_url": f"/api/photo/{photo.id}/thumbnail?size=grid",
+        "original_url": f"/api/photo/{photo.id}/original"
+    }
+
+
+def redirect_to_object(key: str) -> RedirectResponse:
+    """302 to the object in R2 instead of proxying its bytes"""
+    storage = get_storage()
+    if PHOTO_SERVING_MODE == "public":
+        return RedirectResponse(storage.public_url(key), status_code=302)
+    
+    url, expires_at = storage.presign(key)
+    # Let the browser reuse the redirect while the URL is still comfortably valid
+    max_age = max(0, int(expires_at - time.time()) - PRESIGNED_URL_REFRESH_MARGIN)
+    return RedirectResponse(
+        url,
+        status_code=302,
+        headers={"Cache-Control": f"private, max-age={max_age}"}
+    )
+
+
+@app.post("/api/session/{session_id}/match")
+def match_session_photos(
+    session_id: str,
+    descriptors: List[List[float]] = Body(..., embed=True),
+    threshold: float = Body(DEFAULT_MATCH_THRESHOLD, embed=True),
+    limit: Optional[int] = Body(None, embed=True, ge=1),
+    nprobe: Optional[int] = Body(None, embed=True, ge=1),
+    db: Session = Depends(get_db)
+):
+    """
+    Find the photos of a session that contain the given face(s)
+    
+    Args:
+        session_id: Session ID
+        descriptors: One or more 128-d face descriptors (e.g. from a selfie)
+        threshold: Maximum euclidean distance counted as a match
+        limit: Optional maximum number of photos to return
+        nprobe: Index lists searched in large sessions (higher = better recall, slower)
+    
+    Results are cached per session and (quantized) query until photos are
+    added to or removed from the session, so a repeated query is one lookup.
+    """
+    
+    session = load_session_sync(db, session_id)
+    
+    if not session:
+        raise HTTPException(status_code=404, detail="Session not found")
+    
+    # Check if expired
+    if session.expires_at and session.expires_at < datetime.utcnow():
+        raise HTTPException(status_code=410, detail="Session has expired")
+    
+    try:
+        queries = validate_query_descriptors(descriptors)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    # Retries with the same selfie (or a shared device) skip the search entirely
+    cache_key = match_cache_key(session_id, queries, threshold, limit, nprobe)
+    cached = get_cached_match(cache_key)
+    if cached is not None:
+        return cached
+    
+    session_descriptors = load_session_descriptors(db, session_id)
+    
+    people = load_session_people(session_id, session_descriptors) if PEOPLE_MATCHING else None
+    if PEOPLE_MATCHING and len(session_descriptors) and (
+        people is None or people_outdated(len(people.labels), len(session_descriptors))
+    ):
+        # Never clustered, clustered from a matrix that no longer matches (the
+        # stored people are unusable), or faces arrived since; until the new run
+        # is done the faces are searched one by one
+        request_people_build(db, session_id)
+    
+    if people is not None:
+        matches, matched_people, searched = match_people(people, session_descriptors, queries, threshold, limit)
+    else:
+        matches = search_session(session_id, session_descriptors, queries, threshold, limit, nprobe)
+        matched_people, searched = [], len(session_descriptors)
+    
+    result = {
+        "matches": matches,
+        "photo_ids": [match["photo_id"] for match in matches],
+        "people": matched_people,
+        "faces_searched": searched
+    }
+    cache_match(cache_key, result)
+    
+    return result
+
+
+@app.get("/api/session/{session_id}/descriptors.bin")
+def get_session_descriptors(
+    session_id: str,
+    if_none_match: Optional[str] = Header(None, alias="If-None-Match"),
+    db: Session = Depends(get_db)
+):
+    """
+    Every face descriptor of a session in one binary response
+    
+    The body is a float32 matrix plus a per-face photo index (see
+    descriptor_bundle.py), so a guest's browser can match a selfie against
+    the whole event locally after one download. Photos listed in the
+    header's "unanalyzed_photo_ids" had no faces detected at upload and
+    still have to be analyzed by the client.
+    """
+    
+    session = load_session_sync(db, session_id)
+    
+    if not session:
+        raise HTTPException(status_code=404, detail="Session not found")
+    
+    # Check if expired
+    if session.expires_at and session.expires_at < datetime.utcnow():
+        raise HTTPException(status_code=410, detail="Session has expired")
+    
+    etag, bundle = get_descriptor_bundle(db, session_id)
+    
+    # Faces are added while photos are still being ingested, so revalidate
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=60, must-revalidate"}
+    if if_none_match == etag:
+        return Response(status_code=304, headers=headers)
+    
+    return Response(content=bundle, media_type=DESCRIPTOR_BUNDLE_MEDIA_TYPE, headers=headers)
+
+
+@app.get("/api/session/{session_id}/people")
+async def get_session_people(session_id: str, db: AsyncSession = Depends(get_async_db)):
+    """
+    People appearing in a session, found by clustering its faces
+    
+    Clustering runs in the background: the first call (or one after many
+    new faces arrived) starts it and returns the people found so far, with
+    status "clustering".
+    """
+    
+    await get_live_session(db, session_id)
+    
+    state = (await db.execute(
+        select(
+            SessionModel.people_face_count,
+            SessionModel.people_clustered_at,
+            SessionModel.people_build_started_at
+        ).where(SessionModel.id == session_id)
+    )).first()
+    
+    if not state:
+        raise HTTPException(status_code=404, detail="Session not found")
+    
+    clustered_faces, clustered_at, started_at = state
+    
+    face_count = await db.scalar(
+        select(func.count(FaceDescriptor.id)).join(
+            PhotoModel, PhotoModel.id == FaceDescriptor.photo_id
+        ).where(
+            PhotoModel.session_id == session_id,
+            PhotoModel.status == STATUS_READY,
+            FaceDescriptor.descriptor.isnot(None)
+        )
+    )
+    
+    clustering = started_at is not None
+    if not clustering and people_outdated(clustered_faces, face_count):
+        clustering = await db.run_sync(request_people_build, session_id)
+    
+    people = (await db.execute(
+        select(Person).where(Person.session_id == session_id).order_by(Person.photo_count.desc(), Person.id)
+    )).scalars().all()
+    
+    members = {}
+    for person_id, photo_id in (await db.execute(
+        select(PersonPhoto.person_id, PersonPhoto.photo_id).join(
+            Person, Person.id == PersonPhoto.person_id
+        ).where(Person.session_id == session_id).order_by(PersonPhoto.distance)
+    )).all():
+        members.setdefault(person_id, []).append(photo_id)
+    
+    return {
+        "session_id": session_id,
+        "status": "clustering" if clustering else "ready",
+        "clustered_faces": clustered_faces or 0,
+        "clustered_at": clustered_at.isoformat() if clustered_at else None,
+        "people": [
+            {
+                "id": person.id,
+                "face_count": person.face_count,
+                "photo_count": person.photo_count,
+                "cover_photo_id": person.cover_photo_id,
+                "cover_url": f"/api/photo/{person.cover_photo_id}/thumbnail?size=grid" if person.cover_photo_id else None,
+                "photo_ids": members.get(person.id, [])
+            }
+            for person in people
+        ]
+    }
+
+
+@app.get("/api/session/{session_id}/thumbnails")
+async def get_thumbnail_bundle(
+    session_id: str,
+    page: int = 1,
+    per_page: int = 10,
+    after: Optional[str] = None,
+    size: str = "grid",
+    format: str = "jpeg",
+    if_none_match: Optional[str] = Header(None, alias="If-None-Match"),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Thumbnails of one page of photos in a single response
+    
+    Pages are selected exactly like /photos. The body is a length-prefixed
+    bundle (see thumbnail_bundle.py) whose header maps photo IDs to byte
+    ranges, so a gallery page is one request instead of one per image.
+    
+    Args:
+        session_id: Session ID
+        page: Page number (starts at 1)
+        per_page: Photos per page (at most MAX_BUNDLE_PHOTOS)
+        after: Keyset cursor from /photos or a previous bundle
+        size: "view" (800px) or "grid" (200px tile)
+        format: "jpeg" or "webp"
+    """
+    
+    await get_live_session(db, session_id)
+    per_page = max(1, min(per_page, MAX_BUNDLE_PHOTOS))
+    photos, has_next = await select_photo_page(db, session_id, page, per_page, after)
+    
+    entries = [(photo.id, *thumbnail_key(photo, size, format)) for photo in photos]
+    extra = {"next_cursor": encode_cursor(photos[-1]) if has_next else None}
+    
+    try:
+        etag, bundle = await run_in_threadpool(get_bundle, entries, extra)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error building thumbnail bundle: {str(e)}")
+    
+    if etag is None:
+        # Some thumbnails are missing; serve what we have but don't let it be cached
+        return Response(content=bundle, media_type=BUNDLE_MEDIA_TYPE, headers={"Cache-Control": "no-store"})
+    
+    # The page's contents change while photos are still being ingested, so revalidate
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=60, must-revalidate"}
+    if if_none_match == etag:
+        return Response(status_code=304, headers=headers)
+    
+    return Response(content=bundle, media_type=BUNDLE_MEDIA_TYPE, headers=headers)
+
+
 @app.get("/api/photo/{photo_id}/thumbnail")
-def get_photo_thumbnail(photo_id: str, db: Session = Depends(get_db)):
-    """Get photo thumbnail"""
+async def get_photo_thumbnail(
+    photo_id: str,
+    size: str = "view",
+    format: str = "jpeg",
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Get photo thumbnail
     
-    photo = db.query(PhotoModel).filter(PhotoModel.id == photo_id).first()
+    Args:
+        photo_id: Photo ID
+        size: "view" (800px) or "grid" (200px tile)
+        format: "jpeg" or "webp"
+    """
     
-    if not photo:
-        raise HTTPException(status_code=404, detail="Photo not found")
+    photo = await get_live_photo(db, photo_id)
+    
+    key, media_type = thumbnail_key(photo, size, format)
+    
+    if PHOTO_SERVING_MODE != "proxy":
+        return redirect_to_object(key)
+    
+    # Thumbnails never change once written, so they are cached aggressively
+    headers = {"Cache-Control": "public, max-age=31536000, immutable"}
+    
+    # Local storage: sendfile straight from disk, no cache copy needed
+    path = get_storage().local_path(key)
+    if path:
+        return FileResponse(path, media_type=media_type, headers=headers)
     
     try:
-        image_data = download_file_from_r2(photo.r2_key_thumbnail)
-        return StreamingResponse(io.BytesIO(image_data), media_type="image/jpeg")
+        image_data = await cached_get(key)
+        return Response(
+            content=image_data,
+            media_type=media_type,
+            headers=headers
+        )
+    except ObjectNotFound:
+        raise HTTPException(status_code=404, detail="Photo not found")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching photo: {str(e)}")
 
 
+def thumbnail_key(photo, size: str = "view", format: str = "jpeg"):
+    """
+    R2 key and content type of a photo's derivative
+    
+    Photos ingested before derivatives existed only have the 800px JPEG.
+    """
+    image_format = "WEBP" if format.lower() == "webp" else "JPEG"
+    name = derivative_name("grid" if size == "grid" else "view", image_format)
+    
+    key = (photo.derivative_keys or {}).get(name)
+    if key:
+        return key, DERIVATIVE_CONTENT_TYPES[image_format]
+    return photo.r2_key_thumbnail, "image/jpeg"
+
+
 @app.get("/api/photo/{photo_id}/original")
-def get_photo_original(photo_id: str, db: Session = Depends(get_db)):
-    """Get original photo"""
+async def get_photo_original(
+    photo_id: str,
+    range_header: Optional[str] = Header(None, alias="Range"),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Get original photo
     
-    photo = db.query(PhotoModel).filter(PhotoModel.id == photo_id).first()
+    Streams the object from R2 chunk by chunk. A single-range `Range` header
+    is passed through to R2 and answered with 206 Partial Content.
+    """
     
-    if not photo:
-        raise HTTPException(status_code=404, detail="Photo not found")
+    photo = await get_live_photo(db, photo_id)
+    
+    if PHOTO_SERVING_MODE != "proxy":
+        return redirect_to_object(photo.r2_key_original)
+    
+    media_type = photo.content_type or mimetypes.guess_type(photo.original_filename)[0] or "image/jpeg"
+    byte_range = parse_range_header(range_header)
     
     try:
-        image_data = download_file_from_r2(photo.r2_key_original)
-        return StreamingResponse(io.BytesIO(image_data), media_type="image/jpeg")
+        if byte_range is None:
+            # Whole file from local storage goes out via sendfile
+            path = get_storage().local_path(photo.r2_key_original)
+            if path:
+                return FileResponse(path, media_type=media_type, headers={"Accept-Ranges": "bytes"})
+        
+        if byte_range is None and CACHE_ORIGINALS_ON_DISK:
+            # Streamed from an already open file: the disk cache may evict it meanwhile
+            chunks, info = await cached_open_stream(photo.r2_key_original)
+        else:
+            chunks, info = await open_stream(photo.r2_key_original, byte_range)
+    except InvalidRange:
+        raise HTTPException(
+            status_code=416,
+            detail="Requested range not satisfiable",
+            headers={"Content-Range": f"bytes */{photo.file_size or '*'}"}
+        )
+    except ObjectNotFound:
+        raise HTTPException(status_code=404, detail="Photo not found")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching photo: {str(e)}")
+    
+    headers = {
+        "Accept-Ranges": "bytes",
+        "Content-Length": str(info["content_length"])
+    }
+    if info["etag"]:
+        headers["ETag"] = info["etag"]
+    
+    status_code = 200
+    if byte_range and info["content_range"]:
+        status_code = 206
+        headers["Content-Range"] = info["content_range"]
+    
+    return StreamingResponse(
+        chunks,
+        status_code=status_code,
+        media_type=media_type,
+        headers=headers
+    )
+
+
+def parse_range_header(range_header: Optional[str]) -> Optional[str]:
+    """
+    Validate a Range header for pass-through to R2
+    
+    Only a single `bytes=` range is supported; anything else is ignored and
+    the full object is returned, as HTTP allows.
+    """
+    if not range_header:
+        return None
+    
+    match = re.fullmatch(r"\s*bytes=(\d*)-(\d*)\s*", range_header)
+    if not match:
+        return None
+    
+    start, end = match.groups()
+    if not start and not end:
+        return None
+    if start and end and int(end) < int(start):
+        return None
+    
+    return f"bytes={start}-{end}"
 
 
 @app.post("/api/session/{session_id}/download")
 async def download_photos(
     session_id: str,
     photo_ids: List[str],
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Download selected photos as ZIP
@@ -289,50 +980,55 @@ async def download_photos(
         photo_ids: List of photo IDs to include (empty list = all photos)
     """
     
-    session = db.query(SessionModel).filter(SessionModel.id == session_id).first()
+    # Deleted sessions are expired right away and purged in the background
+    await get_live_session(db, session_id)
+    
+    # Name and archive state aren't part of the cached record
+    session = await db.get(SessionModel, session_id)
     
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
     
     # Get photos
+    query = ready_photos_query(session_id)
     if photo_ids:
         # Download specific photos
-        photos = db.query(PhotoModel).filter(
-            PhotoModel.session_id == session_id,
-            PhotoModel.id.in_(photo_ids)
-        ).all()
-    else:
-        # Download all photos
-        photos = db.query(PhotoModel).filter(
-            PhotoModel.session_id == session_id
-        ).all()
+        query = query.where(PhotoModel.id.in_(photo_ids))
+    
+    photos = (await db.execute(query)).scalars().all()
     
     if not photos:
         raise HTTPException(status_code=404, detail="No photos found")
     
-    # Create ZIP in memory
-    zip_buffer = io.BytesIO()
+    filename = f"{session.name.replace(' ', '_')}_{session_id[:8]}.zip"
+    headers = {"Content-Disposition": f"attachment; filename={filename}"}
     
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-        for photo in photos:
+    if not photo_ids:
+        # Serve the cached full-session archive if it matches the current photos
+        if session.archive_fingerprint == archive_fingerprint(photos):
             try:
-                # Download original from R2
-                image_data = download_file_from_r2(photo.r2_key_original)
-                
-                # Add to ZIP with original filename
-                zip_file.writestr(photo.original_filename, image_data)
+                chunks, info = await open_stream(archive_key(session_id))
+                return StreamingResponse(
+                    chunks,
+                    media_type="application/zip",
+                    headers={**headers, "Content-Length": str(info["content_length"])}
+                )
             except Exception as e:
-                print(f"Error adding photo {photo.id} to ZIP: {e}")
-                continue
+                print(f"Cached archive for session {session_id} unavailable: {e}")
+        
+        # Build it once in the background; this request streams live
+        await db.run_sync(request_archive_build, session_id)
     
-    zip_buffer.seek(0)
-    
-    filename = f"{session.name.replace(' ', '_')}_{session_id[:8]}.zip"
+    # Stream the ZIP as it is built; originals are prefetched from R2
+    entries = [
+        (photo.r2_key_original, photo.original_filename, photo.uploaded_at)
+        for photo in photos
+    ]
     
     return StreamingResponse(
-        zip_buffer,
+        stream_zip(entries),
         media_type="application/zip",
-        headers={"Content-Disposition": f"attachment; filename={filename}"}
+        headers=headers
     )
 
 
@@ -371,6 +1067,7 @@ def update_session_settings(
         session.theme_colors = theme_colors
     
     db.commit()
+    invalidate_session(session_id)
     
     return session.to_dict()
 
@@ -384,20 +1081,13 @@ def delete_session(session_id: str, db: Session = Depends(get_db)):
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
     
-    # Delete photos from R2
-    photos = db.query(PhotoModel).filter(PhotoModel.session_id == session_id).all()
-    
-    for photo in photos:
-        try:
-            from r2_storage import delete_file_from_r2
-            delete_file_from_r2(photo.r2_key_original)
-            delete_file_from_r2(photo.r2_key_thumbnail)
-        except Exception as e:
-            print(f"Error deleting photo from R2: {e}")
-    
-    # Delete from database (cascade will delete photos)
-    db.delete(session)
+    # Hide the session right away; objects and rows are purged in the
+    # background (and by the expiry reaper if that purge fails)
+    session.expires_at = datetime.utcnow()
     db.commit()
+    invalidate_session(session_id, include_photos=True)
+    
+    schedule_session_purge(session_id)
     
     return {"message": "Session deleted successfully"}
 
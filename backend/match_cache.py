@@ -0,0 +1,79 @@
+import hashlib
+import os
+import threading
+from typing import Optional
+
+import numpy as np
+
+from metadata_cache import TTLCache
+from metrics import register_stats
+
+# Match results kept in memory (entries; one per session and query)
+MATCH_CACHE_SIZE = int(os.getenv("MATCH_CACHE_SIZE", "5000"))
+
+# How long a cached result is trusted. New photos seen by this process
+# invalidate it right away; this bounds staleness across worker processes.
+MATCH_CACHE_TTL_SECONDS = float(os.getenv("MATCH_CACHE_TTL_SECONDS", "300"))
+
+# Descriptor values are rounded to this step before hashing, so the same
+# selfie detected again (tiny float differences) hits the same entry
+MATCH_CACHE_QUANTUM = float(os.getenv("MATCH_CACHE_QUANTUM", "0.005"))
+
+match_cache = TTLCache(MATCH_CACHE_SIZE, MATCH_CACHE_TTL_SECONDS)
+
+# Per-session generation, bumped whenever the session's photos (or the
+# people they're matched through) change; part of every cache key
+_generations = {}
+_generations_lock = threading.Lock()
+
+register_stats("match_cache", "Match results cached by session and query", match_cache.stats)
+
+
+def match_cache_key(session_id: str, queries: np.ndarray, threshold: float,
+                    limit: Optional[int] = None, nprobe: Optional[int] = None) -> tuple:
+    """
+    Cache key of a match request
+
+    Args:
+        session_id: Session ID
+        queries: Validated query descriptors, shape (n, 128)
+        threshold: Maximum matching distance
+        limit, nprobe: The request's other parameters, which change the result
+
+    Returns:
+        (session_id, generation, query hash, threshold, limit, nprobe)
+    """
+    quantized = np.round(np.asarray(queries, dtype=np.float64) / MATCH_CACHE_QUANTUM).astype('<i4')
+    digest = hashlib.blake2b(quantized.tobytes(), digest_size=16).hexdigest()
+    with _generations_lock:
+        generation = _generations.get(session_id, 0)
+    return session_id, generation, digest, round(float(threshold), 4), limit, nprobe
+
+
+def get_cached_match(key: tuple) -> Optional[dict]:
+    """Cached match response for a key from match_cache_key(), or None"""
+    return match_cache.get(key)
+
+
+def cache_match(key: tuple, result: dict):
+    """Remember a match response (callers must not modify it afterwards)"""
+    # Computed against an older generation if photos arrived meanwhile; never served
+    with _generations_lock:
+        if _generations.get(key[0], 0) != key[1]:
+            return
+    match_cache.put(key, result)
+
+
+def bump_match_generation(session_id: str):
+    """Invalidate a session's cached matches (photos were added or removed)"""
+    with _generations_lock:
+        _generations[session_id] = _generations.get(session_id, 0) + 1
+    # Old-generation entries can't be hit anymore; free them now rather than by LRU
+    match_cache.discard_where(lambda key, value: key[0] == session_id)
+
+
+def forget_session_matches(session_id: str):
+    """Drop a deleted session's cached matches and generation"""
+    match_cache.discard_where(lambda key, value: key[0] == session_id)
+    with _generations_lock:
+        _generations.pop(session_id, None)
@@ -0,0 +1,189 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, NamedTuple, Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from models import Session as SessionModel, Photo, STATUS_READY
+from metrics import register_stats
+
+# Session and photo records kept in memory (entries, shared by both kinds)
+METADATA_CACHE_SIZE = int(os.getenv("METADATA_CACHE_SIZE", "20000"))
+
+# How long a cached record is trusted. Changes made through this process
+# invalidate it right away; this bounds staleness across worker processes.
+METADATA_CACHE_TTL_SECONDS = float(os.getenv("METADATA_CACHE_TTL_SECONDS", "30"))
+
+
+class SessionRecord(NamedTuple):
+    """Detached snapshot of a session row"""
+    id: str
+    expires_at: Optional[datetime]
+    photo_count: int
+    details: dict  # Session.to_dict()
+
+    def to_dict(self) -> dict:
+        return dict(self.details)
+
+
+class PhotoRecord(NamedTuple):
+    """Detached snapshot of the photo columns needed to serve its bytes"""
+    id: str
+    session_id: str
+    original_filename: str
+    r2_key_original: str
+    r2_key_thumbnail: str
+    derivative_keys: Optional[dict]
+    content_type: Optional[str]
+    file_size: Optional[int]
+    status: str
+
+
+class TTLCache:
+    """Thread-safe LRU bounded by entry count whose entries also expire"""
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key) -> Optional[Any]:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or item[1] < time.monotonic():
+                if item is not None:
+                    del self._items[key]
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, value):
+        if self.max_entries <= 0 or self.ttl_seconds <= 0:
+            return
+
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (value, time.monotonic() + self.ttl_seconds)
+
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def discard(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def discard_where(self, predicate) -> int:
+        """Drop every entry whose (key, value) matches; returns how many"""
+        with self._lock:
+            stale = [key for key, (value, _) in self._items.items() if predicate(key, value)]
+            for key in stale:
+                del self._items[key]
+            return len(stale)
+
+    def __len__(self):
+        return len(self._items)
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {
+            "entries": len(self._items),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / requests, 4) if requests else 0.0,
+            "evictions": self.evictions
+        }
+
+
+metadata_cache = TTLCache(METADATA_CACHE_SIZE, METADATA_CACHE_TTL_SECONDS)
+
+register_stats("metadata_cache", "Session and photo records cached in memory", metadata_cache.stats)
+
+
+def _session_record(session: SessionModel) -> SessionRecord:
+    return SessionRecord(
+        id=session.id,
+        expires_at=session.expires_at,
+        photo_count=session.photo_count or 0,
+        details=session.to_dict()
+    )
+
+
+def _photo_record(photo: Photo) -> PhotoRecord:
+    return PhotoRecord(
+        id=photo.id,
+        session_id=photo.session_id,
+        original_filename=photo.original_filename,
+        r2_key_original=photo.r2_key_original,
+        r2_key_thumbnail=photo.r2_key_thumbnail,
+        derivative_keys=photo.derivative_keys,
+        content_type=photo.content_type,
+        file_size=photo.file_size,
+        status=photo.status
+    )
+
+
+async def load_session(db: AsyncSession, session_id: str) -> Optional[SessionRecord]:
+    """Session record from the cache, or from the database on a miss"""
+    record = metadata_cache.get(("session", session_id))
+    if record is None:
+        session = await db.get(SessionModel, session_id)
+        if session is None:
+            return None
+        record = _session_record(session)
+        metadata_cache.put(("session", session_id), record)
+    return record
+
+
+def load_session_sync(db: Session, session_id: str) -> Optional[SessionRecord]:
+    """load_session for sync endpoints"""
+    record = metadata_cache.get(("session", session_id))
+    if record is None:
+        session = db.get(SessionModel, session_id)
+        if session is None:
+            return None
+        record = _session_record(session)
+        metadata_cache.put(("session", session_id), record)
+    return record
+
+
+async def load_photo(db: AsyncSession, photo_id: str) -> Optional[PhotoRecord]:
+    """
+    Photo record from the cache, or from the database on a miss
+
+    Only ready photos are cached: their storage keys never change again.
+    """
+    record = metadata_cache.get(("photo", photo_id))
+    if record is None:
+        photo = await db.get(Photo, photo_id)
+        if photo is None:
+            return None
+        record = _photo_record(photo)
+        if photo.status == STATUS_READY:
+            metadata_cache.put(("photo", photo_id), record)
+    return record
+
+
+def invalidate_session(session_id: str, include_photos: bool = False):
+    """
+    Forget a cached session (after its row changed)
+
+    Args:
+        session_id: Session ID
+        include_photos: Also forget its photos (when the session is deleted)
+    """
+    metadata_cache.discard(("session", session_id))
+    if include_photos:
+        metadata_cache.discard_where(
+            lambda key, value: key[0] == "photo" and value.session_id == session_id
+        )
@@ -0,0 +1,239 @@
+import asyncio
+import functools
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Tuple
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = tuple(
+    float(bound) for bound in os.getenv(
+        "METRICS_LATENCY_BUCKETS",
+        "0.001,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10,30"
+    ).split(",")
+)
+
+METRICS_PREFIX = "photo_matcher"
+
+# Starlette appends "; charset=utf-8" to text/ media types
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4"
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """Latency histogram with cumulative buckets, one series per label set"""
+
+    def __init__(self, name: str, description: str, label_names: Tuple[str, ...], buckets=LATENCY_BUCKETS):
+        self.name = f"{METRICS_PREFIX}_{name}"
+        self.description = description
+        self.label_names = label_names
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = [(key, list(counts), total, count) for key, (counts, total, count) in self._series.items()]
+
+        for key, counts, total, count in sorted(series):
+            labels = dict(zip(self.label_names, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                bucket_labels = _format_labels({**labels, "le": _format_value(bound)})
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': '+Inf'})} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return lines
+
+
+REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds",
+    "Time from request start until the response body was sent, by route template",
+    ("method", "route", "status")
+)
+
+STAGE_SECONDS = Histogram(
+    "stage_duration_seconds",
+    "Time spent in each processing stage (storage I/O, derivatives, ZIP assembly, database)",
+    ("stage",)
+)
+
+# name -> (description, function returning {metric suffix: value})
+_stats_sources: Dict[str, Tuple[str, Callable[[], dict]]] = {}
+
+
+def register_stats(name: str, description: str, collect: Callable[[], dict]):
+    """
+    Expose a stats dict (cache counters, pool sizes...) at /metrics
+
+    Each numeric entry becomes photo_matcher_<name>_<key>; non-numeric
+    entries are skipped.
+    """
+    _stats_sources[name] = (description, collect)
+
+
+@contextmanager
+def timed(stage: str):
+    """Record how long the block takes under a stage"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=stage)
+
+
+def timed_stage(stage: str):
+    """Decorator form of timed() for sync and async functions"""
+    def decorate(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with timed(stage):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def timed_iter(stage: str, iterator: Iterator) -> Iterator:
+    """
+    Pass an iterator through, recording the time spent producing its items
+
+    Time the consumer spends between items (e.g. a slow client reading a
+    StreamingResponse) isn't counted. The total is recorded once, when the
+    iterator is exhausted or closed.
+    """
+    elapsed = 0.0
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                elapsed += time.perf_counter() - start
+                return
+            elapsed += time.perf_counter() - start
+            yield item
+    finally:
+        # Stopped early (e.g. client went away): let the source clean up too
+        close = getattr(iterator, "close", None)
+        if close is not None:
+            close()
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+
+
+def render_metrics() -> str:
+    """Every metric in the Prometheus text exposition format"""
+    lines = REQUEST_SECONDS.render() + STAGE_SECONDS.render()
+
+    for name, (description, collect) in sorted(_stats_sources.items()):
+        try:
+            stats = collect()
+        except Exception as e:
+            print(f"Error collecting {name} metrics: {e}")
+            continue
+        for key, value in sorted(stats.items()):
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            metric = f"{METRICS_PREFIX}_{name}_{key}"
+            lines.append(f"# HELP {metric} {description}")
+            lines.append(f"# TYPE {metric} gauge")
+            lines.append(f"{metric} {_format_value(value)}")
+
+    return "\n".join(lines) + "\n"
+
+
+def executor_stats(executor) -> dict:
+    """Worker count and queued tasks of a ThreadPoolExecutor"""
+    work_queue = getattr(executor, "_work_queue", None)
+    return {
+        "workers": getattr(executor, "_max_workers", 0),
+        "threads": len(getattr(executor, "_threads", ())),
+        "queued": work_queue.qsize() if work_queue is not None else 0
+    }
+
+
+class RequestTimingMiddleware:
+    """
+    ASGI middleware feeding REQUEST_SECONDS
+
+    Requests are labelled with their route template (e.g.
+    /api/photo/{photo_id}/thumbnail), not the raw path, so photo IDs don't
+    create a series each. Streaming responses are timed until their last
+    chunk is sent.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = 500
+        recorded = False
+
+        def record():
+            nonlocal recorded
+            if recorded:
+                return
+            recorded = True
+            route = scope.get("route")
+            REQUEST_SECONDS.observe(
+                time.perf_counter() - start,
+                method=scope["method"],
+                route=getattr(route, "path", "unmatched"),
+                status=status
+            )
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                record()
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            record()
@@ -0,0 +1,86 @@
+"""
+Migrate face descriptors from JSON lists to packed float32 blobs
+
+Usage:
+    python migrate_descriptors.py [--clear-json]
+
+Brings the schema up to date (see database.upgrade_schema), packs every
+legacy `descriptor_data` row, and rebuilds the per-session matrix files.
+Safe to run more than once.
+"""
+from database import init_db, SessionLocal
+from models import FaceDescriptor, Photo
+from face_matching import pack_descriptor, build_session_matrix
+from sqlalchemy import null
+import sys
+
+BATCH_SIZE = 500
+
+
+def migrate_rows(clear_json: bool = False) -> set:
+    """
+    Pack legacy JSON descriptors in batches
+
+    Returns:
+        IDs of sessions whose descriptors changed
+    """
+    db = SessionLocal()
+    sessions = set()
+    migrated = 0
+    skipped = 0
+
+    try:
+        while True:
+            rows = db.query(FaceDescriptor, Photo.session_id).join(
+                Photo, Photo.id == FaceDescriptor.photo_id
+            ).filter(
+                FaceDescriptor.descriptor.is_(None),
+                FaceDescriptor.descriptor_data.isnot(None)
+            ).limit(BATCH_SIZE).all()
+
+            if not rows:
+                break
+
+            for face, session_id in rows:
+                try:
+                    face.descriptor = pack_descriptor(face.descriptor_data)
+                    migrated += 1
+                except (TypeError, ValueError):
+                    # Unusable row; clear it so the loop makes progress
+                    skipped += 1
+                if clear_json or face.descriptor is None:
+                    # SQL NULL rather than a JSON 'null' value
+                    face.descriptor_data = null()
+                sessions.add(session_id)
+
+            db.commit()
+            print(f"  {migrated} descriptors packed...")
+    finally:
+        db.close()
+
+    print(f"✓ Packed {migrated} descriptors ({skipped} invalid rows cleared)")
+    return sessions
+
+
+if __name__ == "__main__":
+    clear_json = "--clear-json" in sys.argv
+
+    print("Migrating face descriptors...")
+
+    try:
+        # Adds the descriptor column and photo_id index if missing
+        init_db()
+        sessions = migrate_rows(clear_json)
+    except Exception as e:
+        print(f"✗ Migration failed: {e}")
+        exit(1)
+
+    db = SessionLocal()
+    try:
+        for session_id in sessions:
+            build_session_matrix(db, session_id)
+    finally:
+        db.close()
+
+    print(f"✓ Rebuilt descriptor matrices for {len(sessions)} sessions")
+    print("\nMigration complete!")
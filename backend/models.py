@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, Integer, DateTime, Boolean, JSON, ForeignKey, Text, Float
+from sqlalchemy import Column, String, Integer, DateTime, Boolean, JSON, ForeignKey, Text, Float, LargeBinary, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from datetime import datetime, timedelta
@@ -6,6 +6,13 @@ import uuid
 
 Base = declarative_base()
 
+# Photo.status values, shared by ingestion and every query that filters on it
+STATUS_UPLOADING = "uploading"
+STATUS_PENDING = "pending"
+STATUS_PROCESSING = "processing"
+STATUS_READY = "ready"
+STATUS_FAILED = "failed"
+
 def generate_uuid():
     return str(uuid.uuid4())
 
@@ -26,8 +33,20 @@ class Session(Base):
     
     # Metadata
     created_at = Column(DateTime, default=datetime.utcnow)
-    expires_at = Column(DateTime, default=lambda: datetime.utcnow() + timedelta(days=7))
+    expires_at = Column(DateTime, default=lambda: datetime.utcnow() + timedelta(days=7), index=True)  # Indexed for the expiry reaper
     photo_count = Column(Integer, default=0)
+    reserved_photos = Column(Integer, nullable=False, default=0, server_default="0")  # Slots held by photos still uploading or processing
+    ready_sequence = Column(Integer, nullable=False, default=0, server_default="0")  # Last Photo.ready_seq handed out
+    
+    # Cached full-session ZIP (see archive_cache.py)
+    archive_fingerprint = Column(String, nullable=True)  # Photo set the stored archive was built from
+    archive_size = Column(Integer, nullable=True)
+    archive_build_started_at = Column(DateTime, nullable=True)  # Set while a build is running
+    
+    # People found by clustering its faces (see face_clustering.py)
+    people_face_count = Column(Integer, nullable=True)  # Faces the stored clusters were built from
+    people_clustered_at = Column(DateTime, nullable=True)
+    people_build_started_at = Column(DateTime, nullable=True)  # Set while clustering is running
     
     # Relationships
     photos = relationship("Photo", back_populates="session", cascade="all, delete-orphan")
@@ -56,16 +75,32 @@ class Photo(Base):
     # File info
     original_filename = Column(String, nullable=False)
     r2_key_original = Column(String, nullable=False)  # Path in R2 for original
-    r2_key_thumbnail = Column(String, nullable=False)  # Path in R2 for thumbnail
+    r2_key_thumbnail = Column(String, nullable=False)  # Path in R2 for thumbnail (800px JPEG)
+    derivative_keys = Column(JSON, nullable=True)  # {"grid.webp": key, "view.jpg": key, ...}
     
     # Metadata
     uploaded_at = Column(DateTime, default=datetime.utcnow)
     file_size = Column(Integer)  # Size in bytes
+    content_type = Column(String, nullable=True)  # MIME type of the original
+    content_hash = Column(String, nullable=True, index=True)  # sha256 of the original; its Blob holds the stored objects
+    
+    # Ingestion
+    status = Column(String, default=STATUS_READY, server_default=STATUS_READY, index=True)  # "pending", "processing", "ready" or "failed"
+    ingest_attempts = Column(Integer, default=0)
+    ingest_error = Column(Text, nullable=True)
+    upload_id = Column(String, nullable=True, index=True)  # Resumable upload the photo was sent in, if any
+    faces_detected = Column(Integer, nullable=True)  # Faces the host's browser found at upload; None if it didn't look
+    ready_seq = Column(Integer, nullable=True)  # Order in which the session's photos became ready (None before it was tracked)
     
     # Relationships
     session = relationship("Session", back_populates="photos")
     face_descriptors = relationship("FaceDescriptor", back_populates="photo", cascade="all, delete-orphan")
     
+    __table_args__ = (
+        # Keyset pagination over a session in upload order
+        Index("ix_photos_session_uploaded_id", "session_id", "uploaded_at", "id"),
+    )
+    
     def to_dict(self):
         return {
             "id": self.id,
@@ -73,21 +108,78 @@ class Photo(Base):
             "original_filename": self.original_filename,
             "uploaded_at": self.uploaded_at.isoformat() if self.uploaded_at else None,
             "file_size": self.file_size,
+            "status": self.status,
             "face_count": len(self.face_descriptors) if self.face_descriptors else 0
         }
 
 
 class FaceDescriptor(Base):
-    """Face descriptors extracted from photos (for future use if needed)"""
+    """Face descriptors extracted from photos"""
     __tablename__ = "face_descriptors"
     
     id = Column(String, primary_key=True, default=generate_uuid)
-    photo_id = Column(String, ForeignKey("photos.id", ondelete="CASCADE"), nullable=False)
+    photo_id = Column(String, ForeignKey("photos.id", ondelete="CASCADE"), nullable=False, index=True)
     
-    # Face data (stored as JSON for now, not used in free tier but ready for future)
-    descriptor_data = Column(JSON, nullable=True)  # 128-number array
+    # Face data
+    descriptor = Column(LargeBinary, nullable=True)  # 128 packed little-endian float32 (512 bytes)
+    descriptor_data = Column(JSON, nullable=True)  # Legacy 128-number array, see migrate_descriptors.py
     quality_score = Column(Float, nullable=True)  # 0-1, face quality
     is_primary = Column(Boolean, default=False)  # Is this the best face in photo?
     
     # Relationships
     photo = relationship("Photo", back_populates="face_descriptors")
+
+
+class Blob(Base):
+    """Stored original + derivatives shared by every photo with the same content"""
+    __tablename__ = "blobs"
+    
+    id = Column(String, primary_key=True, default=generate_uuid)
+    content_hash = Column(String, nullable=False, unique=True)  # sha256 hex of the original
+    
+    # Storage keys (under blobs/, not under any one session)
+    original_key = Column(String, nullable=False)
+    derivative_keys = Column(JSON, nullable=True)  # {"grid.webp": key, "view.jpg": key, ...}
+    content_type = Column(String, nullable=True)
+    file_size = Column(Integer)
+    
+    # Ready photos pointing at this blob; its objects are deleted when this reaches 0
+    ref_count = Column(Integer, nullable=False, default=0, server_default="0")
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class Upload(Base):
+    """Resumable upload adding photos to a session (see chunked_upload.py)"""
+    __tablename__ = "uploads"
+    
+    id = Column(String, primary_key=True, default=generate_uuid)
+    session_id = Column(String, ForeignKey("sessions.id", ondelete="CASCADE"), nullable=False, index=True)
+    
+    part_size = Column(Integer, nullable=False)  # Bytes per part; the last part of a file may be shorter
+    created_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False, index=True)  # Uncommitted uploads are discarded after this
+    committed_at = Column(DateTime, nullable=True)
+
+
+class Person(Base):
+    """Cluster of faces in a session that belong to the same person (see face_clustering.py)"""
+    __tablename__ = "people"
+    
+    id = Column(String, primary_key=True, default=generate_uuid)
+    session_id = Column(String, ForeignKey("sessions.id", ondelete="CASCADE"), nullable=False, index=True)
+    
+    centroid = Column(LargeBinary, nullable=False)  # Quality-weighted mean descriptor, packed like FaceDescriptor.descriptor
+    radius = Column(Float, nullable=False)  # Distance from the centroid of its farthest face
+    face_count = Column(Integer, nullable=False)
+    photo_count = Column(Integer, nullable=False)
+    cover_photo_id = Column(String, nullable=True)  # Photo with its best face
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class PersonPhoto(Base):
+    """Photo a person appears in"""
+    __tablename__ = "person_photos"
+    
+    person_id = Column(String, ForeignKey("people.id", ondelete="CASCADE"), primary_key=True)
+    photo_id = Column(String, ForeignKey("photos.id", ondelete="CASCADE"), primary_key=True, index=True)
+    distance = Column(Float, nullable=False)  # Of the person's closest face in the photo to the centroid
@@ -0,0 +1,339 @@
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable, Iterator, Optional, Tuple
+
+from storage import get_storage, STREAM_CHUNK_SIZE
+from metrics import register_stats
+
+# In-memory tier for small, hot objects (thumbnails)
+MEMORY_CACHE_BYTES = int(os.getenv("MEMORY_CACHE_BYTES", str(64 * 1024 * 1024)))
+
+# Local disk tier shared by thumbnails and (optionally) originals
+DISK_CACHE_DIR = os.getenv(
+    "DISK_CACHE_DIR",
+    os.path.join(tempfile.gettempdir(), "photo-matcher", "objects")
+)
+DISK_CACHE_BYTES = int(os.getenv("DISK_CACHE_BYTES", str(1024 * 1024 * 1024)))
+
+# Serve originals from the disk tier instead of proxying R2 every time
+CACHE_ORIGINALS_ON_DISK = os.getenv("CACHE_ORIGINALS_ON_DISK", "false").lower() == "true"
+
+
+class MemoryLRU:
+    """Thread-safe LRU of bytes values bounded by total size"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.evictions = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: bytes):
+        # Don't let one large object flush the whole tier
+        if len(value) > self.max_bytes // 8:
+            return
+
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.current_bytes -= len(old)
+
+            self._items[key] = value
+            self.current_bytes += len(value)
+
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.current_bytes -= len(evicted)
+                self.evictions += 1
+
+    def discard(self, key: str):
+        with self._lock:
+            value = self._items.pop(key, None)
+            if value is not None:
+                self.current_bytes -= len(value)
+
+    def __len__(self):
+        return len(self._items)
+
+
+class DiskLRU:
+    """
+    Directory of cached objects bounded by total size
+
+    The LRU order lives in memory and is seeded from file modification times
+    on first use, so each worker enforces the budget for the files it knows.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.evictions = 0
+        self._index = None
+        self._lock = threading.Lock()
+
+    def path_for(self, key: str) -> str:
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def _ensure_index(self):
+        if self._index is not None:
+            return
+
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith(".tmp"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, path, stat.st_size))
+
+        self._index = OrderedDict()
+        for _, path, size in sorted(entries):
+            self._index[path] = size
+            self.current_bytes += size
+
+    def get_path(self, key: str) -> Optional[str]:
+        path = self.path_for(key)
+        with self._lock:
+            self._ensure_index()
+            if path not in self._index:
+                if not os.path.exists(path):
+                    return None
+                # Written by another worker
+                self._index[path] = os.path.getsize(path)
+                self.current_bytes += self._index[path]
+            self._index.move_to_end(path)
+        return path
+
+    def get(self, key: str) -> Optional[bytes]:
+        path = self.get_path(key)
+        if path is None:
+            return None
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            # Evicted by another worker in between
+            self.discard(key)
+            return None
+
+    def put(self, key: str, value: bytes) -> str:
+        path = self.path_for(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(value)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self._ensure_index()
+            self.current_bytes += len(value) - self._index.pop(path, 0)
+            self._index[path] = len(value)
+            self._evict()
+
+        return path
+
+    def _evict(self):
+        while self.current_bytes > self.max_bytes and len(self._index) > 1:
+            path, size = self._index.popitem(last=False)
+            self.current_bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def discard(self, key: str):
+        path = self.path_for(key)
+        with self._lock:
+            self._ensure_index()
+            self.current_bytes -= self._index.pop(path, 0)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def load_from_storage(key: str) -> bytes:
+    return get_storage().get(key)
+
+
+class ObjectCache:
+    """
+    Read-through cache in front of storage: memory LRU -> disk LRU -> backend
+
+    Concurrent misses for the same key share one storage download.
+    """
+
+    def __init__(self, memory: MemoryLRU, disk: DiskLRU, loader: Callable[[str], bytes] = load_from_storage):
+        self.memory = memory
+        self.disk = disk
+        self.loader = loader
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.coalesced = 0  # Misses that waited on another request's download
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def _single_flight(self, key: str, load: Callable[[], object]):
+        with self._lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._inflight[key] = future
+
+        if not owner:
+            self.coalesced += 1
+            return future.result()
+
+        try:
+            result = load()
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def get(self, key: str, use_memory: bool = True) -> bytes:
+        """
+        Get an object's bytes
+
+        Args:
+            key: Storage key
+            use_memory: Also keep the object in the memory tier
+
+        Returns:
+            Object content
+        """
+        if use_memory:
+            value = self.get_memory(key)
+            if value is not None:
+                return value
+
+        def load():
+            value = self.disk.get(key)
+            if value is not None:
+                self.disk_hits += 1
+            else:
+                self.misses += 1
+                value = self.loader(key)
+                try:
+                    self.disk.put(key, value)
+                except OSError as e:
+                    print(f"Error writing {key} to disk cache: {e}")
+            if use_memory:
+                self.memory.put(key, value)
+            return value
+
+        return self._single_flight(key, load)
+
+    def get_memory(self, key: str) -> Optional[bytes]:
+        """An object's bytes if the memory tier has them (never blocks on I/O)"""
+        value = self.memory.get(key)
+        if value is not None:
+            self.memory_hits += 1
+        return value
+
+    def get_path(self, key: str) -> str:
+        """
+        Get a local file holding the object (disk tier only)
+
+        The file can be evicted by another request at any time; use
+        open_stream to read it.
+        """
+        path = self.disk.get_path(key)
+        if path is not None:
+            self.disk_hits += 1
+            return path
+
+        def load():
+            path = self.disk.get_path(key)
+            if path is not None:
+                return path
+            self.misses += 1
+            return self.disk.put(key, self.loader(key))
+
+        return self._single_flight(key, load)
+
+    def open_stream(self, key: str, chunk_size: int = STREAM_CHUNK_SIZE) -> Tuple[Iterator[bytes], dict]:
+        """
+        Stream an object from the disk tier
+
+        Suitable for large objects such as originals, which are then never
+        held in memory. The file is opened before returning, so the stream
+        survives the disk tier evicting it meanwhile.
+
+        Returns:
+            (iterator of byte chunks, dict like StorageBackend.open_stream's)
+        """
+        try:
+            f = open(self.get_path(key), 'rb')
+        except FileNotFoundError:
+            # Evicted between get_path and open; fetch it again
+            self.disk.discard(key)
+            f = open(self.get_path(key), 'rb')
+
+        try:
+            size = os.fstat(f.fileno()).st_size
+        except BaseException:
+            f.close()
+            raise
+
+        def iterate():
+            with f:
+                while chunk := f.read(chunk_size):
+                    yield chunk
+
+        info = {"content_length": size, "content_type": None, "content_range": None, "etag": None}
+        return iterate(), info
+
+    def discard(self, key: str):
+        """Drop an object from both tiers (e.g. after deleting it from storage)"""
+        self.memory.discard(key)
+        self.disk.discard(key)
+
+    def stats(self) -> dict:
+        requests = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_rate": round((self.memory_hits + self.disk_hits) / requests, 4) if requests else 0.0,
+            "memory_items": len(self.memory),
+            "memory_bytes": self.memory.current_bytes,
+            "memory_evictions": self.memory.evictions,
+            "disk_bytes": self.disk.current_bytes,
+            "disk_evictions": self.disk.evictions
+        }
+
+
+object_cache = ObjectCache(
+    MemoryLRU(MEMORY_CACHE_BYTES),
+    DiskLRU(DISK_CACHE_DIR, DISK_CACHE_BYTES)
+)
+
+register_stats("object_cache", "Thumbnail/original cache (memory and disk tiers)", object_cache.stats)
@@ -1,8 +1,19 @@
 import boto3
+from boto3.s3.transfer import TransferConfig
 from botocore.client import Config
 import os
-from PIL import Image
+from PIL import Image, ImageOps
 import io
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterator, List, Optional, Tuple, Union
+
+from botocore.exceptions import ClientError
+
+from metrics import timed_stage, register_stats
+
+from storage import StorageBackend, ObjectNotFound, InvalidRange
 
 # R2 Configuration from environment variables
 R2_ACCOUNT_ID = os.getenv("R2_ACCOUNT_ID")
@@ -11,21 +22,64 @@ R2_SECRET_ACCESS_KEY = os.getenv("R2_SECRET_ACCESS_KEY")
 R2_BUCKET_NAME = os.getenv("R2_BUCKET_NAME")
 R2_ENDPOINT = os.getenv("R2_ENDPOINT")
 
-# Validate configuration
-if not all([R2_ACCOUNT_ID, R2_ACCESS_KEY_ID, R2_SECRET_ACCESS_KEY, R2_BUCKET_NAME, R2_ENDPOINT]):
-    raise ValueError("R2 configuration incomplete. Check environment variables.")
-
-# Create S3 client for R2
-s3_client = boto3.client(
-    's3',
-    endpoint_url=R2_ENDPOINT,
-    aws_access_key_id=R2_ACCESS_KEY_ID,
-    aws_secret_access_key=R2_SECRET_ACCESS_KEY,
-    config=Config(signature_version='s3v4'),
-    region_name='auto'
+# Lifetime of presigned GET URLs handed to clients
+PRESIGNED_URL_TTL = int(os.getenv("PRESIGNED_URL_TTL", "3600"))
+
+# A cached presigned URL is replaced once it has less than this many seconds left
+PRESIGNED_URL_REFRESH_MARGIN = int(os.getenv("PRESIGNED_URL_REFRESH_MARGIN", "300"))
+
+PRESIGNED_URL_CACHE_SIZE = int(os.getenv("PRESIGNED_URL_CACHE_SIZE", "20000"))
+
+# HTTP connections kept open to R2 (shared by all upload/download threads)
+R2_MAX_CONNECTIONS = int(os.getenv("R2_MAX_CONNECTIONS", "32"))
+
+# delete_objects accepts at most this many keys per call
+R2_DELETE_BATCH_SIZE = 1000
+
+# Files above the threshold are uploaded in parts of R2_MULTIPART_CHUNK_SIZE,
+# R2_MULTIPART_CONCURRENCY at a time, so one upload buffers at most
+# chunk size x concurrency bytes however large the file is
+R2_MULTIPART_THRESHOLD = int(os.getenv("R2_MULTIPART_THRESHOLD", str(8 * 1024 * 1024)))
+R2_MULTIPART_CHUNK_SIZE = int(os.getenv("R2_MULTIPART_CHUNK_SIZE", str(8 * 1024 * 1024)))
+R2_MULTIPART_CONCURRENCY = int(os.getenv("R2_MULTIPART_CONCURRENCY", "4"))
+
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=R2_MULTIPART_THRESHOLD,
+    multipart_chunksize=R2_MULTIPART_CHUNK_SIZE,
+    max_concurrency=R2_MULTIPART_CONCURRENCY
 )
 
+_s3_client = None
+_client_lock = threading.Lock()
 
+
+def get_s3_client():
+    """
+    S3 client for R2, created on first use
+    
+    Importing this module doesn't need credentials (derivative rendering,
+    the local storage backend and benchmarks use it without R2).
+    """
+    global _s3_client
+    if _s3_client is None:
+        with _client_lock:
+            if _s3_client is None:
+                # Validate configuration
+                if not all([R2_ACCOUNT_ID, R2_ACCESS_KEY_ID, R2_SECRET_ACCESS_KEY, R2_BUCKET_NAME, R2_ENDPOINT]):
+                    raise ValueError("R2 configuration incomplete. Check environment variables.")
+                
+                _s3_client = boto3.client(
+                    's3',
+                    endpoint_url=R2_ENDPOINT,
+                    aws_access_key_id=R2_ACCESS_KEY_ID,
+                    aws_secret_access_key=R2_SECRET_ACCESS_KEY,
+                    config=Config(signature_version='s3v4', max_pool_connections=R2_MAX_CONNECTIONS),
+                    region_name='auto'
+                )
+    return _s3_client
+
+
+@timed_stage("storage_put")
 def upload_file_to_r2(file_content: bytes, key: str, content_type: str = "image/jpeg") -> str:
     """
     Upload a file to R2
@@ -39,7 +93,7 @@ def upload_file_to_r2(file_content: bytes, key: str, content_type: str = "image/
         The key of the uploaded file
     """
     try:
-        s3_client.put_object(
+        get_s3_client().put_object(
             Bucket=R2_BUCKET_NAME,
             Key=key,
             Body=file_content,
@@ -51,6 +105,7 @@ def upload_file_to_r2(file_content: bytes, key: str, content_type: str = "image/
         raise
 
 
+@timed_stage("storage_get")
 def download_file_from_r2(key: str) -> bytes:
     """
     Download a file from R2
@@ -62,58 +117,362 @@ def download_file_from_r2(key: str) -> bytes:
         File content as bytes
     """
     try:
-        response = s3_client.get_object(Bucket=R2_BUCKET_NAME, Key=key)
+        response = get_s3_client().get_object(Bucket=R2_BUCKET_NAME, Key=key)
         return response['Body'].read()
     except Exception as e:
         print(f"Error downloading from R2: {e}")
         raise
 
 
+@timed_stage("storage_put")
+def upload_fileobj_to_r2(fileobj, key: str, content_type: str = "application/octet-stream") -> str:
+    """
+    Upload a file-like object to R2 (multipart for large files)
+    
+    Args:
+        fileobj: Readable binary file object
+        key: Path in R2 bucket
+        content_type: MIME type
+    
+    Returns:
+        The key of the uploaded file
+    """
+    try:
+        get_s3_client().upload_fileobj(
+            fileobj,
+            R2_BUCKET_NAME,
+            key,
+            ExtraArgs={"ContentType": content_type},
+            Config=TRANSFER_CONFIG
+        )
+        return key
+    except Exception as e:
+        print(f"Error uploading to R2: {e}")
+        raise
+
+
+@timed_stage("storage_put")
+def upload_path_to_r2(path: str, key: str, content_type: str = "application/octet-stream") -> str:
+    """
+    Upload a local file to R2, streamed from disk (multipart for large files)
+    
+    Args:
+        path: Local file path
+        key: Path in R2 bucket
+        content_type: MIME type
+    
+    Returns:
+        The key of the uploaded file
+    """
+    try:
+        get_s3_client().upload_file(
+            path,
+            R2_BUCKET_NAME,
+            key,
+            ExtraArgs={"ContentType": content_type},
+            Config=TRANSFER_CONFIG
+        )
+        return key
+    except Exception as e:
+        print(f"Error uploading to R2: {e}")
+        raise
+
+
+@timed_stage("storage_open_stream")
+def open_stream_from_r2(key: str, byte_range: Optional[str] = None, chunk_size: int = 256 * 1024):
+    """
+    Start a streaming download from R2
+    
+    The GET is issued immediately so a missing object (or an unsatisfiable
+    range) raises here rather than halfway through a response.
+    
+    Args:
+        key: Path in R2 bucket
+        byte_range: Optional HTTP Range value passed to R2 (e.g. "bytes=0-1023")
+        chunk_size: Size of the yielded chunks
+    
+    Returns:
+        (iterator of byte chunks, dict with content_length, content_type,
+        content_range and etag)
+    """
+    params = {"Bucket": R2_BUCKET_NAME, "Key": key}
+    if byte_range:
+        params["Range"] = byte_range
+    
+    try:
+        response = get_s3_client().get_object(**params)
+    except Exception as e:
+        print(f"Error downloading from R2: {e}")
+        raise
+    
+    body = response['Body']
+    
+    def iterate():
+        try:
+            yield from body.iter_chunks(chunk_size)
+        finally:
+            body.close()
+    
+    info = {
+        "content_length": response['ContentLength'],
+        "content_type": response.get('ContentType'),
+        "content_range": response.get('ContentRange'),
+        "etag": response.get('ETag')
+    }
+    
+    return iterate(), info
+
+
 def delete_file_from_r2(key: str):
     """Delete a file from R2"""
     try:
-        s3_client.delete_object(Bucket=R2_BUCKET_NAME, Key=key)
+        get_s3_client().delete_object(Bucket=R2_BUCKET_NAME, Key=key)
     except Exception as e:
         print(f"Error deleting from R2: {e}")
         raise
 
 
-def generate_thumbnail(image_content: bytes, max_size: tuple = (800, 800)) -> bytes:
+@timed_stage("storage_delete")
+def delete_files_from_r2(keys: List[str]) -> int:
     """
-    Generate a thumbnail from image content
+    Delete many files from R2, R2_DELETE_BATCH_SIZE keys per request
+    
+    Returns:
+        Number of keys deleted
+    """
+    deleted = 0
+    for start in range(0, len(keys), R2_DELETE_BATCH_SIZE):
+        batch = keys[start:start + R2_DELETE_BATCH_SIZE]
+        try:
+            response = get_s3_client().delete_objects(
+                Bucket=R2_BUCKET_NAME,
+                Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True}
+            )
+        except Exception as e:
+            print(f"Error deleting from R2: {e}")
+            raise
+        
+        errors = response.get("Errors", [])
+        for error in errors:
+            print(f"Error deleting {error.get('Key')} from R2: {error.get('Message')}")
+        deleted += len(batch) - len(errors)
+    return deleted
+
+
+# Derivatives rendered for every photo: (name, longest side in px, format)
+DERIVATIVE_SPECS = [
+    ("view", 800, "JPEG"),
+    ("view", 800, "WEBP"),
+    ("grid", 200, "JPEG"),
+    ("grid", 200, "WEBP"),
+]
+
+DERIVATIVE_EXTENSIONS = {"JPEG": "jpg", "WEBP": "webp"}
+DERIVATIVE_CONTENT_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp"}
+
+
+def derivative_name(size_name: str, image_format: str) -> str:
+    """Name of a derivative, e.g. grid.webp"""
+    return f"{size_name}.{DERIVATIVE_EXTENSIONS[image_format]}"
+
+
+def _fit(img: Image.Image, max_side: int) -> Image.Image:
+    width, height = img.size
+    if max(width, height) <= max_side:
+        return img
+    scale = max_side / max(width, height)
+    new_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return img.resize(new_size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+
+
+def generate_derivatives(image: Union[bytes, str], specs: list = None) -> dict:
+    """
+    Render every derivative of an image in one decode
+    
+    JPEGs are decoded in draft mode, so libjpeg scales by 1/2, 1/4 or 1/8
+    while decoding instead of producing the full-resolution bitmap. EXIF
+    orientation is applied once. Smaller sizes are resized from the next
+    larger one rather than from the original.
     
     Args:
-        image_content: Original image as bytes
-        max_size: Maximum dimensions (width, height)
+        image: Original image as bytes, or the path of a file holding it
+            (read lazily by the decoder, so it is never fully in memory)
+        specs: List of (name, max side, format); defaults to DERIVATIVE_SPECS
     
     Returns:
-        Thumbnail image as bytes
+        Dict of derivative name (e.g. "view.jpg") -> encoded bytes
     """
+    specs = specs or DERIVATIVE_SPECS
+    
     try:
-        # Open image
-        img = Image.open(io.BytesIO(image_content))
+        with Image.open(io.BytesIO(image) if isinstance(image, (bytes, bytearray)) else image) as source:
+            largest = max(max_side for _, max_side, _ in specs)
+            if source.format == 'JPEG':
+                # Ask for the largest derivative's dimensions (same aspect ratio),
+                # so the decoder picks the strongest reduction that still covers it
+                scale = largest / max(source.size)
+                source.draft('RGB', (int(source.size[0] * scale), int(source.size[1] * scale)))
+            
+            # Always a new image, so the file can be closed afterwards
+            img = ImageOps.exif_transpose(source)
         
-        # Convert RGBA to RGB if necessary
-        if img.mode == 'RGBA':
+        if img.mode not in ('RGB', 'L'):
             img = img.convert('RGB')
         
-        # Generate thumbnail (maintains aspect ratio)
-        img.thumbnail(max_size, Image.Resampling.LANCZOS)
+        derivatives = {}
+        current = img
         
-        # Save to bytes
-        output = io.BytesIO()
-        img.save(output, format='JPEG', quality=85, optimize=True)
-        output.seek(0)
+        for max_side in sorted({max_side for _, max_side, _ in specs}, reverse=True):
+            current = _fit(current, max_side)
+            
+            for size_name, spec_side, image_format in specs:
+                if spec_side != max_side:
+                    continue
+                
+                output = io.BytesIO()
+                if image_format == 'WEBP':
+                    current.save(output, format='WEBP', quality=80, method=4)
+                else:
+                    current.save(output, format='JPEG', quality=85)
+                derivatives[derivative_name(size_name, image_format)] = output.getvalue()
         
-        return output.read()
+        return derivatives
     except Exception as e:
-        print(f"Error generating thumbnail: {e}")
+        print(f"Error generating derivatives: {e}")
         raise
 
 
+@timed_stage("thumbnail")
+def generate_thumbnail(image_content: bytes, max_size: tuple = (800, 800)) -> bytes:
+    """
+    Generate a thumbnail from image content
+    
+    Args:
+        image_content: Original image as bytes
+        max_size: Maximum dimensions (width, height)
+    
+    Returns:
+        Thumbnail image as bytes
+    """
+    derivatives = generate_derivatives(image_content, [("thumbnail", max(max_size), "JPEG")])
+    return derivatives["thumbnail.jpg"]
+
+
 def get_public_url(key: str) -> str:
     """
     Get public URL for an R2 object
     Note: R2 bucket must be configured for public access
     """
     return f"{R2_ENDPOINT.replace('.r2.cloudflarestorage.com', '.r2.dev')}/{key}"
+
+
+_presigned_urls = OrderedDict()
+_presigned_lock = threading.Lock()
+
+register_stats(
+    "presigned_url_cache",
+    "Presigned URLs cached until shortly before they expire",
+    lambda: {"entries": len(_presigned_urls)}
+)
+
+
+def get_presigned_url(key: str) -> Tuple[str, float]:
+    """
+    Get a presigned GET URL for an R2 object
+    
+    Signing is done locally (SigV4, no network call) and the URL is cached
+    per key until PRESIGNED_URL_REFRESH_MARGIN seconds before it expires, so
+    repeated listings return the same, browser-cacheable URL.
+    
+    Args:
+        key: Path in R2 bucket
+    
+    Returns:
+        (URL, expiry as a UNIX timestamp)
+    """
+    now = time.time()
+    
+    with _presigned_lock:
+        cached = _presigned_urls.get(key)
+        if cached and cached[1] - now > PRESIGNED_URL_REFRESH_MARGIN:
+            _presigned_urls.move_to_end(key)
+            return cached
+    
+    url = get_s3_client().generate_presigned_url(
+        'get_object',
+        Params={"Bucket": R2_BUCKET_NAME, "Key": key},
+        ExpiresIn=PRESIGNED_URL_TTL
+    )
+    entry = (url, now + PRESIGNED_URL_TTL)
+    
+    with _presigned_lock:
+        _presigned_urls[key] = entry
+        _presigned_urls.move_to_end(key)
+        while len(_presigned_urls) > PRESIGNED_URL_CACHE_SIZE:
+            _presigned_urls.popitem(last=False)
+    
+    return entry
+
+
+def list_r2_prefix(prefix: str) -> Iterator[str]:
+    """Every key in the bucket starting with prefix (1000 per list request)"""
+    paginator = get_s3_client().get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=R2_BUCKET_NAME, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            yield obj["Key"]
+
+
+def _translate_client_error(e: ClientError, key: str):
+    error_code = e.response.get("Error", {}).get("Code")
+    if error_code == "InvalidRange":
+        raise InvalidRange(key) from e
+    if error_code in ("NoSuchKey", "404"):
+        raise ObjectNotFound(key) from e
+    raise e
+
+
+class R2Storage(StorageBackend):
+    """Storage backend for Cloudflare R2 (or any S3-compatible service)"""
+    
+    name = "r2"
+    supports_presign = True
+    
+    def __init__(self):
+        # Fail at startup rather than on the first upload
+        get_s3_client()
+    
+    def put(self, data: bytes, key: str, content_type: str = "image/jpeg") -> str:
+        return upload_file_to_r2(data, key, content_type)
+    
+    def put_fileobj(self, fileobj, key: str, content_type: str = "application/octet-stream") -> str:
+        return upload_fileobj_to_r2(fileobj, key, content_type)
+    
+    def put_file(self, path: str, key: str, content_type: str = "application/octet-stream") -> str:
+        return upload_path_to_r2(path, key, content_type)
+    
+    def get(self, key: str) -> bytes:
+        try:
+            return download_file_from_r2(key)
+        except ClientError as e:
+            _translate_client_error(e, key)
+    
+    def open_stream(self, key: str, byte_range: Optional[str] = None, chunk_size: int = 256 * 1024):
+        try:
+            return open_stream_from_r2(key, byte_range, chunk_size)
+        except ClientError as e:
+            _translate_client_error(e, key)
+    
+    def delete(self, key: str):
+        delete_file_from_r2(key)
+    
+    def delete_many(self, keys: List[str]) -> int:
+        return delete_files_from_r2(keys)
+    
+    def list_prefix(self, prefix: str) -> Iterator[str]:
+        return list_r2_prefix(prefix)
+    
+    def presign(self, key: str) -> Tuple[str, float]:
+        return get_presigned_url(key)
+    
+    def public_url(self, key: str) -> str:
+        return get_public_url(key)
@@ -0,0 +1,217 @@
+import asyncio
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from typing import List, Optional
+
+from sqlalchemy import select, delete
+from sqlalchemy.orm import Session
+
+from blob_store import release_blob_references, collect_orphan_blobs
+from database import SessionLocal
+from models import Session as SessionModel, Photo, FaceDescriptor, Upload, Person, PersonPhoto
+from storage import get_storage
+from object_cache import object_cache
+from face_matching import remove_session_files
+from ann_index import forget_session_index
+from face_clustering import forget_session_people
+from ingestion import remove_session_spool, STATUS_READY
+from metadata_cache import invalidate_session
+from match_cache import forget_session_matches
+from chunked_upload import expire_uploads
+from metrics import register_stats, executor_stats
+
+# How often the reaper looks for expired sessions (0 disables it)
+REAPER_INTERVAL_SECONDS = int(os.getenv("REAPER_INTERVAL_SECONDS", "3600"))
+
+# Sessions purged per reaper batch, so one run never holds the pool for long
+REAPER_BATCH_SIZE = int(os.getenv("REAPER_BATCH_SIZE", "20"))
+
+CLEANUP_WORKERS = int(os.getenv("CLEANUP_WORKERS", "2"))
+
+# Unreferenced blobs younger than this may still be claimed by an ingest in progress
+BLOB_ORPHAN_GRACE_SECONDS = int(os.getenv("BLOB_ORPHAN_GRACE_SECONDS", "3600"))
+
+_cleanup_pool = ThreadPoolExecutor(max_workers=CLEANUP_WORKERS, thread_name_prefix="session-cleanup")
+
+register_stats("cleanup_pool", "Session purge thread pool", lambda: executor_stats(_cleanup_pool))
+
+
+def session_prefix(session_id: str) -> str:
+    """Storage prefix holding every object of a session"""
+    return f"sessions/{session_id}/"
+
+
+def _delete_keys(keys: List[str]) -> int:
+    storage = get_storage()
+    deleted = storage.delete_many(keys) if keys else 0
+    for key in keys:
+        object_cache.discard(key)
+    return deleted
+
+
+def purge_session_objects(session_id: str) -> int:
+    """
+    Delete everything a session stored on its own: objects under its prefix
+    (listed, then deleted in batches) and its local descriptor, index and
+    spool files. Shared blobs are released separately, with the rows.
+
+    Returns:
+        Number of objects deleted
+    """
+    keys = list(get_storage().list_prefix(session_prefix(session_id)))
+    deleted = _delete_keys(keys)
+
+    remove_session_files(session_id)
+    forget_session_index(session_id)
+    forget_session_people(session_id)
+    remove_session_spool(session_id)
+
+    return deleted
+
+
+def delete_session_rows(db: Session, session_id: str) -> List[str]:
+    """
+    Bulk-delete a session with its photos, descriptors, people and uploads (doesn't commit)
+
+    Returns:
+        Content hashes of the ready photos this call deleted (one per photo),
+        whose blob references the caller releases in the same transaction
+    """
+    photo_ids = select(Photo.id).where(Photo.session_id == session_id)
+    db.query(PersonPhoto).filter(
+        PersonPhoto.person_id.in_(select(Person.id).where(Person.session_id == session_id))
+    ).delete(synchronize_session=False)
+    db.query(Person).filter(Person.session_id == session_id).delete(synchronize_session=False)
+    db.query(FaceDescriptor).filter(
+        FaceDescriptor.photo_id.in_(photo_ids)
+    ).delete(synchronize_session=False)
+    deleted_photos = db.execute(
+        delete(Photo).where(Photo.session_id == session_id).returning(Photo.content_hash, Photo.status)
+    ).all()
+    db.query(Upload).filter(Upload.session_id == session_id).delete(synchronize_session=False)
+    db.query(SessionModel).filter(SessionModel.id == session_id).delete(synchronize_session=False)
+
+    return [
+        content_hash for content_hash, status in deleted_photos
+        if status == STATUS_READY and content_hash is not None
+    ]
+
+
+def purge_session(session_id: str) -> int:
+    """
+    Remove a session completely
+
+    Session objects go first and rows last: if the purge fails halfway, the
+    session row is still there (expired) and the reaper retries it. Blob
+    references are dropped in the same transaction as the photo rows, and
+    blobs no other session uses are deleted after it commits.
+
+    Returns:
+        Number of objects deleted
+    """
+    deleted = purge_session_objects(session_id)
+
+    db = SessionLocal()
+    try:
+        unreferenced = release_blob_references(db, delete_session_rows(db, session_id))
+        db.commit()
+    finally:
+        db.close()
+    invalidate_session(session_id, include_photos=True)
+    forget_session_matches(session_id)
+
+    deleted += _delete_keys(unreferenced)
+
+    print(f"Purged session {session_id} ({deleted} objects)")
+    return deleted
+
+
+def _purge_logged(session_id: str):
+    try:
+        purge_session(session_id)
+    except Exception as e:
+        print(f"Error purging session {session_id} (the reaper will retry): {e}")
+
+
+def schedule_session_purge(session_id: str) -> Future:
+    """Purge a session on the cleanup pool"""
+    return _cleanup_pool.submit(_purge_logged, session_id)
+
+
+def reap_expired_sessions(batch_size: int = REAPER_BATCH_SIZE) -> int:
+    """
+    Purge up to batch_size sessions past their expires_at
+
+    Returns:
+        Number of sessions purged
+    """
+    db = SessionLocal()
+    try:
+        expired = [
+            session_id for (session_id,) in db.query(SessionModel.id).filter(
+                SessionModel.expires_at < datetime.utcnow()
+            ).order_by(SessionModel.expires_at).limit(batch_size)
+        ]
+    finally:
+        db.close()
+
+    purged = 0
+    for session_id in expired:
+        try:
+            purge_session(session_id)
+            purged += 1
+        except Exception as e:
+            print(f"Error purging expired session {session_id}: {e}")
+
+    return purged
+
+
+def collect_blobs(batch_size: int = REAPER_BATCH_SIZE) -> int:
+    """
+    Delete up to batch_size blobs that no photo references
+
+    Returns:
+        Number of objects deleted
+    """
+    db = SessionLocal()
+    try:
+        keys = collect_orphan_blobs(db, BLOB_ORPHAN_GRACE_SECONDS, batch_size)
+        db.commit()
+    finally:
+        db.close()
+
+    return _delete_keys(keys)
+
+
+_reaper: Optional[asyncio.Task] = None
+
+
+async def _reaper_loop():
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            # Work through a backlog batch by batch; stop early if a batch had failures
+            while await loop.run_in_executor(_cleanup_pool, reap_expired_sessions) == REAPER_BATCH_SIZE:
+                pass
+            await loop.run_in_executor(_cleanup_pool, collect_blobs)
+            await loop.run_in_executor(_cleanup_pool, expire_uploads, REAPER_BATCH_SIZE)
+        except Exception as e:
+            print(f"Expiry reaper error: {e}")
+        await asyncio.sleep(REAPER_INTERVAL_SECONDS)
+
+
+def start_reaper():
+    """Start the periodic expiry reaper (called on app startup)"""
+    global _reaper
+    if REAPER_INTERVAL_SECONDS > 0 and _reaper is None:
+        _reaper = asyncio.create_task(_reaper_loop())
+
+
+async def stop_reaper():
+    global _reaper
+    if _reaper is not None:
+        _reaper.cancel()
+        await asyncio.gather(_reaper, return_exceptions=True)
+        _reaper = None
+    _cleanup_pool.shutdown(wait=True)
@@ -0,0 +1,269 @@
+import mimetypes
+import mmap
+import os
+import re
+import shutil
+import threading
+from typing import Iterator, List, Optional, Tuple
+
+from metrics import timed_stage
+
+# Where photo bytes live: "r2" (Cloudflare R2 / any S3 API) or "local" (a directory)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "r2").lower()
+
+# Root directory of the local backend
+LOCAL_STORAGE_DIR = os.getenv("LOCAL_STORAGE_DIR", os.path.join(".", "data", "objects"))
+
+STREAM_CHUNK_SIZE = 256 * 1024
+
+
+class ObjectNotFound(Exception):
+    """The requested key doesn't exist in storage"""
+
+
+class InvalidRange(Exception):
+    """The requested byte range lies outside the object"""
+
+
+class StorageBackend:
+    """
+    Interface every storage backend implements
+
+    Keys are slash-separated paths such as "sessions/{id}/photo.jpg".
+    Backends raise ObjectNotFound / InvalidRange instead of their own
+    client errors, so callers don't depend on a particular backend.
+    """
+
+    name = "base"
+
+    # Whether presign()/public_url() return URLs clients can fetch directly
+    supports_presign = False
+
+    def put(self, data: bytes, key: str, content_type: str = "image/jpeg") -> str:
+        raise NotImplementedError
+
+    def put_fileobj(self, fileobj, key: str, content_type: str = "application/octet-stream") -> str:
+        raise NotImplementedError
+
+    def put_file(self, path: str, key: str, content_type: str = "application/octet-stream") -> str:
+        """Store a local file without reading it into memory"""
+        with open(path, 'rb') as f:
+            return self.put_fileobj(f, key, content_type)
+
+    def get(self, key: str) -> bytes:
+        raise NotImplementedError
+
+    def open_stream(
+        self,
+        key: str,
+        byte_range: Optional[str] = None,
+        chunk_size: int = STREAM_CHUNK_SIZE
+    ) -> Tuple[Iterator[bytes], dict]:
+        """
+        Start streaming an object
+
+        Returns:
+            (iterator of byte chunks, dict with content_length, content_type,
+            content_range and etag)
+        """
+        raise NotImplementedError
+
+    def delete(self, key: str):
+        raise NotImplementedError
+
+    def delete_many(self, keys: List[str]) -> int:
+        """Delete several keys; returns how many were deleted"""
+        for key in keys:
+            self.delete(key)
+        return len(keys)
+
+    def list_prefix(self, prefix: str) -> Iterator[str]:
+        """Every key starting with prefix"""
+        raise NotImplementedError
+
+    def presign(self, key: str) -> Tuple[str, float]:
+        """(URL, expiry as a UNIX timestamp) for a direct client download"""
+        raise NotImplementedError(f"{self.name} storage can't presign URLs")
+
+    def public_url(self, key: str) -> str:
+        raise NotImplementedError(f"{self.name} storage has no public URLs")
+
+    def local_path(self, key: str) -> Optional[str]:
+        """Path of the object on this machine, if the backend keeps one (for sendfile)"""
+        return None
+
+
+def parse_byte_range(byte_range: str, size: int) -> Tuple[int, int]:
+    """
+    Resolve a single "bytes=start-end" range against an object size
+
+    Returns:
+        Inclusive (start, end)
+    """
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", byte_range.strip())
+    if not match or not any(match.groups()):
+        raise InvalidRange(byte_range)
+
+    start, end = match.groups()
+    if not start:
+        # Suffix range: the last N bytes
+        length = int(end)
+        if length == 0:
+            raise InvalidRange(byte_range)
+        return max(0, size - length), size - 1
+
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start >= size or end < start:
+        raise InvalidRange(byte_range)
+    return start, end
+
+
+class LocalStorage(StorageBackend):
+    """
+    Objects as files under a directory
+
+    Whole files are served with FileResponse via local_path(); partial
+    reads go through mmap, so neither path reads an object into one bytes.
+    """
+
+    name = "local"
+
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+
+    def path_for(self, key: str) -> str:
+        path = os.path.abspath(os.path.join(self.root, key))
+        if not path.startswith(self.root + os.sep):
+            raise ValueError(f"Invalid storage key: {key}")
+        return path
+
+    def _write(self, key: str, write):
+        path = self.path_for(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                write(f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return key
+
+    @timed_stage("storage_put")
+    def put(self, data: bytes, key: str, content_type: str = "image/jpeg") -> str:
+        return self._write(key, lambda f: f.write(data))
+
+    @timed_stage("storage_put")
+    def put_fileobj(self, fileobj, key: str, content_type: str = "application/octet-stream") -> str:
+        return self._write(key, lambda f: shutil.copyfileobj(fileobj, f, STREAM_CHUNK_SIZE))
+
+    @timed_stage("storage_put")
+    def put_file(self, path: str, key: str, content_type: str = "application/octet-stream") -> str:
+        # copyfile uses sendfile/copy_file_range where available
+        def write(f):
+            f.close()
+            shutil.copyfile(path, f.name)
+        return self._write(key, write)
+
+    @timed_stage("storage_get")
+    def get(self, key: str) -> bytes:
+        try:
+            with open(self.path_for(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            raise ObjectNotFound(key)
+
+    @timed_stage("storage_open_stream")
+    def open_stream(
+        self,
+        key: str,
+        byte_range: Optional[str] = None,
+        chunk_size: int = STREAM_CHUNK_SIZE
+    ) -> Tuple[Iterator[bytes], dict]:
+        try:
+            f = open(self.path_for(key), 'rb')
+        except FileNotFoundError:
+            raise ObjectNotFound(key)
+
+        try:
+            stat = os.fstat(f.fileno())
+            size = stat.st_size
+            start, end = parse_byte_range(byte_range, size) if byte_range else (0, size - 1)
+            # mmap can't map empty files
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        except BaseException:
+            f.close()
+            raise
+
+        def iterate():
+            try:
+                for position in range(start, end + 1, chunk_size):
+                    yield mapped[position:min(position + chunk_size, end + 1)]
+            finally:
+                if mapped is not None:
+                    mapped.close()
+                f.close()
+
+        info = {
+            "content_length": end - start + 1,
+            "content_type": mimetypes.guess_type(key)[0],
+            "content_range": f"bytes {start}-{end}/{size}" if byte_range else None,
+            "etag": f'"{stat.st_mtime_ns:x}-{size:x}"'
+        }
+
+        return iterate(), info
+
+    def delete(self, key: str):
+        path = self.path_for(key)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+        # Drop directories the delete left empty (e.g. a purged session's)
+        directory = os.path.dirname(path)
+        while directory != self.root:
+            try:
+                os.rmdir(directory)
+            except OSError:
+                break
+            directory = os.path.dirname(directory)
+
+    def list_prefix(self, prefix: str) -> Iterator[str]:
+        # Walk only the deepest directory the prefix names
+        directory = os.path.join(self.root, os.path.dirname(prefix))
+        for root, _, files in os.walk(directory):
+            for name in files:
+                if name.endswith(".tmp"):
+                    continue
+                key = os.path.relpath(os.path.join(root, name), self.root).replace(os.sep, "/")
+                if key.startswith(prefix):
+                    yield key
+
+    def local_path(self, key: str) -> Optional[str]:
+        path = self.path_for(key)
+        return path if os.path.isfile(path) else None
+
+
+_storage: Optional[StorageBackend] = None
+_storage_lock = threading.Lock()
+
+
+def get_storage() -> StorageBackend:
+    """The backend selected by STORAGE_BACKEND (created on first use)"""
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                if STORAGE_BACKEND == "local":
+                    _storage = LocalStorage(LOCAL_STORAGE_DIR)
+                elif STORAGE_BACKEND == "r2":
+                    from r2_storage import R2Storage
+                    _storage = R2Storage()
+                else:
+                    raise ValueError(f"Unknown STORAGE_BACKEND: {STORAGE_BACKEND}")
+    return _storage
@@ -0,0 +1,112 @@
+import hashlib
+import json
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+from object_cache import object_cache, MemoryLRU
+from metrics import register_stats, executor_stats
+
+# Bundle layout:
+#   b"PMTB" | uint32 BE header length | header JSON | image bytes...
+# The header lists {"id", "content_type", "offset", "length"} per image, with
+# offsets relative to the first byte after the header.
+BUNDLE_MAGIC = b"PMTB"
+BUNDLE_VERSION = 1
+BUNDLE_MEDIA_TYPE = "application/vnd.photo-matcher.thumbnail-bundle"
+
+# Most thumbnails a single bundle may contain
+MAX_BUNDLE_PHOTOS = int(os.getenv("MAX_BUNDLE_PHOTOS", "50"))
+
+# Thumbnails fetched concurrently while assembling a bundle
+BUNDLE_FETCH_WORKERS = int(os.getenv("BUNDLE_FETCH_WORKERS", "8"))
+
+# Memory kept for assembled bundles, so repeat views of a page are one lookup
+BUNDLE_CACHE_BYTES = int(os.getenv("BUNDLE_CACHE_BYTES", str(64 * 1024 * 1024)))
+
+_fetch_pool = ThreadPoolExecutor(max_workers=BUNDLE_FETCH_WORKERS, thread_name_prefix="bundle-fetch")
+_bundles = MemoryLRU(BUNDLE_CACHE_BYTES)
+
+register_stats(
+    "bundle_cache",
+    "Assembled thumbnail bundles kept in memory",
+    lambda: {"items": len(_bundles), "bytes": _bundles.current_bytes, "evictions": _bundles.evictions}
+)
+register_stats("bundle_fetch_pool", "Thumbnail bundle fetch thread pool", lambda: executor_stats(_fetch_pool))
+
+
+def bundle_etag(entries: List[Tuple[str, str, str]], extra: Optional[dict] = None) -> str:
+    """
+    ETag of a bundle
+
+    Thumbnail keys never get new content, so the key list (plus anything
+    else that goes into the header) identifies the bundle's bytes.
+    """
+    digest = hashlib.sha256()
+    for photo_id, key, content_type in entries:
+        digest.update(f"{photo_id}\0{key}\0{content_type}\n".encode())
+    digest.update(json.dumps(extra or {}, sort_keys=True).encode())
+    return f'"{digest.hexdigest()[:32]}"'
+
+
+def build_bundle(entries: List[Tuple[str, str, str]], extra: Optional[dict] = None) -> Tuple[bytes, bool]:
+    """
+    Pack several thumbnails into one length-prefixed binary response
+
+    Args:
+        entries: (photo_id, r2_key, content_type) per thumbnail, in order
+        extra: Additional fields for the header (e.g. pagination)
+
+    Returns:
+        (bundle bytes, whether every thumbnail made it in); thumbnails that
+        can't be fetched are left out
+    """
+    futures = [_fetch_pool.submit(object_cache.get, key) for _, key, _ in entries]
+
+    index = []
+    images = []
+    offset = 0
+    for (photo_id, key, content_type), future in zip(entries, futures):
+        try:
+            data = future.result()
+        except Exception as e:
+            print(f"Error adding {key} to thumbnail bundle: {e}")
+            continue
+
+        index.append({
+            "id": photo_id,
+            "content_type": content_type,
+            "offset": offset,
+            "length": len(data)
+        })
+        images.append(data)
+        offset += len(data)
+
+    header = json.dumps(
+        {"version": BUNDLE_VERSION, "entries": index, **(extra or {})},
+        separators=(",", ":")
+    ).encode()
+
+    bundle = b"".join([BUNDLE_MAGIC, struct.pack(">I", len(header)), header, *images])
+    return bundle, len(index) == len(entries)
+
+
+def get_bundle(entries: List[Tuple[str, str, str]], extra: Optional[dict] = None) -> Tuple[Optional[str], bytes]:
+    """
+    Cached build_bundle
+
+    Returns:
+        (etag, bundle bytes); etag is None for incomplete bundles
+    """
+    etag = bundle_etag(entries, extra)
+
+    bundle = _bundles.get(etag)
+    if bundle is None:
+        bundle, complete = build_bundle(entries, extra)
+        # A bundle missing thumbnails must not be served again under this ETag
+        if not complete:
+            return None, bundle
+        _bundles.put(etag, bundle)
+
+    return etag, bundle
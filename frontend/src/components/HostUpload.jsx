@@ -1,13 +1,22 @@
-import React, { useState, useCallback } from 'react'
+import React, { useState, useCallback, useEffect } from 'react'
 import axios from 'axios'
+import { uploadPhotos, resumeUpload } from '../services/resumableUpload'
+import { describePhotoFaces } from '../services/faceDetection'
 
 function HostUpload() {
   const [files, setFiles] = useState([])
   const [previews, setPreviews] = useState([])
   const [uploading, setUploading] = useState(false)
   const [uploadProgress, setUploadProgress] = useState(0)
+  const [uploadStage, setUploadStage] = useState('Uploading...')
   const [sessionData, setSessionData] = useState(null)
+  const [ingestStatus, setIngestStatus] = useState(null)
   const [dragActive, setDragActive] = useState(false)
+  // Session and upload to resume after a failed upload, so a retry only resends what's missing
+  const [pendingSession, setPendingSession] = useState(null)
+  const [failedUploadId, setFailedUploadId] = useState(null)
+  const [addingPhotos, setAddingPhotos] = useState(false)
+  const [addFailedFiles, setAddFailedFiles] = useState(null)
 
   // Session settings
   const [sessionName, setSessionName] = useState('')
@@ -18,6 +27,33 @@ function HostUpload() {
 
   const apiUrl = import.meta.env.VITE_API_URL || ''
 
+  // Poll processing progress until every uploaded photo is ready or failed
+  useEffect(() => {
+    if (!sessionData) return
+
+    let cancelled = false
+    let timer = null
+
+    const poll = async () => {
+      try {
+        const response = await axios.get(`${apiUrl}/api/session/${sessionData.session_id}/ingest-status`)
+        if (cancelled) return
+        setIngestStatus(response.data)
+        if (response.data.done) return
+      } catch (error) {
+        console.error('Error loading upload status:', error)
+      }
+      if (!cancelled) timer = setTimeout(poll, 1500)
+    }
+
+    poll()
+
+    return () => {
+      cancelled = true
+      clearTimeout(timer)
+    }
+  }, [sessionData])
+
   const handleDrag = useCallback((e) => {
     e.preventDefault()
     e.stopPropagation()
@@ -49,7 +85,15 @@ function HostUpload() {
     addFiles(selectedFiles)
   }
 
+  // Changing the selection makes a half-finished upload useless; free its photo slots
+  const discardFailedUpload = () => {
+    if (!failedUploadId) return
+    axios.delete(`${apiUrl}/api/uploads/${failedUploadId}`).catch(() => {})
+    setFailedUploadId(null)
+  }
+
   const addFiles = (newFiles) => {
+    discardFailedUpload()
     // Check limit (100 photos)
     const totalFiles = files.length + newFiles.length
     if (totalFiles > 100) {
@@ -69,6 +113,7 @@ function HostUpload() {
   }
 
   const removeFile = (index) => {
+    discardFailedUpload()
     setFiles(prev => prev.filter((_, i) => i !== index))
     setPreviews(prev => prev.filter((_, i) => i !== index))
   }
@@ -87,38 +132,92 @@ function HostUpload() {
     setUploading(true)
     setUploadProgress(0)
 
-    const formData = new FormData()
-    
-    // Add files
-    files.forEach(file => {
-      formData.append('files', file)
-    })
+    try {
+      // Create the (empty) session once; retries reuse it
+      let session = pendingSession
+      if (!session) {
+        const formData = new FormData()
+        formData.append('session_name', sessionName)
+        formData.append('session_mode', sessionMode)
+        if (welcomeMessage) formData.append('welcome_message', welcomeMessage)
+        formData.append('theme_primary', themePrimary)
+        formData.append('theme_secondary', themeSecondary)
+
+        const response = await axios.post(`${apiUrl}/api/host/create-session`, formData, {
+          headers: { 'Content-Type': 'multipart/form-data' }
+        })
+        session = response.data
+        setPendingSession(session)
+      }
 
-    // Add session settings
-    formData.append('session_name', sessionName)
-    formData.append('session_mode', sessionMode)
-    if (welcomeMessage) formData.append('welcome_message', welcomeMessage)
-    formData.append('theme_primary', themePrimary)
-    formData.append('theme_secondary', themeSecondary)
+      const result = await sendPhotos(session.session_id, files)
 
-    try {
-      const response = await axios.post(`${apiUrl}/api/host/create-session`, formData, {
-        headers: { 'Content-Type': 'multipart/form-data' },
-        onUploadProgress: (progressEvent) => {
-          const percentCompleted = Math.round((progressEvent.loaded * 100) / progressEvent.total)
-          setUploadProgress(percentCompleted)
-        }
-      })
-
-      setSessionData(response.data)
+      setPendingSession(null)
+      setSessionData({ ...session, photo_count: result.photo_count })
     } catch (error) {
       console.error('Upload error:', error)
-      alert('Failed to upload photos. Please try again.')
+      alert(uploadErrorMessage(error))
     } finally {
       setUploading(false)
     }
   }
 
+  // Upload photos into a session, resuming the previous attempt if it failed part-way.
+  // A new upload first finds the faces in each photo, so guests can match against
+  // them without downloading every photo (a resumed upload already sent them).
+  const sendPhotos = async (sessionId, photoFiles) => {
+    const onProgress = setUploadProgress
+    try {
+      let result
+      if (failedUploadId) {
+        result = await resumeUpload(apiUrl, failedUploadId, photoFiles, { onProgress })
+      } else {
+        setUploadStage('Finding faces...')
+        const faces = await describePhotoFaces(photoFiles, { onProgress })
+        setUploadStage('Uploading...')
+        setUploadProgress(0)
+        result = await uploadPhotos(apiUrl, sessionId, photoFiles, { onProgress, faces })
+      }
+      setFailedUploadId(null)
+      return result
+    } catch (error) {
+      // Upload expired or is unknown: the next attempt starts a new one
+      const status = error.response && error.response.status
+      setFailedUploadId(status === 404 || status === 410 ? null : error.uploadId || null)
+      throw error
+    }
+  }
+
+  const uploadErrorMessage = (error) => {
+    const detail = error.response && error.response.data && error.response.data.detail
+    if (typeof detail === 'string') return detail
+    if (error.uploadId) return 'Some photos did not finish uploading. Try again to send only what is missing.'
+    return 'Failed to upload photos. Please try again.'
+  }
+
+  const addPhotos = async (newFiles) => {
+    setAddingPhotos(true)
+    setUploadProgress(0)
+    try {
+      const result = await sendPhotos(sessionData.session_id, newFiles)
+      setAddFailedFiles(null)
+      // A new object restarts the ingest-status polling
+      setSessionData(prev => ({ ...prev, photo_count: (prev.photo_count || 0) + result.photo_count }))
+    } catch (error) {
+      console.error('Upload error:', error)
+      setAddFailedFiles(error.uploadId ? newFiles : null)
+      alert(uploadErrorMessage(error))
+    } finally {
+      setAddingPhotos(false)
+    }
+  }
+
+  const handleAddPhotos = (e) => {
+    const newFiles = Array.from(e.target.files).filter(file => file.type.startsWith('image/'))
+    e.target.value = ''
+    if (newFiles.length > 0) addPhotos(newFiles)
+  }
+
   const copyLink = () => {
     navigator.clipboard.writeText(sessionData.share_url)
     alert('Link copied to clipboard! 🎉')
@@ -128,6 +227,10 @@ function HostUpload() {
     setFiles([])
     setPreviews([])
     setSessionData(null)
+    setPendingSession(null)
+    setFailedUploadId(null)
+    setAddFailedFiles(null)
+    setIngestStatus(null)
     setSessionName('')
     setWelcomeMessage('')
     setUploadProgress(0)
@@ -139,9 +242,26 @@ function HostUpload() {
         <div className="success-message">
           <h1>🎉 Session Created!</h1>
           <p style={{ fontSize: '1.3rem', margin: '20px 0', fontWeight: '600' }}>
-            {sessionData.photo_count} photos uploaded successfully
+            {ingestStatus && ingestStatus.done
+              ? `${ingestStatus.ready} photos uploaded successfully`
+              : `Processing photos... ${ingestStatus ? ingestStatus.ready : 0} of ${ingestStatus ? ingestStatus.total : sessionData.photo_count} ready`}
           </p>
 
+          {ingestStatus && !ingestStatus.done && (
+            <div className="progress-bar">
+              <div
+                className="progress-fill"
+                style={{ width: `${Math.round(((ingestStatus.ready + ingestStatus.failed) * 100) / Math.max(ingestStatus.total, 1))}%` }}
+              ></div>
+            </div>
+          )}
+
+          {ingestStatus && ingestStatus.failed > 0 && (
+            <p style={{ fontSize: '0.9rem', color: '#c0392b' }}>
+              {ingestStatus.failed} photo{ingestStatus.failed > 1 ? 's' : ''} could not be processed: {ingestStatus.failed_files.map(f => f.filename).join(', ')}
+            </p>
+          )}
+
           <div style={{ margin: '30px 0', padding: '20px', background: 'white', borderRadius: '12px' }}>
             <p style={{ fontWeight: '600', marginBottom: '10px', color: '#333' }}>Event: {sessionName}</p>
             <p style={{ fontSize: '0.9rem', color: '#666' }}>
@@ -168,9 +288,38 @@ function HostUpload() {
             Share this link with your guests so they can find their photos! 📸
           </p>
 
-          <button onClick={resetForm} className="btn btn-primary">
-            Create Another Session
-          </button>
+          {addingPhotos && (
+            <div style={{ margin: '20px 0' }}>
+              <p style={{ marginBottom: '10px', color: '#666' }}>
+                {uploadStage === 'Uploading...' ? 'Adding photos...' : uploadStage} {uploadProgress}%
+              </p>
+              <div className="progress-bar">
+                <div className="progress-fill" style={{ width: `${uploadProgress}%` }}></div>
+              </div>
+            </div>
+          )}
+
+          <input
+            id="addPhotosInput"
+            type="file"
+            multiple
+            accept="image/*"
+            onChange={handleAddPhotos}
+          />
+
+          <div style={{ display: 'flex', gap: '15px', justifyContent: 'center', flexWrap: 'wrap' }}>
+            <button
+              onClick={() => addFailedFiles ? addPhotos(addFailedFiles) : document.getElementById('addPhotosInput').click()}
+              disabled={addingPhotos}
+              className="btn btn-secondary"
+            >
+              {addingPhotos ? 'Adding Photos...' : addFailedFiles ? '🔁 Retry Adding Photos' : '➕ Add More Photos'}
+            </button>
+
+            <button onClick={resetForm} className="btn btn-primary">
+              Create Another Session
+            </button>
+          </div>
         </div>
       </div>
     )
@@ -278,7 +427,7 @@ function HostUpload() {
           {uploading && (
             <div>
               <p style={{ marginBottom: '10px', color: '#666' }}>
-                Uploading... {uploadProgress}%
+                {uploadStage} {uploadProgress}%
               </p>
               <div className="progress-bar">
                 <div className="progress-fill" style={{ width: `${uploadProgress}%` }}></div>
@@ -312,7 +461,9 @@ function HostUpload() {
               className="btn btn-primary"
               style={{ fontSize: '1.1rem', padding: '16px 40px' }}
             >
-              {uploading ? `Uploading... ${uploadProgress}%` : `🚀 Upload ${files.length} Photos`}
+              {uploading
+                ? `${uploadStage} ${uploadProgress}%`
+                : failedUploadId ? '🔁 Retry Upload' : `🚀 Upload ${files.length} Photos`}
             </button>
           </div>
         </div>
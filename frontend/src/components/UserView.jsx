@@ -2,6 +2,8 @@ import React, { useState, useEffect, useRef } from 'react'
 import { useParams } from 'react-router-dom'
 import axios from 'axios'
 import { detectFace, detectAllFaces, compareFaces, isFaceMatch } from '../services/faceDetection'
+import { fetchThumbnailUrls } from '../services/thumbnailBundle'
+import { fetchDescriptorBundle, matchDescriptorBundle } from '../services/descriptorBundle'
 
 function UserView() {
   const { sessionId } = useParams()
@@ -23,8 +25,31 @@ const [processingStatus, setProcessingStatus] = useState('')
   const [downloadingSelection, setDownloadingSelection] = useState(false)
   
   const selfieImageRef = useRef(null)
+  const bundleUrlsRef = useRef([])
   const apiUrl = import.meta.env.VITE_API_URL || ''
 
+  // Photo URLs are API paths, or absolute R2 URLs when the backend hands out presigned links
+  const resolveUrl = (url) => (/^https?:\/\//.test(url) ? url : `${apiUrl}${url}`)
+
+  // Whole photo list in one request; entries are compact rows described by `fields`
+  const loadManifest = async () => {
+    const response = await axios.get(`${apiUrl}/api/session/${sessionId}/manifest`)
+    const { fields, photos: rows, url_templates: templates } = response.data
+
+    return rows.map(row => {
+      const photo = Object.fromEntries(fields.map((field, i) => [field, row[i]]))
+      const urls = templates
+        ? Object.fromEntries(Object.entries(templates).map(([name, url]) => [name, url.replace('{id}', photo.id)]))
+        : photo
+      return {
+        ...photo,
+        thumbnail_url: resolveUrl(urls.thumbnail_url),
+        grid_url: resolveUrl(urls.grid_url),
+        original_url: resolveUrl(urls.original_url)
+      }
+    })
+  }
+
   useEffect(() => {
     loadSession()
   }, [sessionId])
@@ -51,11 +76,26 @@ const [processingStatus, setProcessingStatus] = useState('')
         `${apiUrl}/api/session/${sessionId}/photos?page=${page}&per_page=10`
       )
       
-      const photosWithUrls = response.data.photos.map(photo => ({
+      let photosWithUrls = response.data.photos.map(photo => ({
         ...photo,
-        thumbnail_url: `${apiUrl}${photo.thumbnail_url}`,
-        original_url: `${apiUrl}${photo.original_url}`
+        thumbnail_url: resolveUrl(photo.thumbnail_url),
+        original_url: resolveUrl(photo.original_url)
       }))
+
+      // All of the page's thumbnails in one request; fall back to per-photo URLs
+      try {
+        const { urls } = await fetchThumbnailUrls(
+          `${apiUrl}/api/session/${sessionId}/thumbnails?page=${page}&per_page=10&size=view`
+        )
+        bundleUrlsRef.current.forEach(url => URL.revokeObjectURL(url))
+        bundleUrlsRef.current = [...urls.values()]
+        photosWithUrls = photosWithUrls.map(photo => ({
+          ...photo,
+          thumbnail_url: urls.get(photo.id) || photo.thumbnail_url
+        }))
+      } catch (error) {
+        console.error('Error loading thumbnail bundle:', error)
+      }
       
       setPhotos(photosWithUrls)
       setTotalPages(response.data.pagination.total_pages)
@@ -108,34 +148,39 @@ const processSelfie = async () => {
     const GALLERY_THRESHOLD = 0.4
 
     // Load all photos
-    const allPhotosToCheck = []
-    for (let page = 1; page <= totalPages; page++) {
-      const response = await axios.get(
-        `${apiUrl}/api/session/${sessionId}/photos?page=${page}&per_page=10`
-      )
-      const pagePhotos = response.data.photos.map(photo => ({
-        ...photo,
-        thumbnail_url: `${apiUrl}${photo.thumbnail_url}`,
-        original_url: `${apiUrl}${photo.original_url}`
-      }))
-      allPhotosToCheck.push(...pagePhotos)
-      
-      const loadProgress = 10 + ((page / totalPages) * 10)
-      setProcessingProgress(loadProgress)
-      setProcessingStatus(`Loading photos... (${page}/${totalPages} pages)`)
+    const allPhotosToCheck = await loadManifest()
+    let photosToAnalyze = allPhotosToCheck
+
+    // Faces found when the host uploaded: one download, matched right here.
+    // Only photos nobody analyzed at upload still have to be fetched one by one.
+    try {
+      setProcessingStatus('📦 Loading faces from the event...')
+      const bundle = await fetchDescriptorBundle(`${apiUrl}/api/session/${sessionId}/descriptors.bin`)
+      const result = matchDescriptorBundle(bundle, referenceGallery, {
+        threshold: MATCH_THRESHOLD,
+        galleryThreshold: GALLERY_THRESHOLD,
+        maxReferences: 3
+      })
+      matched.push(...result.photoIds)
+      referenceGallery.splice(0, referenceGallery.length, ...result.references)
+
+      const unanalyzed = new Set(bundle.unanalyzedPhotoIds)
+      photosToAnalyze = allPhotosToCheck.filter(photo => unanalyzed.has(photo.id))
+    } catch (error) {
+      console.error('Error loading face descriptors:', error)
     }
 
-    setProcessingStatus(`🔍 Analyzing ${allPhotosToCheck.length} photos...`)
+    setProcessingStatus(`🔍 Analyzing ${photosToAnalyze.length} photos...`)
     setProcessingProgress(20)
 
     // Process each photo with progress updates
-    for (let i = 0; i < allPhotosToCheck.length; i++) {
-      const photo = allPhotosToCheck[i]
+    for (let i = 0; i < photosToAnalyze.length; i++) {
+      const photo = photosToAnalyze[i]
       
       // Update progress
-      const progress = 20 + ((i / allPhotosToCheck.length) * 75)
+      const progress = 20 + ((i / photosToAnalyze.length) * 75)
       setProcessingProgress(Math.round(progress))
-      setProcessingStatus(`Analyzing photo ${i + 1} of ${allPhotosToCheck.length}...`)
+      setProcessingStatus(`Analyzing photo ${i + 1} of ${photosToAnalyze.length}...`)
       
       try {
         const img = new Image()
@@ -203,21 +248,8 @@ const processSelfie = async () => {
     if (isPrivacyMode && matched.length > 0) {
       setProcessingStatus('Loading your photos...')
       
-      // Load all pages to get all matched photos
-      const allMatchedPhotos = []
-      for (let page = 1; page <= totalPages; page++) {
-        const response = await axios.get(
-          `${apiUrl}/api/session/${sessionId}/photos?page=${page}&per_page=10`
-        )
-        const pagePhotos = response.data.photos.map(photo => ({
-          ...photo,
-          thumbnail_url: `${apiUrl}${photo.thumbnail_url}`,
-          original_url: `${apiUrl}${photo.original_url}`
-        })).filter(photo => matched.includes(photo.id))
-
-        
-        allMatchedPhotos.push(...pagePhotos)
-      }
+      // One manifest request instead of walking every page
+      const allMatchedPhotos = (await loadManifest()).filter(photo => matched.includes(photo.id))
       
       // Set all matched photos
       setPhotos(allMatchedPhotos)
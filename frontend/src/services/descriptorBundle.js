@@ -0,0 +1,87 @@
+import axios from 'axios'
+
+const BUNDLE_MAGIC = 'PMFD'
+
+// Parse a /descriptors.bin bundle:
+// "PMFD" | uint32 BE header length | header JSON | uint32 photo index per face | float32 descriptors.
+// Both arrays are little-endian and 4-byte aligned, so they are viewed in place.
+export function parseDescriptorBundle(buffer) {
+  const view = new DataView(buffer)
+  const magic = String.fromCharCode(...new Uint8Array(buffer, 0, 4))
+  if (magic !== BUNDLE_MAGIC) {
+    throw new Error('Not a descriptor bundle')
+  }
+
+  const headerLength = view.getUint32(4)
+  const header = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 8, headerLength)))
+  const indexStart = 8 + headerLength
+
+  return {
+    dimensions: header.dimensions,
+    faces: header.faces,
+    photoIds: header.photo_ids,
+    unanalyzedPhotoIds: header.unanalyzed_photo_ids,
+    photoIndex: new Uint32Array(buffer, indexStart, header.faces),
+    matrix: new Float32Array(buffer, indexStart + header.faces * 4, header.faces * header.dimensions)
+  }
+}
+
+// One download for the whole event; the ETag lets the browser revalidate instead of refetching
+export async function fetchDescriptorBundle(url) {
+  const response = await axios.get(url, { responseType: 'arraybuffer' })
+  return parseDescriptorBundle(response.data)
+}
+
+// Euclidean distance from a descriptor to every face in the bundle
+function faceDistances(bundle, descriptor) {
+  const { matrix, faces, dimensions } = bundle
+  const distances = new Float32Array(faces)
+  for (let face = 0; face < faces; face++) {
+    const offset = face * dimensions
+    let sum = 0
+    for (let d = 0; d < dimensions; d++) {
+      const diff = matrix[offset + d] - descriptor[d]
+      sum += diff * diff
+    }
+    distances[face] = Math.sqrt(sum)
+  }
+  return distances
+}
+
+// Photos with a face closer than `threshold` to any reference, best first.
+// Like the per-photo gallery matching, faces very close to the first reference
+// (under `galleryThreshold`) become extra references, up to `maxReferences`.
+// Returns the photo IDs and the references used, for matching further photos.
+export function matchDescriptorBundle(bundle, references, { threshold = 0.6, galleryThreshold = 0.4, maxReferences = 3 } = {}) {
+  const best = faceDistances(bundle, references[0])
+  const gallery = [...references]
+
+  const closest = []
+  best.forEach((distance, face) => {
+    if (distance < galleryThreshold) closest.push(face)
+  })
+  closest.sort((a, b) => best[a] - best[b])
+  for (const face of closest) {
+    if (gallery.length >= maxReferences) break
+    gallery.push(bundle.matrix.subarray(face * bundle.dimensions, (face + 1) * bundle.dimensions))
+  }
+
+  for (const reference of gallery.slice(1)) {
+    const distances = faceDistances(bundle, reference)
+    for (let face = 0; face < bundle.faces; face++) {
+      if (distances[face] < best[face]) best[face] = distances[face]
+    }
+  }
+
+  const photoDistances = new Map()
+  for (let face = 0; face < bundle.faces; face++) {
+    if (best[face] >= threshold) continue
+    const photoId = bundle.photoIds[bundle.photoIndex[face]]
+    if (!photoDistances.has(photoId) || best[face] < photoDistances.get(photoId)) {
+      photoDistances.set(photoId, best[face])
+    }
+  }
+
+  const photoIds = [...photoDistances.keys()].sort((a, b) => photoDistances.get(a) - photoDistances.get(b))
+  return { photoIds, references: gallery }
+}
@@ -58,3 +58,34 @@ export function compareFaces(descriptor1, descriptor2) {
 export function isFaceMatch(distance, threshold = 0.6) {
   return distance < threshold
 }
+
+// The server stores at most this many faces per photo
+const MAX_FACES_PER_PHOTO = 50
+
+// Faces in each of the host's photos, found before upload so guests can match
+// a selfie against them without downloading every photo. An entry is null when
+// a photo couldn't be analyzed; guests' browsers then look at it themselves.
+export async function describePhotoFaces(files, { onProgress } = {}) {
+  try {
+    await loadModels()
+  } catch (error) {
+    return files.map(() => null)
+  }
+
+  const results = []
+  for (let i = 0; i < files.length; i++) {
+    try {
+      const img = await faceapi.bufferToImage(files[i])
+      const detections = await detectAllFaces(img)
+      results.push(detections.slice(0, MAX_FACES_PER_PHOTO).map(detection => ({
+        descriptor: Array.from(detection.descriptor),
+        score: detection.detection.score
+      })))
+    } catch (error) {
+      console.error(`Error detecting faces in ${files[i].name}:`, error)
+      results.push(null)
+    }
+    if (onProgress) onProgress(Math.round(((i + 1) * 100) / files.length))
+  }
+  return results
+}
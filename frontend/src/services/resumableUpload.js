@@ -0,0 +1,111 @@
+import axios from 'axios'
+
+// Parts in flight at once, across all files
+const PART_CONCURRENCY = 6
+const MAX_PART_ATTEMPTS = 4
+
+const sleep = (ms) => new Promise(resolve => setTimeout(resolve, ms))
+
+// Network errors, timeouts, rate limits and server errors are worth retrying
+const isRetryable = (error) => {
+  const status = error.response && error.response.status
+  return !status || status === 408 || status === 429 || status >= 500
+}
+
+async function sendPart(apiUrl, uploadId, part) {
+  const url = `${apiUrl}/api/uploads/${uploadId}/photos/${part.photoId}/parts/${part.index}`
+  for (let attempt = 1; ; attempt++) {
+    try {
+      await axios.put(url, part.blob, { headers: { 'Content-Type': 'application/octet-stream' } })
+      return
+    } catch (error) {
+      if (attempt >= MAX_PART_ATTEMPTS || !isRetryable(error)) throw error
+      await sleep(500 * 2 ** (attempt - 1))
+    }
+  }
+}
+
+// Upload the parts the server reports missing, PART_CONCURRENCY at a time
+async function sendMissingParts(apiUrl, upload, files, onProgress) {
+  const parts = []
+  let totalBytes = 0
+  let sentBytes = 0
+
+  upload.files.forEach((entry, i) => {
+    totalBytes += entry.size
+    const missing = new Set(entry.missing_parts || [])
+    for (let index = 0; index < entry.parts; index++) {
+      const start = index * upload.part_size
+      const blob = files[i].slice(start, Math.min(start + upload.part_size, entry.size))
+      if (missing.has(index)) {
+        parts.push({ photoId: entry.photo_id, index, blob })
+      } else {
+        sentBytes += blob.size
+      }
+    }
+  })
+
+  const report = () => onProgress && onProgress(Math.round((sentBytes * 100) / Math.max(totalBytes, 1)))
+  report()
+
+  let next = 0
+  let failed = 0
+  const worker = async () => {
+    while (next < parts.length) {
+      const part = parts[next++]
+      try {
+        await sendPart(apiUrl, upload.upload_id, part)
+        sentBytes += part.blob.size
+        report()
+      } catch (error) {
+        console.error(`Error uploading part ${part.index} of ${part.photoId}:`, error)
+        failed++
+      }
+    }
+  }
+  await Promise.all(Array.from({ length: PART_CONCURRENCY }, worker))
+
+  if (failed > 0) {
+    const error = new Error(`${failed} parts failed to upload`)
+    error.uploadId = upload.upload_id
+    throw error
+  }
+}
+
+async function commit(apiUrl, uploadId) {
+  const response = await axios.post(`${apiUrl}/api/uploads/${uploadId}/commit`, {})
+  return response.data
+}
+
+// Continue an upload: send only the parts the server doesn't have, then commit.
+// `files` must be the same File objects, in the same order, as when it started.
+export async function resumeUpload(apiUrl, uploadId, files, { onProgress } = {}) {
+  const { data: upload } = await axios.get(`${apiUrl}/api/uploads/${uploadId}`)
+  if (!upload.committed) {
+    await sendMissingParts(apiUrl, upload, files, onProgress)
+  }
+  return commit(apiUrl, uploadId)
+}
+
+// Add photos to a session with the resumable upload protocol:
+// init -> parallel part PUTs (each retried on its own) -> commit.
+// `faces` optionally holds describePhotoFaces() results, sent along with the file list.
+// If parts still fail, the thrown error carries `uploadId` for resumeUpload().
+export async function uploadPhotos(apiUrl, sessionId, files, { onProgress, faces } = {}) {
+  const { data: upload } = await axios.post(`${apiUrl}/api/session/${sessionId}/uploads`, {
+    files: files.map((file, i) => ({
+      filename: file.name,
+      content_type: file.type,
+      size: file.size,
+      ...(faces && faces[i] ? { faces: faces[i] } : {})
+    }))
+  })
+
+  try {
+    await sendMissingParts(apiUrl, upload, files, onProgress)
+    return await commit(apiUrl, upload.upload_id)
+  } catch (error) {
+    error.uploadId = upload.upload_id
+    throw error
+  }
+}
@@ -0,0 +1,36 @@
+import axios from 'axios'
+
+const BUNDLE_MAGIC = 'PMTB'
+
+// Parse a /thumbnails bundle: "PMTB" | uint32 BE header length | header JSON | image bytes
+export function parseThumbnailBundle(buffer) {
+  const view = new DataView(buffer)
+  const magic = String.fromCharCode(...new Uint8Array(buffer, 0, 4))
+  if (magic !== BUNDLE_MAGIC) {
+    throw new Error('Not a thumbnail bundle')
+  }
+
+  const headerLength = view.getUint32(4)
+  const header = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 8, headerLength)))
+  const dataStart = 8 + headerLength
+
+  const images = new Map()
+  for (const entry of header.entries) {
+    const start = dataStart + entry.offset
+    images.set(entry.id, new Blob([buffer.slice(start, start + entry.length)], { type: entry.content_type }))
+  }
+
+  return { images, nextCursor: header.next_cursor }
+}
+
+// Fetch a bundle and turn each thumbnail into an object URL (caller revokes them)
+export async function fetchThumbnailUrls(url) {
+  const response = await axios.get(url, { responseType: 'arraybuffer' })
+  const { images, nextCursor } = parseThumbnailBundle(response.data)
+
+  const urls = new Map()
+  for (const [id, blob] of images) {
+    urls.set(id, URL.createObjectURL(blob))
+  }
+  return { urls, nextCursor }
+}